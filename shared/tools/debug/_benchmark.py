@@ -0,0 +1,420 @@
+"""
+	Benchmarks to measure what the tracer costs.
+
+	Each workload is run untraced first, then under each of the trace modes:
+	  - nop:         a trace function that does nothing (the cost of tracing at all)
+	  - monitoring:  the tracer watching, not recording
+	  - recording:   the tracer recording every context into its buffer
+	  - breakpoints: monitoring with N conditional breakpoints that never stop
+	  - traps:       monitoring with N traps that never trip
+
+	Results report the events per second, the overhead per trace event (compared
+	  to the untraced run), and how much was allocated along the way.
+
+	The full Tracer needs Jython. Outside of Ignition a stand-in for `system`
+	  is installed so it can still be built. If the Tracer can not be imported
+	  at all (plain CPython, for example) the tracer modes fall back to a
+	  component dispatch that mirrors the hot path of Tracer.dispatch:
+	  snapshot, buffer, trap checks and breakpoint lookup.
+
+	Run it from a script console (or any Jython/Python 2 prompt):
+
+		>>> from shared.tools.debug._benchmark import run_benchmarks, format_results
+		>>> print format_results(run_benchmarks())
+"""
+
+import sys
+from time import time
+
+
+__copyright__ = """Copyright (C) 2020 Corso Systems"""
+__license__ = 'Apache 2.0'
+__maintainer__ = 'Andrew Geiger'
+__email__ = 'andrew.geiger@corsosystems.com'
+
+
+#==========================================================================
+# Stand-ins for Ignition
+#==========================================================================
+
+class _LoggerStandIn(object):
+	"""Quacks like an Ignition logger, but only keeps count."""
+	def __init__(self, name):
+		self.name = name
+		self.count = 0
+	def _log(self, message):
+		self.count += 1
+	trace = debug = info = warn = error = _log
+
+
+class _SystemStandIn(object):
+	"""Just enough of Ignition's `system` for the tracer to run outside a gateway."""
+
+	class tag(object):
+		class _Value(object):
+			value = '8.1.0'
+		@staticmethod
+		def read(tag_path):
+			return _SystemStandIn.tag._Value()
+		@staticmethod
+		def exists(tag_path):
+			return False
+
+	class net(object):
+		@staticmethod
+		def getHostName():
+			return 'benchmark'
+
+	class util(object):
+		_loggers = {}
+		@staticmethod
+		def getLogger(name):
+			return _SystemStandIn.util._loggers.setdefault(name, _LoggerStandIn(name))
+		@staticmethod
+		def getProjectName():
+			return 'benchmark'
+		@staticmethod
+		def invokeAsynchronous(function):
+			try:
+				from java.lang import Thread
+				thread = Thread(function)
+			except ImportError:
+				from threading import Thread
+				thread = Thread(target=function)
+				thread.setDaemon(True)
+			thread.start()
+			return thread
+
+
+def install_system_stand_in():
+	"""Install the `system` stand-in, unless the real one is available.
+	Returns True if the stand-in was installed."""
+	import __builtin__
+	if getattr(__builtin__, 'system', None) is not None or 'system' in sys.modules:
+		return False
+	stand_in = _SystemStandIn()
+	__builtin__.system = stand_in
+	sys.modules['system'] = stand_in
+	return True
+
+
+#==========================================================================
+# Workloads
+#==========================================================================
+
+def tight_loop(n=20000):
+	total = 0
+	for i in xrange(n):
+		total += i
+	return total
+
+
+def deep_recursion(depth=200, repeats=20):
+	def recurse(level):
+		if level:
+			return recurse(level - 1) + 1
+		return 0
+	for _ in xrange(repeats):
+		recurse(depth)
+
+
+def exception_heavy(n=2000):
+	caught = 0
+	for i in xrange(n):
+		try:
+			raise ValueError(i)
+		except ValueError:
+			caught += 1
+	return caught
+
+
+def dict_heavy(n=5000):
+	table = {}
+	for i in xrange(n):
+		key = 'key%d' % (i % 100)
+		table[key] = table.get(key, 0) + i
+	return table
+
+
+WORKLOADS = {
+	'tight_loop': tight_loop,
+	'deep_recursion': deep_recursion,
+	'exception_heavy': exception_heavy,
+	'dict_heavy': dict_heavy,
+}
+
+MODES = ('nop', 'monitoring', 'recording', 'breakpoints', 'traps')
+
+
+#==========================================================================
+# Measurement
+#==========================================================================
+
+def _allocation_meter():
+	"""Return a function that reads the allocation counter and its units.
+
+	On the JVM this is the bytes allocated by the current thread.
+	  Otherwise it falls back to the count of live objects the GC tracks.
+	"""
+	try:
+		from java.lang.management import ManagementFactory
+		from java.lang import Thread
+		mxbean = ManagementFactory.getThreadMXBean()
+		thread_id = Thread.currentThread().getId()
+		mxbean.getThreadAllocatedBytes(thread_id)
+		return (lambda: mxbean.getThreadAllocatedBytes(thread_id)), 'bytes'
+	except (ImportError, AttributeError):
+		import gc
+		return (lambda: len(gc.get_objects())), 'objects'
+
+
+def _nop_trace(frame, event, arg):
+	return _nop_trace
+
+
+def count_events(workload):
+	"""Count how many trace events the workload generates."""
+	counter = [0]
+	def counting_trace(frame, event, arg, counter=counter):
+		counter[0] += 1
+		return counting_trace
+	sys.settrace(counting_trace)
+	try:
+		workload()
+	finally:
+		sys.settrace(None)
+	return counter[0]
+
+
+def _time_run(workload, trace_function=None):
+	"""Run the workload once (traced, if given) and return the elapsed seconds."""
+	start = time()
+	if trace_function:
+		sys.settrace(trace_function)
+	try:
+		workload()
+	finally:
+		if trace_function:
+			sys.settrace(None)
+	return time() - start
+
+
+class _ComponentTracer(object):
+	"""Mirror of the Tracer.dispatch hot path, for when the Tracer can't be built."""
+
+	def __init__(self, recording=False):
+		from shared.tools.debug.snapshot import Snapshot, ContextBuffer
+		from shared.tools.debug.breakpoint import Breakpoint
+
+		self._Snapshot = Snapshot
+		self._Breakpoint = Breakpoint
+
+		self.recording = recording
+		self.traps = set()
+		self.context_buffer = ContextBuffer(1000, 64 * 1024 * 1024)
+		self._frame_snapshots = {}
+
+	def dispatch(self, frame, event, arg):
+		if self.recording:
+			context = self._Snapshot(frame, event, arg, clone=True,
+									 previous=self._frame_snapshots.get(frame))
+			if event == 'return':
+				self._frame_snapshots.pop(frame, None)
+			else:
+				self._frame_snapshots[frame] = context
+			self.context_buffer.appendleft(context)
+		else:
+			context = self._Snapshot(frame, event, arg, clone=False)
+
+		for trap in self.traps:
+			trap.check(context)
+		self._Breakpoint.relevant_breakpoints(frame, self)
+		return self.dispatch
+
+	def start(self):
+		sys.settrace(self.dispatch)
+
+	def stop(self):
+		sys.settrace(None)
+
+
+class _NeverTrap(object):
+	"""Stand-in for ContextTrap(caller=...) with a caller that never matches."""
+	def __init__(self, caller):
+		self.caller = caller
+	def check(self, context):
+		return context.caller == self.caller
+
+
+def _tracer_class():
+	"""Get the full Tracer if possible, otherwise None."""
+	install_system_stand_in()
+	try:
+		from shared.tools.debug.tracer import Tracer
+		return Tracer
+	# Jython-only syntax and Java imports fail on other interpreters
+	except (ImportError, SyntaxError):
+		return None
+
+
+def _make_traps(count):
+	"""Traps that are checked on every event, but never trip."""
+	try:
+		from shared.tools.debug.trap import ContextTrap
+	except ImportError:
+		ContextTrap = None
+	traps = []
+	for ix in range(count):
+		caller = '<benchmark:never-%d>' % ix
+		if ContextTrap:
+			trap = ContextTrap(caller=caller)
+		else:
+			trap = _NeverTrap(caller)
+		traps.append(trap)
+	return traps
+
+
+def _function_lines(function):
+	"""The line numbers of the function's body (after its def line)."""
+	code = function.func_code
+	try:
+		from inspect import getsourcelines
+		source_lines, first_line = getsourcelines(function)
+		return range(first_line + 1, first_line + len(source_lines))
+	# No source to be had (a console, say), so just the first body line
+	except (IOError, TypeError):
+		return [code.co_firstlineno + 1]
+
+
+def _make_breakpoints(workload, count, interested_party):
+	"""Conditional breakpoints on the workload's lines that evaluate, but never stop.
+
+	Short functions get more than one breakpoint per line, so every one
+	  of them is still on a line the workload actually runs.
+	"""
+	from shared.tools.debug.breakpoint import Breakpoint
+	code = workload.func_code
+	lines = _function_lines(workload) or [code.co_firstlineno + 1]
+	breakpoints = []
+	for ix in range(count):
+		breakpoint = Breakpoint(code.co_filename, lines[ix % len(lines)],
+								condition='False', note='benchmark')
+		breakpoint.enable(interested_party)
+		breakpoints.append(breakpoint)
+	return breakpoints
+
+
+def _time_tracer_run(workload, mode, num_breakpoints, num_traps):
+	"""Time one run of the workload under the tracer configured for the mode."""
+	Tracer = _tracer_class()
+
+	breakpoints = []
+	if Tracer:
+		tracer = Tracer(trace_asap=True)
+		tracer.recording = (mode == 'recording')
+	else:
+		tracer = _ComponentTracer(recording=(mode == 'recording'))
+
+	try:
+		if mode == 'breakpoints':
+			breakpoints = _make_breakpoints(workload, num_breakpoints, tracer)
+		if mode == 'traps':
+			for trap in _make_traps(num_traps):
+				tracer.traps.add(trap)
+
+		start = time()
+		if Tracer:
+			tracer.monitor()
+		else:
+			tracer.start()
+		try:
+			workload()
+		finally:
+			if Tracer:
+				tracer.monitoring = False
+				tracer.sys.settrace(None)
+			else:
+				tracer.stop()
+		return time() - start
+
+	finally:
+		for breakpoint in breakpoints:
+			breakpoint._remove()
+		if Tracer:
+			del Tracer[tracer.id]
+
+
+def _best_of(repeats, read_allocations, run):
+	"""Repeat the run, returning the fastest time and the least allocated."""
+	timings = []
+	allocated = None
+	for _ in range(repeats):
+		allocations_start = read_allocations()
+		timings.append(run())
+		run_allocated = read_allocations() - allocations_start
+		if allocated is None or run_allocated < allocated:
+			allocated = run_allocated
+	return min(timings), allocated
+
+
+def run_benchmarks(workloads=None, modes=MODES, repeats=3, num_breakpoints=10, num_traps=10):
+	"""Run each workload untraced and under each mode, keeping the best of repeats.
+
+	Returns a list of result dicts (one per workload and mode).
+	"""
+	if workloads is None:
+		workloads = sorted(WORKLOADS)
+
+	read_allocations, allocation_units = _allocation_meter()
+
+	results = []
+	for workload_name in workloads:
+		workload = WORKLOADS[workload_name]
+
+		events = count_events(workload)
+		baseline, allocated = _best_of(repeats, read_allocations, 
+									   lambda: _time_run(workload))
+
+		results.append({
+			'workload': workload_name,
+			'mode': 'untraced',
+			'seconds': baseline,
+			'events': events,
+			'events_per_second': events / baseline if baseline else 0.0,
+			'overhead_per_event': 0.0,
+			'allocated': allocated,
+			'allocation_units': allocation_units,
+		})
+
+		for mode in modes:
+			if mode == 'nop':
+				run = lambda: _time_run(workload, _nop_trace)
+			else:
+				run = lambda: _time_tracer_run(workload, mode, num_breakpoints, num_traps)
+			seconds, allocated = _best_of(repeats, read_allocations, run)
+
+			results.append({
+				'workload': workload_name,
+				'mode': mode,
+				'seconds': seconds,
+				'events': events,
+				'events_per_second': events / seconds if seconds else 0.0,
+				'overhead_per_event': (seconds - baseline) / events if events else 0.0,
+				'allocated': allocated,
+				'allocation_units': allocation_units,
+			})
+
+	return results
+
+
+def format_results(results):
+	"""Render the benchmark results as a plain text table."""
+	header = '%-16s %-12s %10s %10s %14s %14s %14s' % (
+		'workload', 'mode', 'seconds', 'events', 'events/sec', 'us/event', 'allocated')
+	lines = [header, '-' * len(header)]
+	for result in results:
+		lines.append('%-16s %-12s %10.4f %10d %14.1f %14.3f %14d %s' % (
+			result['workload'], result['mode'], result['seconds'], result['events'],
+			result['events_per_second'], result['overhead_per_event'] * 1000000.0,
+			result['allocated'], result['allocation_units']))
+	return '\n'.join(lines)
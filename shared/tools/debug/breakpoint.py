@@ -4,6 +4,8 @@
 
 from weakref import WeakValueDictionary
 from collections import defaultdict
+from threading import Lock
+from time import time
 
 from shared.tools.debug.frame import normalize_filename
 
@@ -20,7 +22,8 @@ class Breakpoint(object):
 	  effectively brings the situation to the breakpoint to be verified.
 	"""
 	__slots__ = ('_id', '_filename', '_line_number', '_function_name',
-				 'temporary', 'condition', 'hits', 
+				 'temporary', '_condition', '_condition_code', 'hits', 
+				 'condition_evals', 'condition_time',
 				 'enabled', 'ignored',
 				 'note',
 				 '__weakref__',
@@ -31,6 +34,16 @@ class Breakpoint(object):
 	_instances = {}
 	_break_locations = {(None, None): set()}
 
+	# Candidate breakpoints per code object, keyed by (co_filename, co_firstlineno).
+	# Each entry maps a line number to the breakpoints that can trip on it,
+	#   with None holding those that may trip on any line (contextless or by function).
+	# Built lazily as code is seen and cleared whenever the breakpoints change.
+	_code_index = {}
+	# Bumped on every change, so a build that raced a change is thrown away
+	#   instead of caching what was already stale.
+	_index_generation = 0
+	_index_lock = Lock()
+
 
 	def __init__(self, filename=None, location=None, 
 				 temporary=False, condition=None, note=''):
@@ -57,6 +70,8 @@ class Breakpoint(object):
 		self.condition = condition
 
 		self.hits = 0
+		self.condition_evals = 0
+		self.condition_time = 0.0 # seconds
 
 		# use Tracer/PDB instance as key for number of hits
 		self.enabled = defaultdict(bool) # no one is interested by default
@@ -89,6 +104,30 @@ class Breakpoint(object):
 		return self._id
 
 
+	def _get_condition(self):
+		return self._condition
+
+	def _set_condition(self, condition):
+		"""Compile the condition once here, rather than on every evaluation.
+		
+		Like PDB, this accepts a string or already compiled code. If the string
+		  fails to compile, the code is left as None and the breakpoint will
+		  simply break (to be safe) when tripped.
+		"""
+		self._condition = condition
+		if not condition:
+			self._condition_code = None
+		elif isinstance(condition, (str, unicode)):
+			try:
+				self._condition_code = compile(condition, '<breakpoint:condition>', 'eval')
+			except SyntaxError:
+				self._condition_code = None
+		else:
+			self._condition_code = condition
+
+	condition = property(_get_condition, _set_condition)
+
+
 	@classmethod
 	def next_id(cls):
 		cls._id_counter += 1
@@ -129,11 +168,75 @@ class Breakpoint(object):
 			
 			self._id = self.next_id()
 			self._instances[self.id] = self 
+			self._invalidate_index()
 
 	def _remove(self):
 		self.enabled.clear()
 		del self._instances[self.id]
 		self._break_locations[self.location].remove(self)
+		self._invalidate_index()
+
+
+	@classmethod
+	def _invalidate_index(cls):
+		"""Drop the per-code index so it gets rebuilt with the current breakpoints."""
+		cls._index_lock.acquire()
+		try:
+			Breakpoint._index_generation += 1
+			cls._code_index.clear()
+		finally:
+			cls._index_lock.release()
+
+
+	@classmethod
+	def _index_code(cls, code):
+		"""Gather the breakpoints that could ever trip in the given code object.
+
+		Only breakpoints enabled for someone are considered. Line breakpoints
+		  before the code's first line can not be in it, and function breakpoints
+		  only apply to code of that name.
+		"""
+		filename = normalize_filename(code.co_filename)
+		generation = cls._index_generation
+
+		index = {}
+		for breakpoint in list(cls._instances.values()):
+			if not any(breakpoint.enabled.values()):
+				continue
+			if breakpoint.filename and breakpoint.filename != filename:
+				continue
+
+			if breakpoint.function_name:
+				if breakpoint.function_name != code.co_name:
+					continue
+				line_number = None
+			elif breakpoint.line_number:
+				if breakpoint.line_number < code.co_firstlineno:
+					continue
+				line_number = breakpoint.line_number
+			else:
+				line_number = None
+
+			index[line_number] = index.get(line_number, ()) + (breakpoint,)
+
+		# Only cache it if nothing changed while it was being built.
+		# (It's still fine to use this once - it was current when the call began.)
+		cls._index_lock.acquire()
+		try:
+			if generation == cls._index_generation:
+				cls._code_index[(code.co_filename, code.co_firstlineno)] = index
+		finally:
+			cls._index_lock.release()
+		return index
+
+
+	@classmethod
+	def code_index(cls, code):
+		"""Return the candidate breakpoint index for the code object. Empty if none apply."""
+		try:
+			return cls._code_index[(code.co_filename, code.co_firstlineno)]
+		except KeyError:
+			return cls._index_code(code)
 
 
 	def trip(self, frame):
@@ -186,10 +289,12 @@ class Breakpoint(object):
 	def enable(self, interested_party):
 		"""Enable the breakpoint for the interested_party"""
 		self.enabled[interested_party] = True
+		self._invalidate_index()
 		
 	def disable(self, interested_party):
 		"""Disable the breakpoint for the interested_party (this is the default state)"""
 		self.enabled[interested_party] = False
+		self._invalidate_index()
 
 	def ignore(self, interested_party, num_passes=0):
 		"""Ignore this breakpoint for num_passes times for the interested_party"""
@@ -202,14 +307,13 @@ class Breakpoint(object):
 
 		# Possible breakpoints are not only the function or line trigger,
 		#   but also any breakpoint that can fire anywhere.
-		location_by_line = cls.frame_location_by_line(frame)
-		location_by_function = cls.frame_location_by_function(frame)
+		# The index is precomputed per code object, so frames that can't break
+		#   bail out here without checking any locations.
+		index = cls.code_index(frame.f_code)
+		if not index:
+			return relevant
 
-		possible = set( cls._break_locations[(None,None)]
-					  | cls._break_locations.get((None, location_by_line[1]), set())
-			          | cls._break_locations.get((None, location_by_function[1]), set())
-					  | cls._break_locations.get(location_by_line, set())
-			          | cls._break_locations.get(location_by_function, set()) )
+		possible = index.get(None, ()) + index.get(frame.f_lineno, ())
 
 		# Check candidate locations
 		for breakpoint in possible:
@@ -246,9 +350,17 @@ class Breakpoint(object):
 					# Sure, eval is evil... but we're in debug so all bets are off
 					# Note that this is like PDB: it expects a string or compiled code here.
 					#   A function will need to be either in scope or compiled beforehand!
-					result = eval(breakpoint.condition, 
-								  frame.f_globals,
-								  frame.f_locals)
+					# (The condition was compiled when set, so this is just the eval.)
+					if breakpoint._condition_code is None:
+						raise SyntaxError("Breakpoint condition did not compile: %r" % breakpoint.condition)
+					breakpoint.condition_evals += 1
+					start = time()
+					try:
+						result = eval(breakpoint._condition_code, 
+									  frame.f_globals,
+									  frame.f_locals)
+					finally:
+						breakpoint.condition_time += time() - start
 					if result:
 						# If interested_party chose to ignore the breakpoint,
 						#   decrement the counter and pass on...
@@ -275,6 +387,8 @@ class Breakpoint(object):
 			'hits': self.hits,
 			'temporary': self.temporary,
 			'condition': self.condition,
+			'condition_evals': self.condition_evals,
+			'condition_time': self.condition_time,
 			'ignore_remaining': self.ignored[interested_party] if interested_party else self.ignored,
 			'location': '%s:%s' % (self.filename or '<ANYWHERE>', self.function_name or self.line_number)
 		}
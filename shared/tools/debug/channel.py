@@ -0,0 +1,145 @@
+"""
+	Command channels for the tracer.
+
+	Commands are handed from whatever thread sends them (a script console,
+	  a message handler, the tag poller) to the traced thread over a blocking
+	  queue. The traced thread sleeps on the queue instead of polling, so it
+	  wakes as soon as a command is put in, and costs nothing while idle.
+
+	Each command put in gets a PendingCommand handle back that resolves
+	  once the traced thread has run it.
+"""
+
+from java.util.concurrent import LinkedBlockingQueue, CountDownLatch, TimeUnit
+
+from time import time
+
+
+__copyright__ = """Copyright (C) 2020 Corso Systems"""
+__license__ = 'Apache 2.0'
+__maintainer__ = 'Andrew Geiger'
+__email__ = 'andrew.geiger@corsosystems.com'
+
+
+__all__ = ['CommandChannel', 'PendingCommand', 'CommandTimeout']
+
+
+class CommandTimeout(RuntimeError):
+	"""The command was not completed in the time allowed."""
+	pass
+
+
+def _to_millis(seconds):
+	return long(max(0, seconds) * 1000)
+
+
+class PendingCommand(object):
+	"""
+	Completion handle for a command sent down a CommandChannel.
+
+	The sender can block on get() until the receiver calls complete().
+	"""
+	__slots__ = ('command', 'result', 'submitted', 'completed', '_latch')
+
+	def __init__(self, command):
+		self.command = command
+		self.result = None
+		self.submitted = time()
+		self.completed = None
+		self._latch = CountDownLatch(1)
+
+	def complete(self, result=None):
+		"""Mark the command done (and wake anything waiting on it)."""
+		self.result = result
+		self.completed = time()
+		self._latch.countDown()
+
+	@property
+	def done(self):
+		return self._latch.getCount() == 0
+
+	@property
+	def latency(self):
+		"""Seconds from being sent to being completed (None until then)."""
+		if self.completed is None:
+			return None
+		return self.completed - self.submitted
+
+	def wait(self, timeout=None):
+		"""Block until the command is done. Returns True if it finished in time."""
+		if timeout is None:
+			self._latch.await()
+			return True
+		return self._latch.await(_to_millis(timeout), TimeUnit.MILLISECONDS)
+
+	def get(self, timeout=None):
+		"""Block until the command is done and return its result."""
+		if not self.wait(timeout):
+			raise CommandTimeout('Command %r did not complete within %r seconds' % (self.command, timeout))
+		return self.result
+
+	def __repr__(self):
+		return '<PendingCommand %r (%s)>' % (self.command, 'done' if self.done else 'pending')
+
+
+class CommandChannel(object):
+	"""
+	An unbounded FIFO of commands, safe to share between threads.
+
+	Commands can be put in as strings (or lists of them) and are taken out
+	  as PendingCommand handles.
+	"""
+	__slots__ = ('_queue',)
+
+	def __init__(self):
+		self._queue = LinkedBlockingQueue()
+
+	def put(self, command):
+		"""Queue a command (or a list of commands). Returns the handle(s)."""
+		if isinstance(command, (list, tuple)):
+			return [self.put(each) for each in command]
+		if not isinstance(command, PendingCommand):
+			command = PendingCommand(command)
+		self._queue.put(command)
+		return command
+
+	def take(self, timeout=None):
+		"""
+		Get the next command, waiting up to timeout seconds for one to arrive.
+		With no timeout this blocks until a command arrives.
+		Returns None if nothing came in time.
+		"""
+		if timeout is None:
+			return self._queue.take()
+		return self._queue.poll(_to_millis(timeout), TimeUnit.MILLISECONDS)
+
+	def poll(self):
+		"""Get the next command without waiting (None if there is none)."""
+		return self._queue.poll()
+
+	def drain(self):
+		"""Take every command currently queued, without waiting."""
+		commands = []
+		while True:
+			command = self._queue.poll()
+			if command is None:
+				return commands
+			commands.append(command)
+
+	def clear(self):
+		self._queue.clear()
+
+	def __contains__(self, command):
+		for pending in self._queue.toArray():
+			if pending.command == command:
+				return True
+		return False
+
+	def __len__(self):
+		return self._queue.size()
+
+	def __nonzero__(self):
+		return not self._queue.isEmpty()
+
+	def __repr__(self):
+		return '<CommandChannel (%d pending)>' % len(self)
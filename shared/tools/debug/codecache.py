@@ -25,9 +25,13 @@ from shared.tools.meta import MetaSingleton
 from shared.tools.debug.frame import find_root_object, normalize_filename
 
 import system
-import sys
+import sys, os
 
 from functools import wraps
+from threading import RLock
+from bisect import bisect_right
+from time import time
+import hashlib
 
 
 __copyright__ = """Copyright (C) 2020 Corso Systems"""
@@ -82,6 +86,26 @@ try:
 		
 		return html.strip()
 
+
+	# Lexing whole sources for line-by-line use: don't strip anything, 
+	#   or the lines won't line up with the source any more
+	SOURCE_LEXER = PythonLexer(stripnl=False, tabsize=4)
+
+	def highlight_lines(code_lines, style='monokai'):
+		"""Use Pygments to syntax highlight code, giving the HTML fragment for each line.
+
+		The formatter closes its spans at each line end, so each fragment
+		  stands alone (even inside multi-line strings).
+		"""
+		formatter = HtmlFormatter(style=style, nowrap=True, noclasses=True)
+		html_lines = highlight('\n'.join(code_lines), SOURCE_LEXER, formatter).split('\n')
+		return html_lines[:len(code_lines)]
+
+	def highlight_colors(style='monokai'):
+		"""Background and highlighted line colors for the style."""
+		style = HtmlFormatter(style=style).style
+		return style.background_color, style.highlight_color
+
 # In case Pygments is not installed, passthru
 except ImportError:
 
@@ -103,18 +127,175 @@ except ImportError:
 		return html.strip()
 
 
+	def highlight_lines(code_lines, style='unavailable'):
+		"""Fallback highlighter - just escapes each line"""
+		return [escape_html(line) for line in code_lines]
+
+	def highlight_colors(style='unavailable'):
+		return '#ffffff', '#ffffcc'
+
+
+def escape_html(text):
+	return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+HIGHLIGHTED_TEMPLATE = """<html>
+<body style="background: %(background)s">
+<table><tr>
+<td style="background-color: #000000; color: #ffffff"><pre>%(line_numbers)s</pre></td>
+<td><pre>%(code)s</pre></td>
+</tr></table>
+</body>
+</html>"""
+
+def render_highlighted(html_lines, start_line=1, highlight_line_numbers=[], style='monokai'):
+	"""Assemble pre-highlighted line fragments (from highlight_lines) into an HTML block.
+	Lines are numbered from start_line."""
+	background, highlight_color = highlight_colors(style)
+
+	line_numbers = []
+	code = []
+	for line_number, html_line in enumerate(html_lines):
+		line_number += start_line
+		line_numbers.append('%d' % line_number)
+		if line_number in highlight_line_numbers:
+			html_line = '<span style="background-color: %s">%s</span>' % (highlight_color, html_line or ' ')
+		code.append(html_line)
+
+	return HIGHLIGHTED_TEMPLATE % {
+		'background': background,
+		'line_numbers': '<br>'.join(line_numbers),
+		'code': '<br>'.join(code),
+		}
+
+
+class Source(object):
+	"""Source code, split once into lines so lookups don't re-split it.
+
+	Lines are indexed from zero, as in the list from splitlines(), so a frame's
+	  (one-indexed) f_lineno is at index f_lineno - 1. Where each line starts
+	  in the original text is kept as well, as a character offset (an index 
+	  into text, not a count of bytes), so positions in the text can be mapped
+	  back to lines (and vice versa).
+	"""
+	__slots__ = ('text', 'lines', 'offsets', '_rendered', '_digest')
+
+	def __init__(self, text):
+		self.text = text
+		self.lines = text.splitlines()
+
+		offsets = []
+		position = 0
+		for line in text.splitlines(True):
+			offsets.append(position)
+			position += len(line)
+		self.offsets = offsets
+
+		self._rendered = {}
+		self._digest = None
+
+	@property
+	def digest(self):
+		"""Hash of the text, so identical sources can be recognized."""
+		if self._digest is None:
+			text = self.text
+			if isinstance(text, unicode):
+				text = text.encode('utf-8')
+			self._digest = hashlib.md5(text).hexdigest()
+		return self._digest
+
+	def line(self, index, default=''):
+		"""The line at the (zero-based) index, or default if there's no such line."""
+		if index < 0:
+			return default
+		try:
+			return self.lines[index]
+		except IndexError:
+			return default
+
+	def offset(self, index):
+		"""Character offset in the text where the line at index starts."""
+		return self.offsets[index]
+
+	def line_index(self, offset):
+		"""Index of the line that contains the character offset in the text."""
+		return max(0, bisect_right(self.offsets, offset) - 1)
+
+	def rendered(self, tab_stop):
+		"""The lines with tabs rendered as spaces to the tab stop. Computed on first request."""
+		try:
+			return self._rendered[tab_stop]
+		except KeyError:
+			rendered = self._rendered[tab_stop] = render_tabstops(self.lines, tab_stop)
+			return rendered
+
+	def __len__(self):
+		return len(self.lines)
+
+	def __getitem__(self, index):
+		return self.lines[index]
+
+	def __iter__(self):
+		return iter(self.lines)
+
+	def __nonzero__(self):
+		return bool(self.text)
+
+	def __str__(self):
+		return self.text
+
+	def __repr__(self):
+		return '<Source %d lines>' % len(self.lines)
+
+
+def render_tabstops(code_lines, tab_stop=4):
+	"""Replace tab characters with spaces to align to tab stops."""
+	rendered_lines = []
+	
+	for line in code_lines:
+		rendered = ''
+		while '\t' in line:
+			pre, tab, line = line.partition('\t')
+			rendered += pre
+			rendered += ' '*(tab_stop - (len(rendered) % tab_stop))
+		rendered += line
+		rendered_lines.append(rendered)
+	return rendered_lines
+
+
+def file_mtime(filepath):
+	"""Modification time of the file, or None if it can't be checked."""
+	if not filepath:
+		return None
+	try:
+		return os.path.getmtime(filepath)
+	except (OSError, IOError):
+		return None
+
+
+class SourceEntry(object):
+	"""A cached Source, along with what's needed to know if it's gone stale."""
+	__slots__ = ('key', 'source', 'version', 'size', 'last_used', 'last_checked')
+
+	def __init__(self, key, source, version=None):
+		self.key = key
+		self.source = source
+		self.version = version
+		self.size = len(source.text)
+		self.last_used = self.last_checked = time()
+
+
 def cached(function):
-	"""Decorator for classmethods that can cache their inputs."""
+	"""Decorator for classmethods that can cache their inputs.
+	Code found is cached (and returned) as a Source.
+
+	Entries are keyed on the function and its arguments, and are never 
+	  revalidated - they're only dropped by eviction or invalidate().
+	"""
 	@wraps(function)
 	def check_cache_first(cls, *args):
-		if not args in cls._cache:
-			code = function(cls, *args)
-			if code:
-				cls._cache[args] = code
-				return code
-		else:
-			return cls._cache[args]
-		return None
+		return cls._cache_fetch((function.__name__,) + args, 
+								lambda: function(cls, *args))
 	return check_cache_first
 
 
@@ -132,29 +313,166 @@ class MetaCodeCache(type):
 
 
 	# cache keys are based on what the _code_* functions need.
+	#   (Every tracer thread shares these, so changes to them hold the _cache_lock)
 	_cache = {}
+	_cache_bytes = 0
+	_cache_lock = RLock()
+	_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+	# Least recently used sources are dropped past either limit
+	MAX_ENTRIES = 200
+	MAX_BYTES = 16 * 1024 * 1024 # characters of source, really
+	# Sources that can go stale (files, modules) are rechecked at most this often
+	REVALIDATE_INTERVAL = 2.0 # seconds
+
+	# Highlighted lines, keyed by (source digest, style)
+	_highlight_cache = {}
+	HIGHLIGHT_CACHE_LIMIT = 20
 
 	_default_sys_context = sys
 
 	TAB_STOP = 4
 
 
+	#==========================================================================
+	# Cache management
+	#==========================================================================
+
+	def _cache_fetch(cls, key, load, version=None):
+		"""Get the Source cached for the key, loading (and caching) it if needed.
+
+		load() returns the code (or None if it can't be found).
+		version(), if given, returns something that changes when the code 
+		  might have. If it no longer matches the cached entry's, 
+		  the entry is dropped and the code loaded fresh.
+		"""
+		now = time()
+		cls._cache_lock.acquire()
+		try:
+			entry = cls._cache.get(key)
+
+			if entry is not None:
+				if version and (now - entry.last_checked) >= cls.REVALIDATE_INTERVAL:
+					entry.last_checked = now
+					if version() != entry.version:
+						cls._cache_drop(key)
+						cls._cache_stats['invalidations'] += 1
+						entry = None
+
+			if entry is not None:
+				entry.last_used = now
+				cls._cache_stats['hits'] += 1
+				return entry.source
+
+			cls._cache_stats['misses'] += 1
+		finally:
+			cls._cache_lock.release()
+
+		# Loading can be slow, so it's done unlocked. 
+		#   (If another thread loads the same key meanwhile, the last one in replaces the other.)
+		code = load()
+		if not code:
+			return None
+		entry = SourceEntry(key, Source(code), version and version())
+
+		cls._cache_lock.acquire()
+		try:
+			cls._cache_drop(key)
+			cls._cache[key] = entry
+			cls._cache_bytes += entry.size
+			cls._cache_trim()
+		finally:
+			cls._cache_lock.release()
+		return entry.source
+
+
+	def _cache_drop(cls, key):
+		"""Remove the key's entry, if any. (Hold the _cache_lock.)"""
+		entry = cls._cache.pop(key, None)
+		if entry is not None:
+			cls._cache_bytes -= entry.size
+		return entry
+
+
+	def _cache_trim(cls):
+		"""Evict the least recently used entries until back within the limits.
+		The most recent entry is always kept, even if it alone is over MAX_BYTES.
+		(Hold the _cache_lock.)"""
+		while len(cls._cache) > 1 and (   len(cls._cache) > cls.MAX_ENTRIES
+									   or cls._cache_bytes > cls.MAX_BYTES):
+			oldest = min(cls._cache.values(), key=lambda entry: entry.last_used)
+			cls._cache_drop(oldest.key)
+			cls._cache_stats['evictions'] += 1
+
+
+	def invalidate(cls, location=None):
+		"""Drop cached source. Without a location everything is dropped,
+		otherwise only entries for that module name, file path, or event name."""
+		cls._cache_lock.acquire()
+		try:
+			for key in list(cls._cache):
+				if location is None or location in key[1:]:
+					cls._cache_drop(key)
+					cls._cache_stats['invalidations'] += 1
+		finally:
+			cls._cache_lock.release()
+		if location is None:
+			cls._highlight_cache.clear()
+
+
+	@property
+	def stats(cls):
+		"""Cache counters and current usage."""
+		cls._cache_lock.acquire()
+		try:
+			stats = dict(cls._cache_stats)
+			stats['entries'] = len(cls._cache)
+			stats['bytes'] = cls._cache_bytes
+		finally:
+			cls._cache_lock.release()
+		stats['max_entries'] = cls.MAX_ENTRIES
+		stats['max_bytes'] = cls.MAX_BYTES
+		stats['highlighted'] = len(cls._highlight_cache)
+		return stats
+
+
+	#==========================================================================
+	# Lookup
+	#==========================================================================
+
+
 	def __getitem__(cls, location):
 		if isinstance(location, slice):
 			return cls._dispatch_frame(location.start, sys_context=location.stop)
 		return cls._dispatch_frame(location)
 
 
+	def get_source(cls, frame, sys_context=None):
+		"""Retrieve the Source for the frame's code (or None if it can't be found)."""
+		return cls._dispatch_frame(frame, sys_context)
+
+
 	def get_line(cls, frame, sys_context=None):
 		"""Retrieve the line of code at the frame location."""
-		code = cls._dispatch_frame(frame)
+		source = cls._dispatch_frame(frame, sys_context)
 
-		if not code: 
+		if not source: 
 			return ''
 		
-		return code.splitlines()[frame.f_lineno]
+		# frame lines are one-indexed
+		return source.line(frame.f_lineno - 1)
 		
 
+	def get_rendered_lines(cls, frame, sys_context=None):
+		"""Retrieve all the lines of code in the frame's file, with tabs rendered to TAB_STOP."""
+		source = cls._dispatch_frame(frame, sys_context)
+
+		if not source:
+			return []
+
+		return source.rendered(cls.TAB_STOP)
+
+
 	def get_lines(cls, frame, radius=5, sys_context=None):
 		"""Retreive the lines of code at the frame location.
 
@@ -173,19 +491,63 @@ class MetaCodeCache(type):
 		If radius is 0, return all the code in that frame's file.
 		Otherwise, return radius lines before and after the frame's
 		  active line, clamping to the start/end of the code block.
+		The starting line is one-indexed, like f_lineno. If there's no
+		  source to be had, there are no lines.
 		"""
-		code = cls._dispatch_frame(frame)
+		source = cls._dispatch_frame(frame, sys_context)
 	
-		if not code: 
-			return []
+		if not source: 
+			return [], 1
 		else:
-			code_lines = code.splitlines()
+			code_lines = source.lines
 	
 		if not radius:
-			return code_lines, 1
+			# Copied, so the cached lines can't be changed by the caller
+			return code_lines[:], 1
 		else:
-			block_slice = cls._calc_block_ends(frame.f_lineno, len(code_lines), radius)
-			return code_lines[block_slice], block_slice.start		
+			# frame lines are one-indexed
+			block_slice = cls._calc_block_ends(frame.f_lineno - 1, len(code_lines), radius)
+			return code_lines[block_slice], block_slice.start + 1
+
+
+	def get_highlighted(cls, frame, radius=5, style='monokai', sys_context=None):
+		"""Syntax highlighted HTML of the code around the frame's line (which is marked).
+
+		If radius is 0, return all the code in that frame's file.
+
+		Sources are highlighted once per style, line by line, so moving 
+		  around a file just reassembles lines already rendered.
+		"""
+		source = cls._dispatch_frame(frame, sys_context)
+
+		if not source:
+			return None
+
+		html_lines = cls._highlighted_lines(source, style)
+
+		# frame lines are one-indexed
+		if radius:
+			block_slice = cls._calc_block_ends(frame.f_lineno - 1, len(html_lines), radius)
+		else:
+			block_slice = slice(0, len(html_lines))
+
+		return render_highlighted(html_lines[block_slice], block_slice.start + 1, [frame.f_lineno], style)
+
+
+	def _highlighted_lines(cls, source, style):
+		key = (source.digest, style)
+		try:
+			return cls._highlight_cache[key]
+		except KeyError:
+			pass
+
+		html_lines = highlight_lines(source.lines, style)
+
+		# These are only ever needed for the few files being debugged
+		if len(cls._highlight_cache) >= cls.HIGHLIGHT_CACHE_LIMIT:
+			cls._highlight_cache.clear()
+		cls._highlight_cache[key] = html_lines
+		return html_lines
 
 
 	@staticmethod
@@ -213,17 +575,7 @@ class MetaCodeCache(type):
 	
 	def _render_tabstops(cls, code_lines):
 		"""Replace tab characters with spaces to align to tab stops."""
-		rendered_lines = []
-		
-		for line in code_lines:
-			rendered = ''
-			while '\t' in line:
-				pre, tab, line = line.partition('\t')
-				rendered += pre
-				rendered += ' '*(cls.TAB_STOP - (len(rendered) % cls.TAB_STOP))
-			rendered += line
-			rendered_lines.append(rendered)
-		return rendered_lines
+		return render_tabstops(code_lines, cls.TAB_STOP)
 		
 
 	def _dispatch_frame(cls, frame, sys_context=None):
@@ -260,10 +612,12 @@ class MetaCodeCache(type):
 		return None
 
 
-	@cached
 	def _code_file(cls, filepath):
-		with open(filepath, 'r') as f:
-			return f.read()
+		def load(filepath=filepath):
+			with open(filepath, 'r') as f:
+				return f.read()
+		return cls._cache_fetch(('_code_file', filepath), load, 
+								lambda filepath=filepath: file_mtime(filepath))
 
 
 	@cached
@@ -286,9 +640,30 @@ class MetaCodeCache(type):
 			return None
 
 
-	@cached
 	def _code_module(cls, filename, sys_context=None):
-	
+		"""Get the module's source. 
+
+		Cached by module name, and checked against the module object itself 
+		  (and its file's mtime, if any). Saving the project recreates the 
+		  project library modules, so the cache sees the change and reloads.
+		"""
+		resolved = []
+		def module(filename=filename, sys_context=sys_context):
+			if not resolved:
+				resolved.append(cls._resolve_module(filename, sys_context))
+			return resolved[0]
+
+		def version():
+			current = module()
+			return (id(current), file_mtime(getattr(current, '__file__', None)))
+
+		def load():
+			return cls._module_source(module())
+
+		return cls._cache_fetch(('_code_module', filename), load, version)
+
+
+	def _resolve_module(cls, filename, sys_context=None):
 		if sys_context is None:
 			sys_context = cls._default_sys_context
 		
@@ -311,7 +686,11 @@ class MetaCodeCache(type):
 			#   loading in, either. So we have to do a loop to let each
 			#   getattr statement take as long as the mechanics need.
 			# module = reduce(getattr, module_chain[1:], module)
-			
+
+		return module
+
+
+	def _module_source(cls, module):
 		filepath = getattr(module, '__file__', None)
 		if filepath:
 			with open(filepath, 'r') as f:
@@ -364,7 +743,7 @@ def trace_entry_line(frame, indent='  '):
 
 	out += frame.f_code.co_name or '<lambda>'
 
-	out += repr(frame.f_locals.get('__args__'), tuple())
+	out += repr(frame.f_locals.get('__args__', tuple()))
 
 	return_value = frame.f_locals.get('__return__', None)
 	if return_value:
@@ -0,0 +1,46 @@
+"""
+	Delta encoding for remote tracer state updates.
+
+	Remote updates only carry what changed since the last one sent.
+	  Note that keys are never removed - the state payloads have a fixed shape.
+
+		>>> previous = {'a': 1, 'b': {'c': 2, 'd': 3}}
+		>>> state = {'a': 1, 'b': {'c': 2, 'd': 4}}
+		>>> delta_encode(state, previous)
+		{'b': {'d': 4}}
+		>>> delta_merge(previous, delta_encode(state, previous)) == state
+		True
+"""
+
+
+__copyright__ = """Copyright (C) 2020 Corso Systems"""
+__license__ = 'Apache 2.0'
+__maintainer__ = 'Andrew Geiger'
+__email__ = 'andrew.geiger@corsosystems.com'
+
+
+__all__ = ['delta_encode', 'delta_merge']
+
+
+def delta_encode(state, previous):
+	"""Return only the parts of state that differ from previous (recursing into dicts)."""
+	delta = {}
+	for key, value in state.items():
+		if key not in previous:
+			delta[key] = value
+		elif value != previous[key]:
+			if isinstance(value, dict) and isinstance(previous[key], dict):
+				delta[key] = delta_encode(value, previous[key]) or value
+			else:
+				delta[key] = value
+	return delta
+
+
+def delta_merge(state, delta):
+	"""Apply a delta (from delta_encode) onto state, in place. Returns state."""
+	for key, value in delta.items():
+		if isinstance(value, dict) and isinstance(state.get(key), dict):
+			delta_merge(state[key], value)
+		else:
+			state[key] = value
+	return state
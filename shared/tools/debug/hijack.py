@@ -120,7 +120,7 @@ class DefSysHijack(object):
 
 
 	def setprofile(self, profilefunc=None):
-		self._thread_sys.setprofile(None)
+		self._thread_sys.setprofile(profilefunc)
 
 
 	# Context management
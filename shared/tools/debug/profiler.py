@@ -0,0 +1,291 @@
+"""
+	Sampling profiler
+
+	Where the Tracer follows every event in a thread, the Profiler just
+	  looks over a thread's shoulder every so often and notes where it is.
+	  Nothing is installed in the target thread, so it runs at full speed,
+	  making this safe to point at a busy gateway thread in production.
+
+	Each sample walks the target's Python stack (via its ThreadState) and
+	  counts it. Functions on top of the stack get "self" samples, and every
+	  function on the stack gets a "total" sample. Times are estimated from
+	  the share of samples, so the longer it runs the better the picture.
+
+	Collapsed stacks (one `root;caller;callee count` line per unique stack)
+	  can be fed straight into flamegraph.pl or speedscope.
+
+		>>> from shared.tools.debug.profiler import Profiler
+		>>> profiler = Profiler.attach('gateway-scheduled-.*MyScript', interval=0.005)
+		>>> # ... wait for it ...
+		>>> profiler.stop()
+		>>> print profiler.report(10)
+		>>> collapsed = profiler.collapsed()
+"""
+
+from shared.tools.thread import getThreadState, findThreads, async, Thread
+from shared.tools.debug.frame import iter_frames, normalize_filename
+
+from time import sleep, time
+
+
+__copyright__ = """Copyright (C) 2020 Corso Systems"""
+__license__ = 'Apache 2.0'
+__maintainer__ = 'Andrew Geiger'
+__email__ = 'andrew.geiger@corsosystems.com'
+
+
+__all__ = ['Profiler', 'profile_thread']
+
+
+def frame_label(frame):
+	"""The function's identity as it appears in reports and collapsed stacks."""
+	code = frame.f_code
+	return '%s (%s:%d)' % (code.co_name, normalize_filename(code.co_filename), code.co_firstlineno)
+
+
+class Profiler(object):
+	"""
+	Samples the Python stack of another thread at a fixed rate.
+
+	Samples are aggregated as they're taken, so memory grows with the number
+	  of unique stacks seen, not the number of samples.
+	"""
+	__slots__ = ('thread', 'interval', 'max_depth',
+				 'samples', 'idle_samples', 'missed_samples',
+				 'stacks', 'self_counts', 'total_counts',
+				 'started', 'stopped',
+				 '_thread_state', '_running', '_sampler_thread',
+				)
+
+	SAMPLE_INTERVAL = 0.010 # seconds
+	MAX_STACK_DEPTH = 256   # frames kept, counting from the root
+
+	def __init__(self, thread, interval=None, max_depth=None):
+		if isinstance(thread, (str, unicode)):
+			thread = self._find_thread(thread)
+		self.thread = thread
+		self.interval = interval or self.SAMPLE_INTERVAL
+		self.max_depth = max_depth or self.MAX_STACK_DEPTH
+
+		self._thread_state = None
+		self._running = False
+		self._sampler_thread = None
+
+		self.reset()
+
+
+	@classmethod
+	def attach(cls, thread, interval=None, max_depth=None):
+		"""Create a profiler for the thread (or thread name pattern) and start sampling."""
+		profiler = cls(thread, interval, max_depth)
+		profiler.start()
+		return profiler
+
+
+	@staticmethod
+	def _find_thread(thread_name_pattern):
+		threads = findThreads(thread_name_pattern, recursive=True)
+		if not threads:
+			raise ValueError('No thread found matching %r' % thread_name_pattern)
+		if len(threads) > 1:
+			raise ValueError('Thread pattern %r is ambiguous - it matches %s' % (
+				thread_name_pattern, ', '.join(repr(thread.getName()) for thread in threads)))
+		return threads[0]
+
+
+	def reset(self):
+		"""Forget all samples taken so far."""
+		self.samples = 0
+		self.idle_samples = 0
+		self.missed_samples = 0
+		self.stacks = {}
+		self.self_counts = {}
+		self.total_counts = {}
+		self.started = None
+		self.stopped = None
+
+
+	#==========================================================================
+	# Sampling
+	#==========================================================================
+
+	@property
+	def running(self):
+		return self._running
+
+
+	def start(self):
+		"""Start sampling in a background thread."""
+		if self._running:
+			return
+		if Thread.currentThread() is self.thread:
+			raise RuntimeError('A thread can not profile itself.')
+
+		self._running = True
+		self.started = time()
+		self.stopped = None
+
+		@async(name='Profiler-%s' % self.thread.getName())
+		def sampler(self=self):
+			try:
+				next_sample = time()
+				while self._running and self.thread.isAlive():
+					self.sample()
+
+					next_sample += self.interval
+					delay = next_sample - time()
+					if delay > 0:
+						sleep(delay)
+					else:
+						# Fell behind - skip the missed beats rather than burst to catch up
+						self.missed_samples += int(-delay / self.interval) + 1
+						next_sample = time()
+			finally:
+				self._running = False
+				if self.stopped is None:
+					self.stopped = time()
+
+		self._sampler_thread = sampler()
+
+
+	def stop(self):
+		"""Stop sampling. Samples taken so far are kept."""
+		self._running = False
+		if self.stopped is None and self.started is not None:
+			self.stopped = time()
+		if self._sampler_thread and self._sampler_thread is not Thread.currentThread():
+			self._sampler_thread.join(long(self.interval * 1000 * 10) + 1)
+
+
+	def _current_frame(self):
+		# The thread state is stable for the life of the thread, so only reflect for it once
+		if self._thread_state is None:
+			self._thread_state = getThreadState(self.thread)
+			if self._thread_state is None:
+				return None
+		return self._thread_state.frame
+
+
+	def sample(self):
+		"""
+		Take one sample of the target thread's stack.
+		Returns the stack (root first, as labels) or None if it was not running Python.
+		"""
+		frame = self._current_frame()
+		self.samples += 1
+		if frame is None:
+			self.idle_samples += 1
+			return None
+
+		stack = [frame_label(each) for each in iter_frames(frame)]
+		stack.reverse()
+		stack = tuple(stack[:self.max_depth])
+
+		self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+		leaf = stack[-1]
+		self.self_counts[leaf] = self.self_counts.get(leaf, 0) + 1
+
+		# Recursion shouldn't count a function more than once per sample
+		seen = set()
+		for label in stack:
+			if label in seen:
+				continue
+			seen.add(label)
+			self.total_counts[label] = self.total_counts.get(label, 0) + 1
+
+		return stack
+
+
+	#==========================================================================
+	# Results
+	#==========================================================================
+
+	@property
+	def duration(self):
+		"""Seconds spent sampling."""
+		if self.started is None:
+			return 0.0
+		return (self.stopped or time()) - self.started
+
+	@property
+	def seconds_per_sample(self):
+		"""Estimated wall time each sample represents."""
+		if not self.samples:
+			return self.interval
+		return self.duration / self.samples
+
+
+	def function_stats(self):
+		"""
+		Per-function results, hottest (by self time) first.
+
+		Each is a dict of function, self/total sample counts, estimated
+		  self/total seconds, and the self/total share of all active samples.
+		"""
+		per_sample = self.seconds_per_sample
+		active = (self.samples - self.idle_samples) or 1
+
+		stats = []
+		for label, total in self.total_counts.items():
+			own = self.self_counts.get(label, 0)
+			stats.append({
+				'function': label,
+				'self_samples': own,
+				'total_samples': total,
+				'self_time': own * per_sample,
+				'total_time': total * per_sample,
+				'self_percent': 100.0 * own / active,
+				'total_percent': 100.0 * total / active,
+			})
+		stats.sort(key=lambda entry: (entry['self_samples'], entry['total_samples']), reverse=True)
+		return stats
+
+
+	def collapsed(self):
+		"""Collapsed stack output (Brendan Gregg's format), ready for flame graph tools."""
+		lines = []
+		for stack, count in sorted(self.stacks.items()):
+			# Semicolons delimit frames, so they can't appear in a label
+			lines.append('%s %d' % (';'.join(label.replace(';', ':') for label in stack), count))
+		return '\n'.join(lines)
+
+
+	def report(self, limit=20):
+		"""A plain text table of the hottest functions."""
+		lines = ['Profiled %r for %0.3fs: %d samples (%d idle, %d missed) every %0.1fms' % (
+					self.thread.getName(), self.duration, self.samples,
+					self.idle_samples, self.missed_samples, self.interval * 1000),
+				 '%8s %8s %10s %10s  %s' % ('self%', 'total%', 'self(s)', 'total(s)', 'function'),
+				]
+		for entry in self.function_stats()[:limit]:
+			lines.append('%8.2f %8.2f %10.4f %10.4f  %s' % (
+				entry['self_percent'], entry['total_percent'],
+				entry['self_time'], entry['total_time'],
+				entry['function']))
+		return '\n'.join(lines)
+
+
+	# Context management
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.stop()
+
+
+	def __repr__(self):
+		return '<Profiler of %r: %d samples%s>' % (
+			self.thread.getName(), self.samples, ' (running)' if self._running else '')
+
+
+def profile_thread(thread, seconds=10.0, interval=None):
+	"""Profile the thread (or thread name pattern) for a while and return the profiler."""
+	profiler = Profiler.attach(thread, interval)
+	try:
+		sleep(seconds)
+	finally:
+		profiler.stop()
+	return profiler
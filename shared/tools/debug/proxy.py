@@ -7,12 +7,16 @@
 	  inconvenient.
 
 	The streams are also buffered, allowing us to review the I/O after the fact.
+	  Only the last so many lines are kept, so a chatty thread won't eat memory.
 """
 
+from shared.tools.timing import now
+
 from StringIO import StringIO
 from collections import deque
-from time import sleep
+from time import sleep, time
 from datetime import datetime
+from threading import Condition
 
 try:
 	from shared.tools.compat import next
@@ -26,6 +30,184 @@ __maintainer__ = 'Andrew Geiger'
 __email__ = 'andrew.geiger@corsosystems.com'
 
 
+class LineHistory(object):
+	"""A fixed size ring of (epoch milliseconds, line) records.
+
+	Once full, the oldest lines are overwritten. Indexing and slicing work
+	  like a list of the lines kept, with the timestamp formatted in only
+	  when a line is actually read: '[2020-01-01 12:34:56.789000] line'
+
+	Only one thread should append (the one writing to the stream), but any
+	  number may read. Nothing is locked, so a reader racing the writer may
+	  see a line that has just been overwritten - never an error.
+
+	Every line gets a sequence number (its count since the start), so
+	  readers can follow along: read_since() picks up where the last read
+	  left off, wait_for() blocks until there's something new, and 
+	  follow() puts both together as a generator. The writer only takes 
+	  a lock when someone is actually waiting.
+	"""
+	__slots__ = ('capacity', '_records', '_count', '_waiting', '_condition')
+
+	def __init__(self, capacity):
+		self.capacity = capacity
+		self._records = [None] * capacity
+		self._count = 0 # total ever appended
+		self._waiting = 0
+		self._condition = Condition()
+
+
+	def append(self, line, timestamp=None):
+		self._records[self._count % self.capacity] = (timestamp or now(), line)
+		self._count += 1
+		if self._waiting:
+			self._notify()
+
+	def extend(self, lines, timestamp=None):
+		timestamp = timestamp or now()
+		for line in lines:
+			self._records[self._count % self.capacity] = (timestamp, line)
+			self._count += 1
+		if self._waiting:
+			self._notify()
+
+	def _notify(self):
+		self._condition.acquire()
+		try:
+			self._condition.notifyAll()
+		finally:
+			self._condition.release()
+
+
+	#==========================================================================
+	# Following along
+	#==========================================================================
+
+	@property
+	def next_sequence(self):
+		"""The sequence number the next line will get."""
+		return self._count
+
+	@property
+	def first_sequence(self):
+		"""The sequence number of the oldest line still kept."""
+		return max(0, self._count - self.capacity)
+
+
+	def read_since(self, sequence=0, limit=None, formatted=True):
+		"""
+		Get the lines from sequence number on, as (lines, next_sequence, skipped).
+
+		Pass next_sequence back in to get just what's new next time.
+		  Skipped counts the lines that were overwritten before they could
+		  be read. If limit is given, at most that many (the oldest) are 
+		  returned - the rest come with the next read.
+		Negative sequence numbers count back from the end, like an index.
+		"""
+		count = self._count
+		first = max(0, count - self.capacity)
+
+		if sequence < 0:
+			sequence = max(0, count + sequence)
+
+		skipped = 0
+		if sequence < first:
+			skipped = first - sequence
+			sequence = first
+
+		stop = count
+		if limit is not None:
+			stop = min(count, sequence + limit)
+
+		records = [self._records[ix % self.capacity] for ix in xrange(sequence, stop)]
+		if formatted:
+			records = [self.format_record(record) for record in records]
+		return records, max(stop, sequence), skipped
+
+
+	def wait_for(self, sequence, timeout=None):
+		"""Block until there's a line at or past the sequence number (or timeout passes).
+		Returns True if there's something to read."""
+		if self._count > sequence:
+			return True
+
+		if timeout is not None:
+			deadline = time() + timeout
+
+		self._condition.acquire()
+		self._waiting += 1
+		try:
+			while self._count <= sequence:
+				if timeout is None:
+					self._condition.wait()
+				else:
+					remaining = deadline - time()
+					if remaining <= 0:
+						return False
+					self._condition.wait(remaining)
+			return True
+		finally:
+			self._waiting -= 1
+			self._condition.release()
+
+
+	def follow(self, sequence=None, idle_timeout=None, formatted=True):
+		"""
+		Yield lines as they're written, starting at the sequence number
+		  (or with the next new line, if not given). Like `tail -f`.
+
+		Stops once nothing new is written for idle_timeout seconds, 
+		  or runs until the consumer stops iterating if no timeout is given.
+		"""
+		if sequence is None:
+			sequence = self._count
+		while True:
+			if not self.wait_for(sequence, idle_timeout):
+				return
+			lines, sequence, _ = self.read_since(sequence, formatted=formatted)
+			for line in lines:
+				yield line
+
+
+	@staticmethod
+	def format_record(record):
+		timestamp, line = record
+		return '[%s] %s' % (datetime.fromtimestamp(timestamp / 1000.0), line)
+
+	@property
+	def records(self):
+		"""The (epoch milliseconds, line) records kept, oldest first."""
+		count = self._count
+		start = max(0, count - self.capacity)
+		return [self._records[ix % self.capacity] for ix in xrange(start, count)]
+
+
+	def __len__(self):
+		return min(self._count, self.capacity)
+
+	def __getitem__(self, index):
+		count = self._count
+		retained = min(count, self.capacity)
+		first = count - retained
+
+		if isinstance(index, slice):
+			return [self.format_record(self._records[(first + ix) % self.capacity])
+					for ix in xrange(*index.indices(retained))]
+
+		if index < 0:
+			index += retained
+		if not 0 <= index < retained:
+			raise IndexError('history index out of range')
+		return self.format_record(self._records[(first + index) % self.capacity])
+
+	def __iter__(self):
+		for ix in xrange(len(self)):
+			yield self[ix]
+
+	def __repr__(self):
+		return '<LineHistory %d of %d lines>' % (len(self), self.capacity)
+
+
 class StreamBuffer(object):
 	__slots__ = ('history', 
 				 '_target_io',
@@ -33,12 +215,15 @@ class StreamBuffer(object):
 				 '_buffer_line',
 				 '__weakref__',
 				)
+	# Lines kept in the history
 	_MAX_HISTORY = 10000
+	# A partial line longer than this is logged as-is, rather than waiting on a newline
 	_BUFFER_CHUNK = 1000
 
 	def __init__(self, target_io, parent_proxy=None):
 		self._buffer_line = ''
-		self.history = ['[%s] %s' % (str(datetime.now()), '#! Starting log...')]
+		self.history = LineHistory(self._MAX_HISTORY)
+		self.history.append('#! Starting log...')
 		
 		# Failsafe to drill past repeated inits
 		while isinstance(target_io, StreamBuffer):
@@ -57,25 +242,30 @@ class StreamBuffer(object):
 
 	def write(self, string):
 		self._target_io.write(string)
+
+		# Most writes are partial lines (print writes the newline separately)
+		if not '\n' in string:
+			buffer = self._buffer_line + string
+			if len(buffer) > self._BUFFER_CHUNK:
+				self.history.append(buffer)
+				buffer = ''
+			self._buffer_line = buffer
+			return
 		
-		buffer = self._buffer_line + string
-		timestamp = str(datetime.now())
-		ix = 0
-		while '\n' in buffer:
-			line, _, buffer = buffer.partition('\n')
-			self.history.append('[%s] %s' % (timestamp, line))
-		self._buffer_line = buffer
+		lines = (self._buffer_line + string).split('\n')
+		self._buffer_line = lines.pop()
+		self.history.extend(lines)
 		
 
 	def writelines(self, iterable):
-		self._target_io.writelines(iterable)
-		
-		timestamp = str(datetime.now())
-		for ix, line in enumerate(iterable):
-			if ix == 0:
-				line = self._buffer_line + line
-				self._buffer_line = ''
-			self.history.append('[%s %d] %s' % (timestamp, ix, line))
+		# Iterate once, in case it's a generator
+		lines = list(iterable)
+		self._target_io.writelines(lines)
+
+		if lines:
+			lines[0] = self._buffer_line + lines[0]
+			self._buffer_line = ''
+		self.history.extend(lines)
 
 
 	def __getattr__(self, attribute):
@@ -133,6 +323,26 @@ class ProxyIO(object):
 		return self.stderr.history[-1]
 
 
+	_STREAMS = ('stdin', 'stdout', 'stderr')
+
+	def _history(self, stream):
+		if not stream in self._STREAMS:
+			raise ValueError('Stream must be one of %r, not %r' % (self._STREAMS, stream))
+		return getattr(self, stream).history
+
+	def read_since(self, stream='stdout', sequence=0, limit=None):
+		"""New lines on the stream as (lines, next_sequence, skipped). See LineHistory.read_since."""
+		return self._history(stream).read_since(sequence, limit)
+
+	def wait_for(self, stream='stdout', sequence=0, timeout=None):
+		"""Block until the stream has a line at or past sequence. See LineHistory.wait_for."""
+		return self._history(stream).wait_for(sequence, timeout)
+
+	def follow(self, stream='stdout', sequence=None, idle_timeout=None):
+		"""Yield the stream's lines as they're written. See LineHistory.follow."""
+		return self._history(stream).follow(sequence, idle_timeout)
+
+
 	@property
 	def stdin(self):
 		return self._stdin
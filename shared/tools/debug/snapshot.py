@@ -7,11 +7,32 @@
 	  not actively deepcopying for speed) may mutate as execution progresses.
 	  Moreover, Java objects are not subject to deepcopy, meaning that their 
 	  references are merely passed along and saved. And so be forewarned.
+
+	To keep recording cheap, a snapshot can be given the previous snapshot of
+	  the same frame. Any local that is still the same object with the same
+	  shallow signature is shared with that previous snapshot instead of being
+	  cloned again. Only new or changed locals get deepcopied. Note that this
+	  check is shallow: a mutation deep inside a nested structure that leaves
+	  the top level untouched will not be seen, and the older clone is reused.
+	  Large containers are only sampled, so replacing an item in the middle of
+	  one may go unseen as well.
+
+	Snapshots do not hold on to the live locals they cloned - only their ids
+	  and signatures - so the buffer doesn't keep big objects alive.
+	  (Jython never reuses an id. On CPython an id can be reused once its object
+	  is freed, but the type and shallow signature must then match as well.)
+
+	The ContextBuffer holds the history. It is a fixed capacity ring that also
+	  keeps a rough tally of how many bytes the cloned locals take up, evicting
+	  the oldest snapshots once either limit is reached. A clone shared by 
+	  several snapshots is counted once, for as long as any of them is held.
 """
 
 from copy import deepcopy
+from itertools import islice
 
 from shared.tools.debug.frame import iter_frames
+from shared.tools.sizing import estimate_size
 
 
 __copyright__ = """Copyright (C) 2020 Corso Systems"""
@@ -20,20 +41,76 @@ __maintainer__ = 'Andrew Geiger'
 __email__ = 'andrew.geiger@corsosystems.com'
 
 
+# Types whose hash is derived from their value (and so can not mutate unseen)
+VALUE_HASHED_TYPES = (bool, int, long, float, complex, str, unicode, type(None), frozenset)
+
+# Containers bigger than this are sampled for their signature, not walked
+SIGNATURE_SAMPLE = 32
+
+def _sampled_ids(items, count):
+	"""Identities of the items - all of them if there are few, otherwise an even sample."""
+	if count <= SIGNATURE_SAMPLE:
+		return tuple(id(item) for item in items)
+	if isinstance(items, (list, tuple)):
+		return tuple(id(item) for item in items[::count // SIGNATURE_SAMPLE])
+	return tuple(id(item) for item in islice(items, SIGNATURE_SAMPLE))
+
+def shallow_signature(value):
+	"""A cheap fingerprint of a value's top level, used to tell if it changed.
+
+	Immutable values use their hash. Common mutable containers and plain
+	  instances are summarized by the identities of what they hold, so
+	  appending to a list or rebinding an attribute changes the signature.
+	  (Past SIGNATURE_SAMPLE items, only a sample of them is used.)
+	  Anything else returns None, meaning the value can not be verified
+	  as unchanged and must be cloned again.
+	"""
+	if isinstance(value, VALUE_HASHED_TYPES):
+		return (type(value), hash(value))
+	if isinstance(value, dict):
+		count = len(value)
+		return (dict, count, _sampled_ids(value.iterkeys(), count), 
+							 _sampled_ids(value.itervalues(), count))
+	if isinstance(value, (list, tuple)):
+		return (type(value), len(value), _sampled_ids(value, len(value)))
+	if isinstance(value, set):
+		return (set, len(value), _sampled_ids(iter(value), len(value)))
+
+	state = getattr(value, '__dict__', None)
+	if isinstance(state, dict):
+		count = len(state)
+		return (type(value), count, _sampled_ids(state.iterkeys(), count),
+									_sampled_ids(state.itervalues(), count))
+	return None
+
+
+# Rough figure for what a snapshot costs besides its clones (in bytes)
+SNAPSHOT_OVERHEAD = 256
+# Clones are sized only this many levels deep, to keep recording cheap
+CLONE_SIZE_DEPTH = 3
+
+
 class Snapshot(object):
 	
 	__slots__ = ('_event', '_arg', '_frame', '_code',
 				 '_filename', '_line', '_caller', '_depth',
 				 '_locals_key', '_locals_dup', '_locals_ref', '_locals_err', 
-				 '_cloned', 
+				 '_locals_src', '_locals_size',
+				 '_cloned', '_shared', '_size',
 				 '__weakref__',)
 	
 	_repr_markers = {'line': '|',  'call': '+',   'return': '/',   'exception': 'X',
 							     'c_call': '+', 'c_return': '/', 'c_exception': 'X', 
 					 'init': '#'}
 
-	def __init__(self, frame, event, arg, clone=True):
-		
+	def __init__(self, frame, event, arg, clone=True, previous=None):
+		"""Capture the frame's state. If previous is a cloned snapshot of this
+		  same frame, then unchanged locals are shared with it instead of cloned.
+
+		The previous snapshot also lets the depth be worked out incrementally
+		  if it was of this frame, its caller, or one it called. Otherwise the 
+		  depth is only counted (by walking the stack) when it's first needed.
+		"""
 
 		self._event    = event
 		self._arg      = arg
@@ -43,29 +120,73 @@ class Snapshot(object):
 		self._filename = frame.f_code.co_filename
 		self._line     = frame.f_lineno
 		self._caller   = frame.f_code.co_name
-		self._depth    = len(list(iter_frames(frame)))
+		self._depth    = None
+
+		if previous is not None and previous._depth is not None:
+			if previous._frame is frame:
+				self._depth = previous._depth
+			elif previous._frame is frame.f_back:
+				self._depth = previous._depth + 1
+			elif previous._frame.f_back is frame:
+				self._depth = previous._depth - 1
 
 		local_key = set()
 		local_dup = {}
 		local_ref = {}
 		local_err = {}
+		local_src = {}
+		local_size = {}
+		shared = 0
+		size = SNAPSHOT_OVERHEAD
 
 		if clone:
+			# only share with a snapshot that cloned the very same frame
+			if previous is not None and previous._cloned and previous._frame is frame:
+				previous_src = previous._locals_src
+			else:
+				previous_src = {}
+
 			# attempt to make a deepcopy of each item,
 			# note that Java and complex objects will fail deepcopy
 			#   and instead will be saved by reference only
 			for key,value in frame.f_locals.items():
+				# references are just that, so no need to try (and fail) again
+				if key in previous_src and previous._locals_ref.get(key) is value:
+					local_ref[key] = value
+					local_err[key] = previous._locals_err[key]
+					local_src[key] = previous_src[key]
+					shared += 1
+					continue
+
+				# Only the id and signature are kept, not the value itself
+				signature = shallow_signature(value)
+				local_src[key] = (id(value), signature)
+
+				# reuse the previous clone if the local is (shallowly) unchanged
+				if (signature is not None and previous_src.get(key) == local_src[key]
+					and key in previous._locals_dup):
+					local_dup[key] = previous._locals_dup[key]
+					local_size[key] = previous._locals_size[key]
+					shared += 1
+					continue
+
 				try:
 					local_dup[key] = deepcopy(value)
+					local_size[key] = estimate_size(local_dup[key], max_depth=CLONE_SIZE_DEPTH)
+					size += local_size[key]
 				except Exception, err:
 					local_ref[key] = value
 					local_err[key] = err
 		self._cloned = clone
+		self._shared = shared
+		self._size = size
 		
 		self._locals_key = local_key
 		self._locals_dup = local_dup
 		self._locals_ref = local_ref
 		self._locals_err = local_err
+		self._locals_src = local_src
+		self._locals_size = local_size
 
 
 	@property
@@ -88,6 +209,8 @@ class Snapshot(object):
 		return self._caller
 	@property
 	def depth(self):
+		if self._depth is None:
+			self._depth = len(list(iter_frames(self._frame)))
 		return self._depth
 	@property
 	def code(self):
@@ -97,6 +220,18 @@ class Snapshot(object):
 	def cloned(self):
 		return self._cloned
 	@property
+	def size(self):
+		"""Approximate bytes held by this snapshot's own (unshared) clones."""
+		return self._size
+
+	def clone_sizes(self):
+		"""Each clone this snapshot holds (shared or not) as (id, approximate bytes)."""
+		return [(id(self._locals_dup[key]), size) for key, size in self._locals_size.items()]
+	@property
+	def shared(self):
+		"""Number of locals reused from the previous snapshot instead of cloned."""
+		return self._shared
+	@property
 	def locals(self):
 		return dict(self._locals_ref.items() + self._locals_dup.items())
 	@property
@@ -145,3 +280,136 @@ class Snapshot(object):
 		tree_marker[len(tree_marker) % (self.depth)] = self._repr_markers.get(self.event, '*')
 		return '<Snapshot [%s%2d:%6s] %4d of %s at %s>' % (''.join(tree_marker),
 			self.depth, self.event.capitalize()[:6], self.line, self.filename, self.caller)
+
+
+
+class ContextBuffer(object):
+	"""A fixed capacity ring of snapshots, with the most recent at index 0.
+
+	Acts enough like the deque it replaces: appendleft adds the newest,
+	  pop removes the oldest, and indexing counts back into the past.
+	  Both adding and evicting are O(1).
+
+	Besides the count limit, an approximate byte budget is enforced using
+	  each snapshot's estimated size. Once over budget, the oldest snapshots
+	  are evicted until it fits again (though the newest is always kept).
+	  Clones shared between snapshots are counted once, and only stop counting
+	  once the last snapshot holding them is evicted.
+	"""
+	__slots__ = ('_ring', '_head', '_length', '_clones',
+				 'capacity', 'byte_budget', 'bytes', 
+				 'filled', 'evicted',
+				 '__weakref__',)
+
+	def __init__(self, capacity=1000, byte_budget=None):
+		assert capacity > 0, "Context buffers need room for at least one snapshot."
+		self.capacity = capacity
+		self.byte_budget = byte_budget
+		self._ring = [None] * capacity
+		self._head = 0 # index of the most recent entry
+		self._length = 0
+		self._clones = {} # id of clone -> [bytes, snapshots holding it]
+		self.bytes = 0
+		self.filled = 0
+		self.evicted = 0
+
+
+	def appendleft(self, snapshot):
+		"""Add the most recent snapshot, evicting old ones as needed to fit."""
+		if self._length == self.capacity:
+			self.pop()
+
+		self._head = (self._head - 1) % self.capacity
+		self._ring[self._head] = snapshot
+		self._length += 1
+		self.bytes += self._charge(snapshot)
+		self.filled += 1
+
+		if self.byte_budget:
+			while self.bytes > self.byte_budget and self._length > 1:
+				self.pop()
+
+
+	def pop(self):
+		"""Remove and return the oldest snapshot."""
+		if not self._length:
+			raise IndexError("pop from an empty context buffer")
+		tail = (self._head + self._length - 1) % self.capacity
+		snapshot = self._ring[tail]
+		self._ring[tail] = None
+		self._length -= 1
+		self.bytes -= self._release(snapshot)
+		self.evicted += 1
+		return snapshot
+
+
+	def clear(self):
+		self._ring = [None] * self.capacity
+		self._head = 0
+		self._length = 0
+		self._clones = {}
+		self.bytes = 0
+		self.filled = 0
+		self.evicted = 0
+
+
+	def _charge(self, snapshot):
+		"""Bytes the snapshot adds to the buffer: its overhead, plus clones not already held."""
+		if not hasattr(snapshot, 'clone_sizes'):
+			return getattr(snapshot, 'size', SNAPSHOT_OVERHEAD)
+		added = SNAPSHOT_OVERHEAD
+		for clone_id, size in snapshot.clone_sizes():
+			held = self._clones.get(clone_id)
+			if held:
+				held[1] += 1
+			else:
+				self._clones[clone_id] = [size, 1]
+				added += size
+		return added
+
+	def _release(self, snapshot):
+		"""Bytes freed by dropping the snapshot: its overhead, plus clones no one else holds."""
+		if not hasattr(snapshot, 'clone_sizes'):
+			return getattr(snapshot, 'size', SNAPSHOT_OVERHEAD)
+		freed = SNAPSHOT_OVERHEAD
+		for clone_id, size in snapshot.clone_sizes():
+			held = self._clones.get(clone_id)
+			if not held:
+				continue
+			held[1] -= 1
+			if not held[1]:
+				del self._clones[clone_id]
+				freed += held[0]
+		return freed
+
+
+	@property
+	def stats(self):
+		return {
+			'length': self._length,
+			'capacity': self.capacity,
+			'bytes': self.bytes,
+			'byte_budget': self.byte_budget,
+			'filled': self.filled,
+			'evicted': self.evicted,
+		}
+
+
+	def __len__(self):
+		return self._length
+
+	def __getitem__(self, index):
+		if index < 0:
+			index += self._length
+		if not 0 <= index < self._length:
+			raise IndexError("context buffer index out of range")
+		return self._ring[(self._head + index) % self.capacity]
+
+	def __iter__(self):
+		"""Iterate from the most recent snapshot into the past."""
+		for index in range(self._length):
+			yield self._ring[(self._head + index) % self.capacity]
+
+	def __repr__(self):
+		return '<ContextBuffer %d of %d (%d of %s bytes)>' % (
+			self._length, self.capacity, self.bytes, self.byte_budget or 'unlimited')
@@ -18,12 +18,14 @@ from shared.tools.debug.frame import iter_frames, normalize_filename
 from shared.tools.debug.breakpoint import Breakpoint
 
 from shared.tools.debug.codecache import CodeCache, trace_entry_line
-from shared.tools.debug.snapshot import Snapshot
+from shared.tools.debug.snapshot import Snapshot, ContextBuffer
+from shared.tools.debug.channel import CommandChannel
+from shared.tools.debug.delta import delta_encode, delta_merge
 
 from shared.tools.debug.trap import TransientTrap, Step, Next, Until, Return
 
 from ast import literal_eval
-from time import sleep
+from time import sleep, time
 from collections import deque 
 from datetime import datetime, timedelta
 import textwrap, math, re
@@ -336,15 +338,11 @@ class MetaTracer(type):
 		if message_type == MessageTypes.LISTING:
 			return ExtraGlobal.keys(scope=ExtraGlobalScopes.REMOTE_INFO)
 
-		# Reply to a tracer's request for commands (if any have been buffered)
+		# Reply to a tracer's request for commands with whatever is buffered.
+		#   This never waits - it would tie up a message handler thread - 
+		#   since the tracer simply asks again shortly if it got nothing.
 		if message_type == MessageTypes.INPUT:
-			commands = ExtraGlobal.get(label=tracer_id, 
-									   scope=ExtraGlobalScopes.REMOTE_COMMANDS, 
-									   default=[])
-			if commands:
-				ExtraGlobal.trash(label=tracer_id, 
-								  scope=ExtraGlobalScopes.REMOTE_COMMANDS)
-			return commands
+			return [each.command for each in cls._remote_channel(tracer_id).drain()]
 
 		# Enqueue a command sent to the hub
 		if message_type == MessageTypes.COMMAND:
@@ -357,6 +355,27 @@ class MetaTracer(type):
 		if message_type == MessageTypes.STATE_UPDATE:
 			def heartbeat_check(cls=cls, tracer_id=tracer_id):
 				cls._check_heartbeat(tracer_id)
+
+			# While the tracer reports in, keep its command channel from lapsing
+			cls._remote_channel(tracer_id)
+
+			# Updates are usually just what changed, so merge onto what's known
+			state = ExtraGlobal.get(label=tracer_id,
+									scope=ExtraGlobalScopes.REMOTE_INFO,
+									default=None)
+			# A delta only applies on top of the update right before it.
+			#   Without that (expired, or a message went missing) ask for a full state instead.
+			if payload.get('delta'):
+				if not state or payload.get('sequence') != state.get('sequence', 0) + 1:
+					cls._request_resync(tracer_id)
+					return
+			dropped_total = payload.get('dropped', 0)
+			if state:
+				dropped_total += state.get('dropped_total', 0)
+				if payload.get('delta'):
+					payload = delta_merge(state, payload)
+			payload['dropped_total'] = dropped_total
+
 			ExtraGlobal.stash(payload,
 							  label=tracer_id, 
 							  scope=ExtraGlobalScopes.REMOTE_INFO,
@@ -378,43 +397,67 @@ class MetaTracer(type):
 	def _check_heartbeat(cls, tracer_id):
 		#system.util.getLogger('Tracer %s' % (tracer_id,)).trace('Heartbeat check...')
 
-		pending_commands = ExtraGlobal.get(label=tracer_id, 
-									   scope=ExtraGlobalScopes.REMOTE_COMMANDS, 
-									   default=[])
-		if isinstance(pending_commands, (list, tuple)):
-			# Check if we've already tried to send the command and failed
-			if 'heartbeat' in pending_commands:
-				return
-		elif isinstance(pending_commands, (str, unicode)):
-			if 'heartbeat' == pending_commands:
-				return
+		# Check if we've already tried to send the command and failed
+		if cls._command_waiting(tracer_id, 'heartbeat'):
+			return
 		
 		#system.util.getLogger('Tracer %s' % (tracer_id,)).trace('Heartbeat extending')
 
 		cls._queue_command(tracer_id, 'heartbeat')
 		ExtraGlobal.extend(label=tracer_id, 
 						   scope=ExtraGlobalScopes.REMOTE_INFO,
-						   additional_time=self._MESSAGE_CALLBACK_TIMEOUT)
+						   additional_time=cls._MESSAGE_CALLBACK_TIMEOUT)
+
+
+	def _request_resync(cls, tracer_id):
+		"""Ask the tracer for its full state, since a delta could not be applied."""
+		# Only ask once until the tracer picks it up
+		if cls._command_waiting(tracer_id, 'resync'):
+			return
+		cls._queue_command(tracer_id, 'resync')
+
+
+	def _command_waiting(cls, tracer_id, command):
+		"""True if the command is already queued for the tracer (wherever _queue_command put it)."""
+		tracer = ExtraGlobal.get(label=tracer_id, 
+								 scope=ExtraGlobalScopes.INSTANCES,
+								 default=None)
+		if tracer is not None:
+			return command in tracer._pending_commands
+		return command in cls._remote_channel(tracer_id)
+
+
+	def _remote_channel(cls, tracer_id):
+		"""The hub's buffer of commands waiting for the tracer to ask for them.
+
+		Each use renews its lifespan, and the tracer's state updates and heartbeats
+		  use it, so it only lapses once the tracer stops reporting in.
+		"""
+		channel = ExtraGlobal.get(tracer_id, 
+								  scope=ExtraGlobalScopes.REMOTE_COMMANDS, 
+								  default=None)
+		if channel is None:
+			channel = ExtraGlobal.setdefault(tracer_id, 
+											 scope=ExtraGlobalScopes.REMOTE_COMMANDS, 
+											 default=CommandChannel(),
+											 lifespan=cls.REMOTE_CHANNEL_LIFESPAN)
+		return channel
 
 
 	def _queue_command(cls, tracer_id, command):
-		"""Enqueue a command onto the local ExtraGlobal remote control list"""
-		commands = ExtraGlobal.get(label=tracer_id, 
-								   scope=ExtraGlobalScopes.REMOTE_COMMANDS, 
-								   default=[])
-		if not commands:
-			commands = command
-		if isinstance(commands, (list, tuple)):
-			if isinstance(command, (list, tuple)):
-				commands += command
-			else:
-				commands.append(command)
-		elif isinstance(commands, (str, unicode)):
-			commands = command
+		"""
+		Enqueue a command (or list of commands) for the tracer.
 
-		ExtraGlobal.stash(commands,
-						  label=tracer_id, 
-						  scope=ExtraGlobalScopes.REMOTE_COMMANDS)
+		If the tracer lives in this JVM it gets the command directly. Otherwise 
+		  the command waits on the hub until the tracer asks for input.
+		Returns the PendingCommand handle(s).
+		"""
+		tracer = ExtraGlobal.get(label=tracer_id, 
+								 scope=ExtraGlobalScopes.INSTANCES,
+								 default=None)
+		if tracer is not None:
+			return tracer.submit(command)
+		return cls._remote_channel(tracer_id).put(command)
 
 
 #==========================================================================
@@ -456,6 +499,7 @@ class Tracer(object):
 				 '_pending_commands', 
 				 '_map_o_commands', '_logged_commands',
 				 '_current_context', 'recording', 'context_buffer',
+				 '_frame_snapshots',
 				 
 				 '_alias_commands', 
 				 'traps', 'active_traps', 
@@ -476,6 +520,9 @@ class Tracer(object):
 
 				 # Remote control handles
 				 '_remote_request_handle', '_remote_request_thread',
+				 '_update_pending', '_update_last_time', '_update_dropped',
+				 '_update_sequence', '_update_published', 
+				 '_commands_logged', '_commands_published',
 				 'tag_path', 'tag_acked',
 				 
 				 '__weakref__', # Allows the weakref mechanics to work on this slotted class.
@@ -491,8 +538,15 @@ class Tracer(object):
 	SCRAM_DEADMAN_SIGNAL = SCRAM_DEADMAN_SIGNAL
 	
 	CONTEXT_BUFFER_LIMIT = 1000
+	CONTEXT_BUFFER_BYTES = 64 * 1024 * 1024 # approximate, based on the cloned locals
+	# Share unchanged locals with the frame's previous snapshot instead of cloning them again
+	SHARED_SNAPSHOTS = True
+	# Do not trace into frames that can not possibly stop (see _frame_is_interesting)
+	FAST_SKIP = True
 	COMMAND_BUFFER_LIMIT = 1000
 	_UPDATE_CHECK_DELAY = 0.050 # seconds (leave relatively high since it should be driven by human input.)
+	# Longest the traced thread sleeps waiting for a command before checking its failsafe
+	COMMAND_WAIT_TIMEOUT = 1.00 # seconds
 	INTERDICTION_FAILSAFE = False # True
 	INTERDICTION_FAILSAFE_TIMEOUT = 30000 # milliseconds (seconds if failsafe disabled)
 		
@@ -513,6 +567,19 @@ class Tracer(object):
 	# Make sure the sendRequest is not called more often than a few times a second, 
 	#   or the client starts to log jam events a bit.
 	_MESSAGE_CALLBACK_TIMEOUT = 1.50 # seconds
+	# How often a waiting tracer asks the hub for commands. 
+	#   Remote commands are polled for: the hub can't wake a tracer in another JVM,
+	#   so they're picked up within this long (and each ask is a gateway request).
+	REMOTE_POLL_INTERVAL = 0.10 # seconds
+	# Commands wait on the hub for the tracer at most this long after it last reported in
+	REMOTE_CHANNEL_LIFESPAN = 300 # seconds
+
+	# State updates are coalesced and sent no more often than this (per second)
+	UPDATE_MAX_RATE = 4.0
+	# Send the full state, rather than just what changed, every so many updates
+	UPDATE_FULL_STATE_EVERY = 20
+	# Most logged commands carried in a single update
+	UPDATE_LOG_LIMIT = 20
 
 
 	#==========================================================================
@@ -546,6 +613,15 @@ class Tracer(object):
 		self._remote_request_handle = None
 		self._remote_request_thread = None
 
+		# Outbound state updates
+		self._update_pending = False
+		self._update_last_time = 0
+		self._update_dropped = 0
+		self._update_sequence = 0
+		self._update_published = None
+		self._commands_logged = 0
+		self._commands_published = 0
+
 		# Remote control via tag command line emulation
 		self._init_control_tag(control_tag)
 
@@ -565,15 +641,16 @@ class Tracer(object):
 			for attribute in dir(self)
 			if attribute.startswith('_command_'))
 		
-		self._pending_commands = []
+		self._pending_commands = CommandChannel()
 		self._logged_commands = deque()
 		self._cursor_context_index = 0
 		self._cursor_index = 0
 		self._cursor_stack = tuple()
 
 		self.recording = record
-		self.context_buffer = deque()
+		self.context_buffer = ContextBuffer(self.CONTEXT_BUFFER_LIMIT, self.CONTEXT_BUFFER_BYTES)
 		self._current_context = None
+		self._frame_snapshots = {}
 
 		self._alias_commands = {}
 		self.traps = set()
@@ -641,6 +718,7 @@ class Tracer(object):
 		self._debug.clear()
 		self._logged_commands = None
 		self.context_buffer = None
+		self._frame_snapshots = None
 		self._cursor_stack = None
 		# Finish shutdown
 		self.shutdown()
@@ -791,6 +869,10 @@ class Tracer(object):
 			system.tag.write(self.tag_path + '.enabled', False)
 		self.monitoring = False
 		self._cursor_stack = tuple()
+		self._frame_snapshots = {}
+		# Don't leave anything waiting on commands that will never run
+		for pending in self._pending_commands.drain():
+			pending.complete(TracerException('Tracer shut down before command %r ran' % pending.command))
 		try:
 			self._stack_uninstall()
 			self._abdicate_tracer(self.id)
@@ -857,14 +939,25 @@ class Tracer(object):
 	def current_context(self):
 		return self._current_context
 
+	@property
+	def cursor_stack(self):
+		"""The frames from the current context up, computed lazily once per event."""
+		if self._cursor_stack is None:
+			if self.monitoring and self._current_context:
+				self._cursor_stack = tuple(iter_frames(self._current_context.frame))
+			else:
+				self._cursor_stack = tuple()
+		return self._cursor_stack
+
 	@property 
 	def cursor_frame(self):
 		# Though technically the same, 
 		# we'll treat the very most present context directly instead of via buffer
 		if self._cursor_context_index == 0:
 			# Override to fail safe to local context (if we're not actively monitoring...)
-			if self._cursor_index < len(self._cursor_stack):
-				return self._cursor_stack[self._cursor_index]
+			cursor_stack = self.cursor_stack
+			if self._cursor_index < len(cursor_stack):
+				return cursor_stack[self._cursor_index]
 			else:
 				return self.sys._getframe()
 		else:
@@ -1017,21 +1110,26 @@ class Tracer(object):
 				
 		if _skip_frame(frame):
 			return None
+
+		# Returning None on call means no local trace at all for the new frame
+		if event == 'call' and self.FAST_SKIP and not self._frame_is_interesting(frame):
+			return None
 			
 		if self.step_speed:
 			sleep(self.step_speed) # DEBUG
 		
-		self._cursor_stack = tuple(iter_frames(frame))
-		self._current_context = Snapshot(frame, event, arg, clone=self.recording)
+		# The cursor stack is only walked if a command needs it (see cursor_stack)
+		self._cursor_stack = None
+		self._current_context = self._snapshot(frame, event, arg)
 		
 		# Buffer's most present is always index 0
+		#   (and it evicts the oldest on its own to stay in its limits)
 		if self.recording:
 			self.context_buffer.appendleft(self._current_context)
-			#self.context_buffer.insert(0,self._current_context)
-		while len(self.context_buffer) > self.CONTEXT_BUFFER_LIMIT:
-			_ = self.context_buffer.pop()
 
-		self.logger.trace('%r' % self._current_context)
+		# (The repr can walk the whole stack for the depth, so only build it if it'll be logged)
+		if self.logger.isTraceEnabled():
+			self.logger.trace('%r' % self._current_context)
 
 		# From user code to overrides, this is the section that can go wrong.
 		# Blast shield this with a try/except
@@ -1054,6 +1152,11 @@ class Tracer(object):
 		# Ensure trace continues in this context
 		if frame.f_trace is None:
 			frame.f_trace = self.dispatch
+
+		# The caller may have been fast skipped, so it has no local trace.
+		#   Arm it if a trap could still trip once it resumes (like a Next or Step).
+		if event == 'return' and self.FAST_SKIP:
+			self._arm_caller(frame)
 		
 		# Ideally we'd use sys.gettrace but that ain't a thing in Jython 2.5
 		if self.monitoring and not _skip_frame(frame):
@@ -1065,6 +1168,76 @@ class Tracer(object):
 		return self.dispatch
 		
 
+	def _arm_caller(self, frame):
+		"""Turn on local tracing for a returning frame's caller, if it may need it.
+
+		Frames skipped on call never got an f_trace. Without one, stepping 
+		  or returning out of a traced frame would never stop in its caller.
+		"""
+		if not (self.interdicting or self.recording or self.traps):
+			return
+		caller = frame.f_back
+		if caller is None or caller.f_trace is not None or _skip_frame(caller):
+			return
+		caller.f_trace = self.dispatch
+
+
+	def _frame_is_interesting(self, frame):
+		"""Decide (at call time) if anything could possibly stop in this frame.
+
+		A frame is interesting if the tracer is interdicting or recording, 
+		  if a trap could trip in it, or if a breakpoint enabled for this tracer
+		  could be in its code. Otherwise it can be skipped entirely.
+
+		NOTE: This is decided once per call. A breakpoint added while an 
+		  uninteresting frame is already running will not trip in that frame.
+		  Returning into a skipped frame while a trap is set arms it again
+		  (see _arm_caller).
+		"""
+		if self.interdicting or self.recording or self.active_traps:
+			return True
+
+		code = frame.f_code
+
+		for trap in self.traps:
+			# Transient traps like Next and Return only apply to their own scope,
+			#   but any other trap (or Step) may trip anywhere.
+			filename = getattr(trap, 'filename', None)
+			if filename is None:
+				return True
+			if filename == code.co_filename and trap.caller == code.co_name:
+				return True
+
+		for breakpoints in Breakpoint.code_index(code).values():
+			for breakpoint in breakpoints:
+				if breakpoint.enabled[self]:
+					return True
+
+		return False
+
+
+	def _snapshot(self, frame, event, arg):
+		"""Capture the context, sharing unchanged locals with the frame's last snapshot.
+
+		The last snapshot per frame is only kept while the frame is live:
+		  once it returns there is nothing further to share with.
+		"""
+		# The last context is passed along either way so depth can be tracked incrementally
+		if not (self.recording and self.SHARED_SNAPSHOTS):
+			return Snapshot(frame, event, arg, clone=self.recording, 
+							previous=self._current_context)
+
+		previous = self._frame_snapshots.get(frame)
+		if previous is None:
+			previous = self._current_context
+		snapshot = Snapshot(frame, event, arg, clone=True, previous=previous)
+		if event == 'return':
+			self._frame_snapshots.pop(frame, None)
+		else:
+			self._frame_snapshots[frame] = snapshot
+		return snapshot
+
+
 	#--------------------------------------------------------------------------
 	# Event Dispatch
 	#--------------------------------------------------------------------------
@@ -1282,11 +1455,10 @@ class Tracer(object):
 					scope=MessageScopes.GATEWAY
 					)
 
+			# The hub replies with whatever commands it had buffered (if any)
 			if result:
 				self._remote_request_handle = True
 				self._request_command_onSuccess(result)
-			
-			sleep(self._UPDATE_CHECK_DELAY)
 			return
 
 		# Run in an async, since we don't want to risk waiting for GUI to finish
@@ -1333,14 +1505,12 @@ class Tracer(object):
 
 		if result:
 			if isinstance(result, (str, unicode)):
-				self._pending_commands.append(result)
+				self._pending_commands.put(result)
 			elif isinstance(result, (list, tuple, set)):
-				for command in result:
-					self._pending_commands.append(command)
+				self._pending_commands.put(list(result))
 
 		# Request complete - clear it. 
 		#   Assume that if not sanity check request_handle was passed in, this was correctly called back. 
-		sleep(self._UPDATE_CHECK_DELAY)
 		self._remote_request_handle = None
 
 
@@ -1359,21 +1529,77 @@ class Tracer(object):
 		self._remote_request_handle = None
 
 
-	def _send_update(self):
-		pass
-#		if self.REMOTE_MESSAGING:
-#			_ = system.util.sendMessage(
-#				project=self.IGNITION_MESSAGE_PROJECT,
-#				messageHandler=self.IGNITION_MESSAGE_HANDLER,
-#				payload=self._payload_tracer_state,
-#				scope=MessageScopes.GATEWAY,
-#				)
+	def _send_update(self, force=False):
+		"""Mark the tracer state as changed and publish it, at most UPDATE_MAX_RATE times a second.
+
+		Changes that come in faster than that are coalesced: the next update sent
+		  carries the latest state and how many intermediate states were dropped.
+		  Anything still pending is flushed while the tracer waits for commands.
+		"""
+		if not self.REMOTE_MESSAGING:
+			return
+		if self._update_pending:
+			self._update_dropped += 1
+		self._update_pending = True
+		self._flush_update(force)
+
+
+	def _flush_update(self, force=False):
+		"""Publish the pending update, if any, once the rate limit allows."""
+		if not self._update_pending:
+			return
+
+		now = time()
+		if not force and (now - self._update_last_time) < (1.0 / self.UPDATE_MAX_RATE):
+			return
+
+		payload = self._payload_tracer_update
+		self._update_pending = False
+		self._update_last_time = now
+
+		_ = system.util.sendMessage(
+			project=self.IGNITION_MESSAGE_PROJECT,
+			messageHandler=self.IGNITION_MESSAGE_HANDLER,
+			payload=payload,
+			scope=MessageScopes.GATEWAY,
+			)
 
 
 	#--------------------------------------------------------------------------
 	# Payloads
 	#--------------------------------------------------------------------------
 
+	@property
+	def _payload_tracer_update(self):
+		"""The tracer state, delta encoded against the last update sent.
+
+		Also carries the commands logged since then and the dropped state count.
+		"""
+		state = self._payload_tracer_state
+
+		self._update_sequence += 1
+		full = (    self._update_published is None
+				 or self._update_sequence % self.UPDATE_FULL_STATE_EVERY == 0)
+		if full:
+			payload = dict(state)
+		else:
+			payload = delta_encode(state, self._update_published)
+		self._update_published = state
+
+		new_commands = min(self._commands_logged - self._commands_published, self.UPDATE_LOG_LIMIT)
+		if new_commands:
+			payload['logs'] = self._payload_last_logs(new_commands)
+		self._commands_published = self._commands_logged
+
+		payload['message'] = str(MessageTypes.STATE_UPDATE)
+		payload['id'] = self.id
+		payload['sequence'] = self._update_sequence
+		payload['delta'] = not full
+		payload['dropped'] = self._update_dropped
+		self._update_dropped = 0
+
+		return payload
+
 	@property
 	def _payload_tracer_state(self):
 		return {
@@ -1382,6 +1608,8 @@ class Tracer(object):
 			'ignition': self._payload_ignition_info,
 			'cursor': self._payload_cursor_info,
 			'log': self._payload_last_log,
+			'context_buffer': self.context_buffer.stats,
+			'code_cache': CodeCache.stats,
 		}
 	
 	@property
@@ -1398,6 +1626,12 @@ class Tracer(object):
 			'stdout': self.sys.stdout.history[-n:],
 			'stdin': self.sys.stdin.history[-n:],
 			'stderr': self.sys.stderr.history[-n:],
+			# Where to pick up with the `output` command to follow along
+			'sequences': {
+				'stdout': self.sys.stdout.history.next_sequence,
+				'stdin': self.sys.stdin.history.next_sequence,
+				'stderr': self.sys.stderr.history.next_sequence,
+			},
 			'commands': [ {
 					'in': self._logged_commands[i][0],
 					'out': self._logged_commands[i][1],
@@ -1407,26 +1641,29 @@ class Tracer(object):
 
 	@property 
 	def _payload_last_log(self, n=5):
+		# (Nothing may be logged yet - a resync or heartbeat can come first)
+		if self._logged_commands:
+			command = {
+				'in': self._logged_commands[0][0],
+				'out': self._logged_commands[0][1],
+			}
+		else:
+			command = None
 		return {
 			'stdout': self.sys.stdout.history[-1:],
 			'stdin': self.sys.stdin.history[-1:],
 			'stderr': self.sys.stderr.history[-1:],
-			'command': {
-				'in': self._logged_commands[0][0],
-				'out': self._logged_commands[0][1],
-			}
+			'command': command,
 		}
 
 	@property
 	def _payload_cursor_info(self):
 
 		radius = 10
-		src = self._command_source(radius=radius)
-		if not src:
+		source_lines, source_start = self._command_source(radius=radius)
+		if not source_lines:
 			source_lines = ['# CodeCache could not find source code!']
 			source_start = 0
-		else:
-			source_lines, source_start = src
 
 		return {
 			'source': source_lines,
@@ -1452,7 +1689,7 @@ class Tracer(object):
 	#--------------------------------------------------------------------------
 
 	# Some commands shouldn't sanely be logged. Especially the log/status stuff.
-	_UNLOGGED_COMMANDS = set(['status', 'state', 'log'])
+	_UNLOGGED_COMMANDS = set(['status', 'state', 'log', 'output', 'resync'])
 	
 	def command(self, command):
 		"""
@@ -1502,11 +1739,15 @@ class Tracer(object):
 
 		while self.interdicting:
 			# Pause while we wait for a command
-			self._await_command()
+			pending = self._await_command()
 
-			while self._pending_commands and self.interdicting:
+			commands_run = False
+			while pending is not None and self.interdicting:
 				#self.logger.debug('Command: %s' % self.command)
-				result = self.command(self._pending_commands.pop())
+				command = pending.command
+				result = self.command(command)
+				pending.complete(result)
+				commands_run = True
 
 				# Reply to the tag's command with results
 				if self.tag_path:
@@ -1519,36 +1760,74 @@ class Tracer(object):
 							system.tag.write(self.tag_path, 'Done.')						
 						else:
 							system.tag.write(self.tag_path, str(result))
+
+				pending = self._pending_commands.poll()
 						
 			# Send update after all commands are run (query for logs if batch set...)
-			self._send_update()
+			if commands_run:
+				self._send_update()
+
+			# ... and if it got held back by the rate limit, send it once allowed
+			self._flush_update()
+
+		# Nothing will come by to flush a held back update once released, so send it now
+		self._flush_update(force=True)
+
+	def submit(self, command):
+		"""
+		Queue a command (or list of commands) to be run on the traced thread.
+
+		Unlike `tracer << command` this is safe from any thread. Returns a
+		  PendingCommand handle (or a list of them) - use .get(timeout) on it
+		  to wait for the result.
+		"""
+		return self._pending_commands.put(command)
+
 
 	def _await_command(self):
-		if not self._pending_commands:
+		"""
+		Block until a command is ready and return it (as a PendingCommand).
+		Returns None if nothing arrived within COMMAND_WAIT_TIMEOUT.
 
-			# Attempt to allow remote control of tracer (in case of gui thread blocking, for example)
-			if self.REMOTE_MESSAGING and not self._remote_request_handle:
-				self._request_command(blocking=True)
+		Commands submitted in this JVM wake it right away. Remote ones (and tag commands)
+		  can't, so while those are set up this wakes every REMOTE_POLL_INTERVAL to ask.
+		"""
+		pending = self._pending_commands.poll()
+		if pending is not None:
+			return pending
 
-			# If given a tag for input, check if it has a command ready.
-			# To prevent repeated commands, value must be cleared between commands.
-			if self.tag_path:
-				tag_command = system.tag.read(self.tag_path).value
-				if tag_command:
-					if self.tag_acked:
-						self._pending_commands.append(tag_command)
-					self.tag_acked = False
-				else:
-					self.tag_acked = True
+		wait = self.COMMAND_WAIT_TIMEOUT
 
-			sleep(self._UPDATE_CHECK_DELAY)
+		# Attempt to allow remote control of tracer (in case of gui thread blocking, for example)
+		#   The hub replies right away, so ask again after a short wait if it had nothing.
+		if self.REMOTE_MESSAGING and not self._remote_request_handle:
+			self._request_command(blocking=True)
+			wait = min(wait, self.REMOTE_POLL_INTERVAL)
 
-			self._burn_failsafe_fuse()
+		# If given a tag for input, check if it has a command ready.
+		# To prevent repeated commands, value must be cleared between commands.
+		#   Tags can't wake the channel, so they still need polling.
+		if self.tag_path:
+			tag_command = system.tag.read(self.tag_path).value
+			if tag_command:
+				if self.tag_acked:
+					self._pending_commands.put(tag_command)
+				self.tag_acked = False
+			else:
+				self.tag_acked = True
+			wait = min(wait, self._UPDATE_CHECK_DELAY)
+
+		pending = self._pending_commands.take(wait)
+
+		self._burn_failsafe_fuse()
+
+		return pending
 
 
 	def _log_command(self, command, result, timestamp=None):
 		format_string = '[%s] (IPD) %s'
 		self._logged_commands.appendleft((format_string % (timestamp or datetime.now(), command), result))
+		self._commands_logged += 1
 		# self._logged_commands.insert(0, (format_string % (timestamp or datetime.now(), command), result))
 		while len(self._logged_commands) > self.COMMAND_BUFFER_LIMIT:
 			_ = self._logged_commands.pop()	
@@ -1579,7 +1858,13 @@ class Tracer(object):
 
 	def _command_heartbeat(self, command='heartbeat'):
 		"""Sends an update to prove the tracer is still alive."""
-		self._send_update()
+		self._send_update(force=True)
+
+
+	def _command_resync(self, command='resync'):
+		"""Sends the full state, for when the hub lost track of the updates."""
+		self._update_published = None
+		self._send_update(force=True)
 
 
 	#--------------------------------------------------------------------------
@@ -1640,7 +1925,7 @@ class Tracer(object):
 		"""
 		stack = [trace_entry_line(frame, indent= ('-> ' if index == self._cursor_index else '   ') )
 				 for index, frame
-				 in iter_frames(self.cursor_frame)]
+				 in enumerate(iter_frames(self.cursor_frame))]
 
 		stack.append('Cursor is %s current execution frame in %s context' % (
 			'at' if not self._cursor_index else ('%d from' % self._cursor_index),
@@ -1666,7 +1951,7 @@ class Tracer(object):
 		"""
 		Move the cursor to an older frame (up the stack)
 		"""
-		if self._cursor_index < (len(self._cursor_stack) - 1):
+		if self._cursor_index < (len(self.cursor_stack) - 1):
 			self._cursor_index += 1
 		return self._cursor_index
 	_command_u = _command_up
@@ -1986,6 +2271,24 @@ class Tracer(object):
 			return 'IndexError: log depth %d is out of range for %s' % (log_index, format)
 	_command_state = _command_log = _command_status
 
+
+	def _command_output(self, command='output', stream='stdout', sequence=-10, limit=100):
+		"""
+		Read the lines written to stream ('stdout', 'stdin', or 'stderr') 
+		  from the given sequence number on (at most limit of them).
+		By default this is the last 10 lines. The reply includes the sequence 
+		  to ask for next time to get only what's new, and how many lines were
+		  skipped because they fell out of the buffer before being read.
+		NOTE: Like status, this is not logged.
+		"""
+		lines, sequence, skipped = self.sys._io_proxy.read_since(stream, sequence, limit)
+		return {
+			'stream': stream,
+			'lines': lines,
+			'sequence': sequence,
+			'skipped': skipped,
+		}
+
 		
 	def _command_list(self, command='list', first=0, last=0):
 		"""
@@ -2026,7 +2329,7 @@ class Tracer(object):
 		if end >= len(code_lines):
 			end = len(code_lines) - 1
 
-		rendered_code = CodeCache._render_tabstops(code_lines[start:end])
+		rendered_code = CodeCache.get_rendered_lines(frame, sys_context=self.sys)[start:end]
 
 		line_order = (int(math.log10(end)) + 1)
 		fmt_line = '[ %%%dd]  %%s' % line_order
@@ -2040,12 +2343,16 @@ class Tracer(object):
 	_command_l = _command_list
 
 
-	def _command_source(self, command='source', radius=0):
+	def _command_source(self, command='source', radius=0, format=''):
 		"""
 		Returns the source code for the file at the cursor frame.
 		Just source code lines returned by default, otherwise the starting 
 		  line is also returned (to contextualize block of code).
+		If format is 'html', the source is instead syntax highlighted HTML,
+		  with the cursor's line marked (for example "source 10 html").
 		"""
+		if format == 'html':
+			return CodeCache.get_highlighted(self.cursor_frame, radius=radius, sys_context=self.sys)
 		if radius:
 			return CodeCache.get_lines_with_start(self.cursor_frame, radius=radius, sys_context=self.sys)
 		else:
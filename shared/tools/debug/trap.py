@@ -6,6 +6,7 @@ from shared.tools.expression import Expression, two_argument_operators
 
 
 from functools import wraps
+from time import time
 
 
 __copyright__ = """Copyright (C) 2020 Corso Systems"""
@@ -26,7 +27,11 @@ def fail_false(function):
 
 
 def resolve_field(context, field):
-	return getattr(context, field, context[field])
+	"""Get the field from the context's attributes, falling back to its locals."""
+	try:
+		return getattr(context, field)
+	except AttributeError:
+		return context[field]
 
 
 
@@ -44,18 +49,20 @@ class WatchTrap(BaseTrap):
 
 	Function will be provided values from context that map to the argument names of it.
 	"""
-	__slots__ = ('function', 'expectation')
+	__slots__ = ('function', 'expectation', '_fields')
 
 	def __init__(self, function, expectation=True):
 		self.function = function
 		self.expectation = expectation
 
+		# Resolve the argument names once, rather than each check
+		fc = function.func_code
+		self._fields = fc.co_varnames[:fc.co_argcount]
+
 	@fail_false
 	def check(self, context):
-		fc = self.function.f_code
-		return self.function(*(self.resolve_field(context, field) 
-		         			   for field in fc.co_varnames[:fc.co_argcount]
-							 )) == self.expectation
+		return self.function(*[resolve_field(context, field) 
+							   for field in self._fields]) == self.expectation
 
 
 class ExpressionTrap(BaseTrap):
@@ -64,36 +71,46 @@ class ExpressionTrap(BaseTrap):
 	Expressions should reference variables in context.
 	"""
 
-	__slots__ = ('left', 'comparator', 'right')
+	__slots__ = ('left', 'comparator', 'right', 
+				 'checks', 'check_time')
 
 	def __init__(self, expression, comparator='==', expected_result='True'):
-		self.left = Expression(self.expression)
+		# Expressions are resolved here once and then simply called on each check
+		self.left = Expression(expression)
 		self.comparator = two_argument_operators[comparator]
-		self.right = Expression(self.expected_result)
+		self.right = Expression(expected_result)
+
+		self.checks = 0
+		self.check_time = 0.0 # seconds
 		
 	
 	@fail_false
 	def check(self, context):
-		return self.comparator(
-				self.left(*(self.resolve_field(context, field)
-							for field 
-							in self.left._fields) ) ,
-				self.right(*(self.resolve_field(context, field)
-							 for field 
-				 			 in self.right._fields) ) )
+		self.checks += 1
+		start = time()
+		try:
+			return self.comparator(
+					self.left(*[resolve_field(context, field)
+								for field 
+								in self.left._fields]) ,
+					self.right(*[resolve_field(context, field)
+								 for field 
+					 			 in self.right._fields]) )
+		finally:
+			self.check_time += time() - start
 
 
 
 class ContextTrap(BaseTrap):
 	"""Return true if a context matches the preset values."""
-	__slots__ = ('context_values')
+	__slots__ = ('context_values',)
 
 	def __init__(self, **context_values):
 		self.context_values = context_values
 
 	@fail_false
 	def check(self, context):
-		return all(self.resolve_field(context, field) == value 
+		return all(resolve_field(context, field) == value 
 			       for field, value 
 			       in self.context_values.items())
 
@@ -122,11 +139,10 @@ class Next(TransientTrap):
 		self.caller   = context.caller
 
 	def check(self, context):
-		return all((
-			context.depth    == self.depth,
-			context.filename == self.filename,
-			context.caller   == self.caller,
-			))
+		# Depth is checked last since it may need to walk the stack
+		return (    context.filename == self.filename
+				and context.caller   == self.caller
+				and context.depth    == self.depth )
 
 
 class Until(TransientTrap):
@@ -140,12 +156,10 @@ class Until(TransientTrap):
 		self.line     = context.line
 
 	def check(self, context):
-		return all((
-			context.depth    == self.depth,
-			context.filename == self.filename,
-			context.caller   == self.caller,
-			context.line > self.line or context.event == 'return',
-			))
+		return (    context.filename == self.filename
+				and context.caller   == self.caller
+				and (context.line > self.line or context.event == 'return')
+				and context.depth    == self.depth )
 
 
 class Return(TransientTrap):
@@ -156,9 +170,7 @@ class Return(TransientTrap):
 		self.caller   = context.caller
 
 	def check(self, context):
-		return all((
-			context.depth    == self.depth,
-			context.filename == self.filename,
-			context.caller   == self.caller,
-			context.event    == 'return',
-			))
\ No newline at end of file
+		return (    context.event    == 'return'
+				and context.filename == self.filename
+				and context.caller   == self.caller
+				and context.depth    == self.depth )
\ No newline at end of file
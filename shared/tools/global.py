@@ -3,11 +3,16 @@
 
 	This is a manual form of memoization.
 
-	When used, ExtraGlobal will generate two threads:
+	When used, ExtraGlobal will generate these threads:
 	 - A cache thread that holds references even if the source threads or functions
 	     go out of scope
-	 - A monitoring thread that culls the cache periodically, checking what items
+	 - A monitoring thread that wakes when the next item is due, checking what items
 	     need to be removed from expiration, or replaced/refreshed from a callback
+	 - A few refresh workers that run the callbacks, so a slow one doesn't hold up the rest
+	     (these close themselves after a while without work)
+
+	Optionally, the cache can be saved to a local file every so often and reloaded
+	  when it starts back up (see enable_persistence), so it comes up warm after a restart.
 
 	The ExtraGlobal class can not be instantiated - it is forced to be a singleton
 	  interface by the metaclass that defines it. All methods to interact with the
@@ -33,12 +38,26 @@
 """
 
 from shared.tools.thread import async, findThreads, getFromThreadScope
-from shared.tools.timing import EveryFixedDelay
 from shared.tools.meta import MetaSingleton
+from shared.tools.sizing import estimate_size, SIZE_OBJECT
 
 from time import time, sleep
+from random import random
 from functools import wraps
-from java.lang import Thread
+from itertools import count
+import cPickle as pickle
+import os
+from heapq import heappush, heappop, heapify, nsmallest
+from threading import Lock, RLock, Condition, Event, currentThread
+import sys
+from java.lang import Thread, System
+from java.util import Date
+from java.util.concurrent import LinkedBlockingQueue, TimeUnit
+from java.io import File
+from java.nio.file import Files, LinkOption, StandardCopyOption
+from java.nio.file.attribute import PosixFileAttributeView, PosixFilePermission, PosixFilePermissions
+from com.inductiveautomation.ignition.common import Dataset
+from com.inductiveautomation.ignition.common.script.builtin.DatasetUtilities import PyDataSet
 
 
 __copyright__ = """Copyright (C) 2020 Corso Systems"""
@@ -57,8 +76,95 @@ __all__ = [
 	'eg_keys',
 	'eg_iterkeys',
 	'eg_update',
+	'extra_global_memoize',
+	'estimate_size',
 	]
 
+
+# Bump if what persist writes changes, so older snapshots are ignored
+PERSIST_VERSION = 1
+
+class _FrozenDataset(object):
+	"""A picklable stand-in for a dataset: just its column names and rows."""
+
+	def __init__(self, dataset):
+		self.py = isinstance(dataset, PyDataSet)
+		if self.py:
+			dataset = dataset.getUnderlyingDataset()
+		self.headers = list(dataset.getColumnNames())
+		self.rows = [[dataset.getValueAt(row, column) for column in range(dataset.getColumnCount())]
+					 for row in range(dataset.getRowCount())]
+
+	def thaw(self):
+		dataset = system.dataset.toDataSet(self.headers, self.rows)
+		if self.py:
+			return system.dataset.toPyDataSet(dataset)
+		return dataset
+
+
+def _freeze(obj):
+	if isinstance(obj, (Dataset, PyDataSet)):
+		return _FrozenDataset(obj)
+	return obj
+
+def _thaw(obj):
+	if isinstance(obj, _FrozenDataset):
+		return obj.thaw()
+	return obj
+
+
+def _trusted_snapshot(path):
+	"""True if the file at path is owned by the user the gateway runs as, and no one else can write to it.
+	(Unpickling a snapshot can run code, so anyone who could write it could run code here.)
+	"""
+	snapshot_path = File(path).toPath()
+	if Files.isSymbolicLink(snapshot_path):
+		return False
+	# (Windows names the owner as DOMAIN\user)
+	owner = Files.getOwner(snapshot_path, LinkOption.NOFOLLOW_LINKS).getName().rpartition('\\')[2]
+	if owner != System.getProperty('user.name'):
+		return False
+	# Without POSIX permissions (Windows) the owner is all there is to go on
+	if Files.getFileAttributeView(snapshot_path, PosixFileAttributeView, LinkOption.NOFOLLOW_LINKS) is None:
+		return True
+	permissions = Files.getPosixFilePermissions(snapshot_path, LinkOption.NOFOLLOW_LINKS)
+	return not (permissions.contains(PosixFilePermission.GROUP_WRITE) 
+	         or permissions.contains(PosixFilePermission.OTHERS_WRITE))
+
+def _create_private(path):
+	"""Create an empty file at path that only its owner can read or write (where there are POSIX permissions).
+	Fails if anything is already there, rather than following a link or reusing someone else's file."""
+	file_path = File(path).toPath()
+	if file_path.getFileSystem().supportedFileAttributeViews().contains('posix'):
+		Files.createFile(file_path, PosixFilePermissions.asFileAttribute(PosixFilePermissions.fromString('rw-------')))
+	else:
+		Files.createFile(file_path)
+
+
+def _resolve_callback(path):
+	"""Import the function at the dotted path (None if it can't be found)."""
+	module_name, _, name = path.rpartition('.')
+	if not module_name:
+		return None
+	try:
+		module = __import__(module_name, {}, {}, [name])
+		return getattr(module, name)
+	except:
+		return None
+
+def _callback_path(callback):
+	"""The dotted path to a module level function, so it can be found again after a restart.
+	Closures, lambdas, and methods can't be, so they get None."""
+	module_name = getattr(callback, '__module__', None)
+	name = getattr(callback, '__name__', None)
+	if not module_name or not name or module_name == '__main__':
+		return None
+	path = '%s.%s' % (module_name, name)
+	if _resolve_callback(path) is not callback:
+		return None
+	return path
+
+
 class CacheEntry(object):
 	"""Hold the relevant details for an object in the cache.
 	Assumes that there is a monitoring process that will clear the item
@@ -66,14 +172,22 @@ class CacheEntry(object):
 	"""
 	__slots__ = ('_obj', 
 		         'label', 'scope', 'lifespan', 
-		         '_last_time', 'callback')
+		         '_last_time', 'callback',
+		         'grace', 'refresh_ahead', '_refresh_lock', '_refresh_owner',
+		         'size', 'last_access')
 
-	def __init__(self, obj, label, scope, lifespan, callback=None):
+	def __init__(self, obj, label, scope, lifespan, callback=None, grace=None, refresh_ahead=None):
 		"""Set up the cache object. A callback may be given to generate a new value on expiration.
 		
 		Lifespan determines when death should occur.
 		 - If a callback is given, wait for the lifespan then refresh
 		 - Otherwise lifespan is the timeout for the cache entry cooling off
+
+		With a callback, two more windows can be set (in seconds):
+		 - grace: after the lifespan, the stale value is still returned for this long
+		     while it's refreshed in the background
+		 - refresh_ahead: refresh in the background this long before the lifespan is up,
+		     so the value never goes stale if the callback keeps up
 		"""
 		self._obj = obj
 		self.label = label
@@ -82,6 +196,17 @@ class CacheEntry(object):
 
 		self._last_time = time()
 		self.callback = callback
+
+		self.grace = grace or 0.0
+		self.refresh_ahead = refresh_ahead or 0.0
+		self._refresh_lock = Lock()
+		# The thread running the callback, so it can read this entry without deadlocking
+		self._refresh_owner = None
+
+		# For capacity limits: estimated bytes, and how recently it's been used
+		#   (how often is counted by the key's metrics)
+		self.size = 0
+		self.last_access = self._last_time
 		
 	def update(self, obj=None):
 		"""Change the cache entry to what's in obj. Resets the last_time for expiration/refresh.
@@ -91,12 +216,22 @@ class CacheEntry(object):
 			if self.callback:
 				self.refresh()
 		else:
-			self._obj = obj
-			self._last_time = time()
+			self._replace(obj)
+
+	def _replace(self, obj):
+		"""Swap in a new value, resetting the clock (and the size accounting for it)."""
+		self._obj = obj
+		self._last_time = time()
+		ExtraGlobal._resize(self)
 
 	@property
 	def obj(self):
 		"""Set as a property to prevent getting easily written to."""
+		self.last_access = time()
+		if self.stale:
+			# Serve what's here while the refresh workers get a new one
+			ExtraGlobal._dispatch_refresh(self)
+			return self._obj
 		if self.expired:
 			return None
 		else:
@@ -113,6 +248,25 @@ class CacheEntry(object):
 	def time_remaining(self):
 		return max(0, self.lifespan - (time() - self._last_time))
 
+	@property
+	def due(self):
+		"""When the entry's time is up (epoch seconds)."""
+		return self._last_time + self.lifespan
+
+	@property
+	def refresh_time(self):
+		"""When the entry should next be checked - ahead of when it's due, if it can refresh ahead."""
+		if self.callback:
+			return self._last_time + self.lifespan - self.refresh_ahead
+		return self._last_time + self.lifespan
+
+	@property
+	def stale(self):
+		"""True when the lifespan is up, but the entry's still in its grace window."""
+		if not (self.callback and self.grace) or self._obj is None:
+			return False
+		return 0 < (time() - self._last_time - self.lifespan) <= self.grace
+
 	@property 
 	def expired(self):
 		"""Returns true when the entry is past when it should be cleaned up.
@@ -127,7 +281,12 @@ class CacheEntry(object):
 			# ... check if it can be refreshed
 			if self.callback:
 				
-				self.refresh()
+				# The callback's reading its own entry mid-refresh: hand it what's here
+				if self._refresh_owner is currentThread():
+					return False
+
+				# (if some other thread is already on it, this waits for their result)
+				self.refresh(force=False)
 				
 				# Either the refresh worked, or it didn't. 
 				# If the refresh callback replaced the entry, then it'll return None
@@ -153,28 +312,59 @@ class CacheEntry(object):
 		return False
 
 
-	def refresh(self):
+	def refresh(self, wait=True, force=True):
 		"""Run the callback, if any was provided.
 		If the callback function does not return a value, assume the function
 		  updated the cache on its own (or not - perhaps it's a cleanup...)
 		Otherwise save the value and reset the clock. 
+
+		Only one thread runs the callback at a time. Any others that ask meanwhile
+		  wait for it to finish (unless wait is False) and don't run it again.
+		Unless forced, the callback isn't run if the entry's not yet up for refresh
+		  (another thread got to it first).
+		If the callback itself reads (or refreshes) this entry, that's let through
+		  without running the callback again.
 		"""
-		if self.callback:
+		if not self.callback:
+			return
+
+		if self._refresh_owner is currentThread():
+			return
+
+		if not self._refresh_lock.acquire(False):
+			if wait:
+				self._refresh_lock.acquire()
+				self._refresh_lock.release()
+			return
+
+		try:
+			if not force and time() < self.refresh_time:
+				return
+
 			# in case of failure, mark to cull and move on
+			started = time()
+			self._refresh_owner = currentThread()
 			try:
 				ret_val = self.callback()
 			except:
 				self._obj = None
+				ExtraGlobal._record_refresh(self.key, time() - started, failed=True)
 				return
+			ExtraGlobal._record_refresh(self.key, time() - started)
 				
 			if ret_val is not None:
-				self._obj = ret_val
-				self._last_time = time()
+				self._replace(ret_val)
+		finally:
+			self._refresh_owner = None
+			self._refresh_lock.release()
 
 
 	def extend(self, additional_time=0.0):
 		"""Extend the effective lifespan of the cache entry by additional_time seconds."""
 		self._last_time += additional_time
+		# Only shortening it needs rescheduling - later is caught when it comes due
+		if additional_time < 0:
+			ExtraGlobal._schedule(self)
 
 	
 	@property
@@ -203,6 +393,67 @@ class CacheEntry(object):
 			return '<CacheEntry [% 9.3fs] "%s" (global)>' % (time() - self._last_time, self.label,)
 
 
+class KeyMetrics(object):
+	"""Running counters for one (scope, label) of the cache.
+	These are kept even after the entry itself is gone, so misses count too.
+	(Counts are approximate when many threads hit the same key at once.)
+	"""
+	__slots__ = ('hits', 'misses', 'fallbacks',
+				 'refreshes', 'refresh_failures', 'refresh_seconds', 'refresh_max',
+				 'last_hit')
+
+	COLUMNS = ('scope', 'label', 'cached', 
+			   'hits', 'misses', 'fallbacks', 'hit_ratio',
+			   'refreshes', 'refresh_failures', 'refresh_avg_ms', 'refresh_max_ms',
+			   'last_hit')
+
+	def __init__(self):
+		self.hits = 0
+		self.misses = 0
+		self.fallbacks = 0
+		self.refreshes = 0
+		self.refresh_failures = 0
+		self.refresh_seconds = 0.0
+		self.refresh_max = 0.0
+		self.last_hit = None
+
+	def row(self, key, cached):
+		"""The counters as a dict with the COLUMNS as keys."""
+		scope, label = key
+		lookups = self.hits + self.fallbacks + self.misses
+		return {
+			'scope': scope, 
+			'label': label, 
+			'cached': cached,
+			'hits': self.hits, 
+			'misses': self.misses, 
+			'fallbacks': self.fallbacks,
+			'hit_ratio': (float(self.hits + self.fallbacks) / lookups) if lookups else None,
+			'refreshes': self.refreshes,
+			'refresh_failures': self.refresh_failures,
+			'refresh_avg_ms': (1000.0 * self.refresh_seconds / self.refreshes) if self.refreshes else None,
+			'refresh_max_ms': 1000.0 * self.refresh_max,
+			'last_hit': self.last_hit,
+		}
+
+
+class _Flight(object):
+	"""A computation in progress, for other threads to wait on."""
+	__slots__ = ('done', 'result', 'error')
+
+	def __init__(self):
+		self.done = Event()
+		self.result = None
+		self.error = None
+
+	def outcome(self):
+		"""Wait for the computation to finish, then return its result (or raise its error)."""
+		self.done.wait()
+		if self.error:
+			raise self.error[0], self.error[1], self.error[2]
+		return self.result
+
+
 class ExtraMetaExtraGlobal(type):
 	"""Force the MetaExtraGlobal definition to be a JVM-level global singleton object.
 
@@ -282,6 +533,13 @@ class ExtraMetaExtraGlobal(type):
 			# Initialize to be self-consistent and self-referential
 			if MetaExtraGlobal.GLOBAL_REFERENCE is None:
 				MetaExtraGlobal.GLOBAL_REFERENCE = MetaExtraGlobal
+
+			# Come up warm, if persistence was set up before the cache was (re)started
+			if MetaExtraGlobal.PERSIST_PATH and MetaExtraGlobal._initialized:
+				try:
+					MetaExtraGlobal._initialized.restore()
+				except:
+					system.util.getLogger('ExtraGlobal').warn('Could not restore from %r: %r' % (MetaExtraGlobal.PERSIST_PATH, sys.exc_info()[1]))
 				
 			thisThread = Thread.currentThread()
 			
@@ -358,18 +616,93 @@ class MetaExtraGlobal(type):
 	DEFAULT_LIFESPAN = 60 # seconds
 
 	# Monitor (garbage collecing) thread configuraiton
-	# Period to check the cache for expired entries
-	CHECK_PERIOD = 10 # seconds
-	
+	# The monitor sleeps until the next entry is due, but wakes at least this often
+	#   to check if it should be replaced or shut down.
 	# Inherited from the metaclass, copied here for reference
 	RELEVANCE_CHECK_PERIOD = 1 # second
 
 	CLEANUP_THREAD_NAME = 'ExtraGlobal-Monitor'
 	_CLEANUP_MONITOR = None
 
+	# Refresh worker configuration
+	# Callbacks are run by up to REFRESH_WORKERS threads, fed by a bounded queue.
+	REFRESH_THREAD_NAME = 'ExtraGlobal-Refresh'
+	REFRESH_WORKERS = 4
+	REFRESH_QUEUE_LIMIT = 1000
+	# Seconds a worker waits for more work before closing
+	REFRESH_WORKER_IDLE = 30
+	# Seconds to wait before trying again if the queue is full
+	REFRESH_RETRY_DELAY = 1.0
+
+	_refresh_queue = LinkedBlockingQueue(REFRESH_QUEUE_LIMIT)
+	#   live worker threads (guarded by the _index_lock)
+	_refresh_workers = []
+	# Numbers the workers' thread names, so each one's name is unique
+	_refresh_worker_ids = count(1)
+	#   key -> entry currently queued or being refreshed
+	_refreshing = {}
+	#   key -> _Flight, for values being computed for the first time (see setdefault)
+	_flights = {}
+
+	# Capacity limits (None for no limit), for the whole cache and for each scope.
+	# Past a limit, entries are evicted by EVICTION_POLICY ('lru' or 'lfu')
+	#   until back under EVICTION_TARGET of the limit.
+	# ('lfu' goes by the hits in the key metrics, so without METRICS it's the same as 'lru')
+	# Use set_capacity to set these.
+	MAX_ENTRIES = None
+	MAX_BYTES = None
+	SCOPE_MAX_ENTRIES = {}
+	SCOPE_MAX_BYTES = {}
+	EVICTION_POLICY = 'lru'
+	EVICTION_TARGET = 0.9
+
+	# Called with (label, scope, obj) for each entry evicted for capacity
+	_eviction_callbacks = []
+	#   scope -> count evicted
+	_evictions = {}
+	# Estimates how many bytes an object takes (a list so it can be swapped out - see set_sizer)
+	_sizer = [estimate_size]
+
+	# Persistence (off unless PERSIST_PATH is set - see enable_persistence)
+	PERSIST_PATH = None
+	# Seconds between snapshots
+	PERSIST_PERIOD = 60
+	# Callback entries restored past their time are refreshed at random
+	#   within this many seconds, rather than all at once
+	PERSIST_RESTORE_SPREAD = 10.0
+	# Entries estimated past PERSIST_MAX_ENTRY_BYTES aren't saved, and once the snapshot
+	#   holds PERSIST_MAX_BYTES (most recently used first), nothing more is. None for no limit.
+	PERSIST_MAX_ENTRY_BYTES = 1024 * 1024
+	PERSIST_MAX_BYTES = 64 * 1024 * 1024
+	PERSIST_THREAD_NAME = 'ExtraGlobal-Persist'
+	_persist_state = {'next': 0, 'thread': None}
+
+	# Per key metrics (hits, misses, refresh times). Turn off to save the bookkeeping.
+	METRICS = True
+	# Past this many keys tracked, metrics are pruned back to half that 
+	#   (keys no longer cached go first, then the least recently hit)
+	METRICS_MAX_KEYS = 10000
+	#   key -> KeyMetrics (keys are added and removed holding the _metrics_lock)
+	_metrics = {}
+	_metrics_lock = Lock()
+
 	_cache = {}
 
+	# Indexes kept in step with the _cache, so nothing needs to scan all of it
+	#   scope -> set of labels
 	_scoped_labels = {}
+	#   scope -> estimated bytes
+	_scope_bytes = {}
+	#   heap of (due time, key) - entries whose time may be up, soonest first
+	_expirations = []
+	#   key -> due time of its live item on the heap. Items that don't match are stale
+	#   (superseded by a sooner one, or the key was removed) and are skipped when they come up.
+	_scheduled = {}
+	# Past this many stale items (and at least twice the live ones) the heap is rebuilt
+	_EXPIRATIONS_SLACK = 64
+	_index_lock = RLock()
+	# Signalled when something is scheduled sooner than the monitor expects
+	_schedule_changed = Condition(_index_lock)
 	
 	def __new__(cls, clsname, bases, attrs):
 		"""Run when ExtraGlobal is created. Set to run once and only once."""
@@ -382,8 +715,19 @@ class MetaExtraGlobal(type):
 
 	def clear(cls):
 		"""Hard reset the cache."""
-		cls._cache.clear()
-		cls._scoped_labels.clear()
+		cls._index_lock.acquire()
+		try:
+			cls._cache.clear()
+			cls._scoped_labels.clear()
+			cls._scope_bytes.clear()
+			cls._evictions.clear()
+			del cls._expirations[:]
+			cls._scheduled.clear()
+		finally:
+			cls._index_lock.release()
+		cls.reset_metrics()
+		cls._refresh_queue.clear()
+		cls._refreshing.clear()
 		cls._CLEANUP_MONITOR = None
 
 
@@ -399,7 +743,7 @@ class MetaExtraGlobal(type):
 
 	# Primary access methods
 
-	def stash(cls, obj, label=None, scope=None, lifespan=None, callback=None):
+	def stash(cls, obj, label=None, scope=None, lifespan=None, callback=None, grace=None, refresh_ahead=None):
 		"""Add an object to the cache.  Label will be how it's retrieved, with an optional scope
 		  in case multiple labels are the same in differing contexts.
 
@@ -410,20 +754,21 @@ class MetaExtraGlobal(type):
 
 		A callback can be provided that will be called when the object expires or when refresh is called.
 		  The callback must take no arguments (either setting the cache value itself or is a closure.) 
+		  With a callback, the stale value can be served for up to grace seconds past the lifespan
+		  while it refreshes, and it can be refreshed in the background refresh_ahead seconds early.
 		"""
 		assert label is not None, "Objects stashed need to have a label associated with them."
 
 		if lifespan is None:
 			lifespan = cls.DEFAULT_LIFESPAN
 
-		cache_entry = CacheEntry(obj, label, scope, lifespan, callback)
-		cls._cache[cache_entry.key] = cache_entry
-		cls._scope_track(cache_entry.label, cache_entry.scope)
-		
-		system.util.getLogger('ExtraGlobal').trace('Stashed %r from %r' % (cache_entry.key, Thread.currentThread()))
+		cache_entry = CacheEntry(obj, label, scope, lifespan, callback, grace, refresh_ahead)
+		cache_entry.size = cls._measure(obj)
+		cls._index_add(cache_entry)
 		
 		system.util.getLogger('ExtraGlobal').trace('Stashed %r from %r' % (cache_entry.key, Thread.currentThread()))
 		
+		cls._enforce_capacity(scope, keep=cache_entry.key)
 		cls.spawn_cache_monitor()
 		return cache_entry.key
 
@@ -433,22 +778,47 @@ class MetaExtraGlobal(type):
 
 		Defaults to "global" scope (contextless - just the label as the key)
 		"""
+		key = CacheEntry.gen_key(label, scope)
 		try:
-			cache_entry = cls._cache[CacheEntry.gen_key(label, scope)]
+			cache_entry = cls._cache[key]
 		except KeyError:
-			scope = None
-			cache_entry = cls._cache[CacheEntry.gen_key(label, scope)]
+			try:
+				cache_entry = cls._cache[CacheEntry.gen_key(label, None)]
+			except KeyError:
+				cls._record_miss(key)
+				raise
+			if cls.METRICS and scope is not None:
+				cls._key_metrics(key).fallbacks += 1
 				
 		cls.spawn_cache_monitor()
-		return cache_entry.obj
+		obj = cache_entry.obj
+
+		if cls.METRICS:
+			metrics = cls._key_metrics(cache_entry.key)
+			if obj is None:
+				metrics.misses += 1
+			else:
+				metrics.hits += 1
+				metrics.last_hit = time()
+		return obj
 
 
 	def trash(cls, label=None, scope=None):
 		"""Remove an item from the cache directly."""
-		cls._scope_untrack(label, scope)
-		del cls._cache[CacheEntry.gen_key(label, scope)]
+		if not cls._index_remove(CacheEntry.gen_key(label, scope)):
+			raise KeyError((scope, label))
 		system.util.getLogger('ExtraGlobal').trace('Trashed (scope:%r, label:%r) from %r' % (scope, label, Thread.currentThread()))
 		cls.spawn_cache_monitor()
+
+
+	def trash_scope(cls, scope):
+		"""Remove everything in the scope from the cache. Returns how many were removed."""
+		removed = 0
+		for label in list(cls._scoped_labels.get(scope, ())):
+			if cls._index_remove(CacheEntry.gen_key(label, scope)):
+				removed += 1
+		system.util.getLogger('ExtraGlobal').trace('Trashed %d from scope %r from %r' % (removed, scope, Thread.currentThread()))
+		return removed
 	
 
 	# Cache entry helpers
@@ -459,7 +829,642 @@ class MetaExtraGlobal(type):
 		cache_entry.extend(additional_time)
 
 
-	# Scope tracking for easier filtering
+	# Indexing - every change to the _cache goes through these
+
+	def _index_add(cls, cache_entry):
+		"""Put the entry in the cache, tracking its scope and scheduling its expiration."""
+		scope = cache_entry.scope
+		cls._index_lock.acquire()
+		try:
+			replaced = cls._cache.get(cache_entry.key)
+			cls._cache[cache_entry.key] = cache_entry
+			cls._scope_track(cache_entry.label, scope)
+			cls._scope_bytes[scope] = (cls._scope_bytes.get(scope, 0) + cache_entry.size
+									   - (replaced.size if replaced else 0))
+			cls._schedule(cache_entry)
+		finally:
+			cls._index_lock.release()
+
+	def _index_remove(cls, key):
+		"""Take the key out of the cache and the scope index. Returns the entry removed, if any."""
+		cls._index_lock.acquire()
+		try:
+			cache_entry = cls._cache.pop(key, None)
+			if cache_entry is not None:
+				scope = cache_entry.scope
+				cls._scope_untrack(cache_entry.label, scope)
+				if scope in cls._scoped_labels:
+					cls._scope_bytes[scope] = cls._scope_bytes.get(scope, 0) - cache_entry.size
+				else:
+					cls._scope_bytes.pop(scope, None)
+			# Its item on the expiration heap is now stale, and skipped when it comes up
+			cls._scheduled.pop(key, None)
+			return cache_entry
+		finally:
+			cls._index_lock.release()
+
+	def _schedule(cls, cache_entry, when=None):
+		"""(Re)schedule the entry's expiration check for when it's next due (or when given).
+		Wakes the monitor if this is now the first thing it needs to do.
+
+		Each key has at most one live item on the heap. If it's already set to come up 
+		  no later than this, nothing is pushed - when it comes up, an entry that isn't 
+		  due yet is simply put back for its new time.
+		"""
+		if when is None:
+			when = cache_entry.refresh_time
+		key = cache_entry.key
+		cls._index_lock.acquire()
+		try:
+			scheduled = cls._scheduled.get(key)
+			if scheduled is not None and scheduled <= when:
+				return
+			cls._scheduled[key] = when
+			expirations = cls._expirations
+			heappush(expirations, (when, key))
+			if len(expirations) > 2 * len(cls._scheduled) + cls._EXPIRATIONS_SLACK:
+				cls._compact_expirations()
+			if expirations[0][0] == when:
+				cls._schedule_changed.notifyAll()
+		finally:
+			cls._index_lock.release()
+
+	def _compact_expirations(cls):
+		"""Rebuild the expiration heap from just the live items. (Call with the _index_lock held.)"""
+		expirations = cls._expirations
+		expirations[:] = [(when, key) for key, when in cls._scheduled.items()]
+		heapify(expirations)
+
+	def _wait_for_due(cls, max_wait):
+		"""Sleep until the next entry is due (or something sooner is scheduled), up to max_wait seconds."""
+		cls._index_lock.acquire()
+		try:
+			next_due = cls.next_due
+			if next_due is None:
+				delay = max_wait
+			else:
+				delay = min(max_wait, next_due - time())
+			if delay > 0:
+				cls._schedule_changed.wait(delay)
+		finally:
+			cls._index_lock.release()
+
+	def _due_entries(cls, now=None):
+		"""Take the entries that are due off the expiration heap, soonest first.
+
+		Entries used or refreshed since they were scheduled are put back 
+		  for their new due time instead.
+		"""
+		if now is None:
+			now = time()
+		due = []
+		cls._index_lock.acquire()
+		try:
+			expirations = cls._expirations
+			scheduled = cls._scheduled
+			while expirations and expirations[0][0] <= now:
+				when, key = heappop(expirations)
+				if scheduled.get(key) != when:
+					continue # stale - superseded or removed since
+				del scheduled[key]
+				cache_entry = cls._cache.get(key)
+				if cache_entry is None:
+					continue
+				if cache_entry.refresh_time > now:
+					scheduled[key] = cache_entry.refresh_time
+					heappush(expirations, (cache_entry.refresh_time, key))
+					continue
+				due.append(cache_entry)
+		finally:
+			cls._index_lock.release()
+		return due
+
+	@property
+	def next_due(cls):
+		"""When the next entry may be due (or None if nothing's scheduled)."""
+		try:
+			return cls._expirations[0][0]
+		except IndexError:
+			return None
+
+	# Capacity
+
+	def set_capacity(cls, scope=None, max_entries=None, max_bytes=None, everything=False):
+		"""Limit how many entries (and roughly how many bytes) a scope can hold.
+		With everything=True, limit the whole cache instead. (None for no limit.)
+		"""
+		if everything:
+			cls.MAX_ENTRIES = max_entries
+			cls.MAX_BYTES = max_bytes
+			scope = None
+		else:
+			for limits, limit in ((cls.SCOPE_MAX_ENTRIES, max_entries), (cls.SCOPE_MAX_BYTES, max_bytes)):
+				if limit is None:
+					limits.pop(scope, None)
+				else:
+					limits[scope] = limit
+		cls._enforce_capacity(scope)
+
+	def set_sizer(cls, sizer=None):
+		"""Replace how objects are sized (a function of the object, returning bytes).
+		None restores the default, estimate_size."""
+		cls._sizer[0] = sizer or estimate_size
+
+	def add_eviction_callback(cls, callback):
+		"""Call callback(label, scope, obj) whenever an entry is evicted to stay within capacity."""
+		cls._eviction_callbacks.append(callback)
+
+	def remove_eviction_callback(cls, callback):
+		cls._eviction_callbacks.remove(callback)
+
+	def _measure(cls, obj):
+		try:
+			return int(cls._sizer[0](obj))
+		except Exception, error:
+			system.util.getLogger('ExtraGlobal').debug('Could not size %r: %r' % (type(obj), error))
+			return SIZE_OBJECT
+
+	def _resize(cls, cache_entry):
+		"""Re-measure an entry whose value changed, and make sure everything still fits."""
+		size = cls._measure(cache_entry._obj)
+		scope = cache_entry.scope
+		cls._index_lock.acquire()
+		try:
+			if cls._cache.get(cache_entry.key) is cache_entry:
+				cls._scope_bytes[scope] = cls._scope_bytes.get(scope, 0) + size - cache_entry.size
+			cache_entry.size = size
+		finally:
+			cls._index_lock.release()
+		cls._enforce_capacity(scope, keep=cache_entry.key)
+
+	@staticmethod
+	def _over_capacity(count, size, max_entries, max_bytes, fraction=1.0):
+		return ((max_entries is not None and count > max_entries * fraction) 
+			 or (max_bytes is not None and size > max_bytes * fraction))
+
+	def _enforce_capacity(cls, scope, keep=None):
+		"""Evict entries until the scope and the whole cache are within their limits.
+		The key in keep (usually the one just stashed) is never evicted.
+		"""
+		evicted = []
+		cls._index_lock.acquire()
+		try:
+			max_entries = cls.SCOPE_MAX_ENTRIES.get(scope)
+			max_bytes = cls.SCOPE_MAX_BYTES.get(scope)
+			count = len(cls._scoped_labels.get(scope, ()))
+			size = cls._scope_bytes.get(scope, 0)
+			if cls._over_capacity(count, size, max_entries, max_bytes):
+				keys = [CacheEntry.gen_key(label, scope) for label in cls._scoped_labels[scope]]
+				evicted += cls._evict(keys, count, size, max_entries, max_bytes, keep)
+
+			count = len(cls._cache)
+			size = sum(cls._scope_bytes.values())
+			if cls._over_capacity(count, size, cls.MAX_ENTRIES, cls.MAX_BYTES):
+				evicted += cls._evict(cls._cache.keys(), count, size, cls.MAX_ENTRIES, cls.MAX_BYTES, keep)
+		finally:
+			cls._index_lock.release()
+
+		for cache_entry in evicted:
+			system.util.getLogger('ExtraGlobal').trace('Evicted %r for capacity' % (cache_entry.key,))
+			for callback in cls._eviction_callbacks:
+				try:
+					callback(cache_entry.label, cache_entry.scope, cache_entry._obj)
+				except Exception, error:
+					system.util.getLogger('ExtraGlobal').warn('Eviction callback %r failed: %r' % (callback, error))
+
+	def _evict(cls, keys, count, size, max_entries, max_bytes, keep=None):
+		"""Remove entries from keys, least valuable first by the EVICTION_POLICY,
+		  until under EVICTION_TARGET of the limits. Returns the entries removed.
+
+		Only about as many as need to go are picked out (rather than sorting all the keys),
+		  going back for more if the ones picked were smaller than average.
+		"""
+		rank = cls._eviction_rank()
+		target = cls.EVICTION_TARGET
+
+		evicted = []
+		while cls._over_capacity(count, size, max_entries, max_bytes, target):
+			needed = 1
+			if max_entries is not None:
+				needed = max(needed, count - int(max_entries * target))
+			if max_bytes is not None and size > max_bytes * target:
+				needed = max(needed, int((size - max_bytes * target) * count / size) + 1)
+
+			candidates = []
+			for key in keys:
+				cache_entry = cls._cache.get(key)
+				if cache_entry is not None and key != keep:
+					candidates.append(cache_entry)
+			picked = nsmallest(needed, candidates, key=rank)
+			if not picked:
+				break
+
+			for cache_entry in picked:
+				if not cls._over_capacity(count, size, max_entries, max_bytes, target):
+					break
+				cls._index_remove(cache_entry.key)
+				count -= 1
+				size -= cache_entry.size
+				cls._evictions[cache_entry.scope] = cls._evictions.get(cache_entry.scope, 0) + 1
+				evicted.append(cache_entry)
+		return evicted
+
+	def _eviction_rank(cls):
+		"""How _evict orders entries (lowest goes first) for the EVICTION_POLICY."""
+		if cls.EVICTION_POLICY != 'lfu':
+			return lambda cache_entry: cache_entry.last_access
+
+		all_metrics = cls._metrics
+		def rank(cache_entry):
+			metrics = all_metrics.get(cache_entry.key)
+			if metrics is None:
+				return (0, cache_entry.last_access)
+			return (metrics.hits + metrics.fallbacks, cache_entry.last_access)
+		return rank
+
+	def _scope_stats(cls, scope):
+		return {
+			'entries': len(cls._scoped_labels.get(scope, ())),
+			'bytes': cls._scope_bytes.get(scope, 0),
+			'max_entries': cls.SCOPE_MAX_ENTRIES.get(scope),
+			'max_bytes': cls.SCOPE_MAX_BYTES.get(scope),
+			'evictions': cls._evictions.get(scope, 0),
+		}
+
+	def stats(cls):
+		"""How full the cache is, overall and for each scope (entries, estimated bytes, limits, evictions)."""
+		cls._index_lock.acquire()
+		try:
+			scopes = {}
+			for scope in cls._scoped_labels:
+				scopes[scope] = cls._scope_stats(scope)
+			return {
+				'entries': len(cls._cache),
+				'bytes': sum(cls._scope_bytes.values()),
+				'max_entries': cls.MAX_ENTRIES,
+				'max_bytes': cls.MAX_BYTES,
+				'evictions': sum(cls._evictions.values()),
+				'eviction_policy': cls.EVICTION_POLICY,
+				'scopes': scopes,
+			}
+		finally:
+			cls._index_lock.release()
+
+
+	# Metrics
+
+	def _key_metrics(cls, key):
+		metrics = cls._metrics.get(key)
+		if metrics is None:
+			cls._metrics_lock.acquire()
+			try:
+				metrics = cls._metrics.get(key)
+				if metrics is None:
+					if len(cls._metrics) >= cls.METRICS_MAX_KEYS:
+						cls._prune_metrics()
+					metrics = cls._metrics[key] = KeyMetrics()
+			finally:
+				cls._metrics_lock.release()
+		return metrics
+
+	def _prune_metrics(cls):
+		"""Drop metrics down to half of METRICS_MAX_KEYS, so pruning isn't needed again for a while.
+		Keys no longer cached go first, then the least recently hit. (Hold the _metrics_lock.)
+		"""
+		excess = len(cls._metrics) - cls.METRICS_MAX_KEYS // 2
+		if excess <= 0:
+			return
+		cache = cls._cache
+		for key, _ in nsmallest(excess, cls._metrics.iteritems(), 
+		                        key=lambda item: (item[0] in cache, item[1].last_hit)):
+			del cls._metrics[key]
+
+	def _record_miss(cls, key):
+		if cls.METRICS:
+			cls._key_metrics(key).misses += 1
+
+	def _record_refresh(cls, key, seconds, failed=False):
+		if not cls.METRICS:
+			return
+		metrics = cls._key_metrics(key)
+		metrics.refreshes += 1
+		if failed:
+			metrics.refresh_failures += 1
+		metrics.refresh_seconds += seconds
+		if seconds > metrics.refresh_max:
+			metrics.refresh_max = seconds
+
+	def reset_metrics(cls):
+		cls._metrics_lock.acquire()
+		try:
+			cls._metrics.clear()
+		finally:
+			cls._metrics_lock.release()
+
+	def key_metrics(cls, scope=None):
+		"""Metrics for every key tracked (or just those in the scope), most hit first.
+		Each is a dict with KeyMetrics.COLUMNS as keys."""
+		cls._metrics_lock.acquire()
+		try:
+			tracked = cls._metrics.items()
+		finally:
+			cls._metrics_lock.release()
+		rows = [metrics.row(key, key in cls._cache)
+				for key, metrics in tracked
+				if scope is None or key[0] == scope]
+		rows.sort(key=lambda row: (row['hits'] + row['fallbacks'], row['misses']), reverse=True)
+		return rows
+
+	def hot_keys(cls, limit=10, scope=None):
+		"""The most used keys."""
+		return cls.key_metrics(scope)[:limit]
+
+	def cold_keys(cls, limit=10, scope=None):
+		"""The least used keys still in the cache (the ones holding memory for little benefit)."""
+		rows = []
+		for key, cache_entry in cls._cache.items():
+			if scope is not None and key[0] != scope:
+				continue
+			metrics = cls._metrics.get(key) or KeyMetrics()
+			row = metrics.row(key, True)
+			row['last_hit'] = metrics.last_hit or cache_entry.last_access
+			rows.append(row)
+		rows.sort(key=lambda row: (row['hits'] + row['fallbacks'], row['last_hit']))
+		return rows[:limit]
+
+	def metrics_dataset(cls, rows=None):
+		"""Metrics as a dataset (for a diagnostics table, say). 
+		Defaults to all the key_metrics, but give it hot_keys() or cold_keys() to narrow it down."""
+		if rows is None:
+			rows = cls.key_metrics()
+		data = []
+		for row in rows:
+			row = dict(row)
+			for column in ('scope', 'label'):
+				if row[column] is None:
+					row[column] = ''
+				elif not isinstance(row[column], basestring):
+					row[column] = repr(row[column])
+			if row['last_hit'] is not None:
+				row['last_hit'] = Date(long(row['last_hit'] * 1000))
+			data.append([row[column] for column in KeyMetrics.COLUMNS])
+		return system.dataset.toDataSet(list(KeyMetrics.COLUMNS), data)
+
+
+	# Persistence
+
+	def enable_persistence(cls, path, period=None):
+		"""Save the cache to path every PERSIST_PERIOD seconds, and load what's there now.
+		Returns how many entries were restored.
+
+		Only entries that can be pickled are saved (datasets are saved as their rows),
+		  within PERSIST_MAX_ENTRY_BYTES and PERSIST_MAX_BYTES of their estimated sizes.
+		  Callbacks are saved by their module path, so only module level functions
+		  survive a restart - other entries come back without one and simply expire.
+
+		Loading a snapshot unpickles it, which can run any code written into it. So the
+		  file is only restored if it's owned by the user the gateway runs as, and (where
+		  there are POSIX permissions) no one else can write to it. Snapshots are written 
+		  readable by their owner alone. Keep the path in a directory that's the gateway's, too.
+		"""
+		cls.PERSIST_PATH = path
+		if period is not None:
+			cls.PERSIST_PERIOD = period
+		cls._persist_state['next'] = time() + cls.PERSIST_PERIOD
+		restored = cls.restore(path)
+		if restored:
+			cls.spawn_cache_monitor()
+		return restored
+
+	def disable_persistence(cls):
+		cls.PERSIST_PATH = None
+
+	def _snapshot_entry(cls, cache_entry, now):
+		"""The entry as a pickled record, or None if it can't (or needn't) be saved."""
+		obj = cache_entry._obj
+		if obj is None:
+			return None
+		remaining = cache_entry.lifespan - (now - cache_entry.last_time)
+		if remaining <= 0 and not cache_entry.callback:
+			return None
+		record = {
+			'label': cache_entry.label,
+			'scope': cache_entry.scope,
+			'lifespan': cache_entry.lifespan,
+			'remaining': remaining,
+			'callback': _callback_path(cache_entry.callback) if cache_entry.callback else None,
+			'grace': cache_entry.grace,
+			'refresh_ahead': cache_entry.refresh_ahead,
+		}
+		try:
+			record['value'] = _freeze(obj)
+			return pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+		except:
+			return None
+
+	def persist(cls, path=None):
+		"""Write what can be saved of the cache to path (PERSIST_PATH by default).
+		Returns how many entries were written. (If none can be, nothing is written.)"""
+		path = path or cls.PERSIST_PATH
+		now = time()
+		max_entry_bytes = cls.PERSIST_MAX_ENTRY_BYTES
+		budget = cls.PERSIST_MAX_BYTES
+		records = []
+		cache_entries = sorted(cls._cache.values(), key=lambda cache_entry: cache_entry.last_access, reverse=True)
+		for cache_entry in cache_entries:
+			if max_entry_bytes is not None and cache_entry.size > max_entry_bytes:
+				continue
+			if budget is not None and cache_entry.size > budget:
+				continue
+			record = cls._snapshot_entry(cache_entry, now)
+			if record is not None:
+				records.append(record)
+				if budget is not None:
+					budget -= cache_entry.size
+
+		if not records:
+			system.util.getLogger('ExtraGlobal').debug('Nothing of %d entries to persist to %r' % (len(cache_entries), path))
+			return 0
+
+		# Write alongside, then swap it in, so a crash mid-write doesn't lose the last snapshot.
+		# Whatever is at the temp path is cleared out first (a link itself, not what it points to)
+		#   so the file written is a new one that was private from the start.
+		temp_path = path + '.tmp'
+		Files.deleteIfExists(File(temp_path).toPath())
+		_create_private(temp_path)
+		snapshot_file = open(temp_path, 'wb')
+		try:
+			pickle.dump({'version': PERSIST_VERSION, 'saved': now, 'entries': records}, 
+						snapshot_file, pickle.HIGHEST_PROTOCOL)
+		finally:
+			snapshot_file.close()
+		Files.move(File(temp_path).toPath(), File(path).toPath(), StandardCopyOption.REPLACE_EXISTING)
+
+		system.util.getLogger('ExtraGlobal').debug('Persisted %d of %d entries to %r' % (len(records), len(cls._cache), path))
+		return len(records)
+
+	def _persist_in_background(cls):
+		"""Persist on another thread, unless a snapshot is already being written."""
+		cls._persist_state['next'] = time() + cls.PERSIST_PERIOD
+		writer = cls._persist_state['thread']
+		if writer and writer.getState() != Thread.State.TERMINATED:
+			return
+
+		@async(name=cls.PERSIST_THREAD_NAME)
+		def persist_snapshot(cls=cls):
+			try:
+				cls.persist()
+			except:
+				system.util.getLogger('ExtraGlobal').warn('Could not persist to %r: %r' % (cls.PERSIST_PATH, sys.exc_info()[1]))
+
+		cls._persist_state['thread'] = persist_snapshot()
+
+	def restore(cls, path=None):
+		"""Load entries written by persist back into the cache. Returns how many were restored.
+
+		Keys already in the cache are left alone. Time spent down counts against
+		  what was left of each entry's lifespan: those without a callback that 
+		  would have expired are skipped, and those with one are refreshed soon after.
+
+		The file is refused unless the gateway's user owns it and no one else can 
+		  write to it (see enable_persistence).
+		"""
+		path = path or cls.PERSIST_PATH
+		if not path or not os.path.exists(path):
+			return 0
+		if not _trusted_snapshot(path):
+			system.util.getLogger('ExtraGlobal').warn('Not restoring from %r: it must be owned by %r and writable by no one else' 
+			                                          % (path, System.getProperty('user.name')))
+			return 0
+
+		snapshot_file = open(path, 'rb')
+		try:
+			snapshot = pickle.load(snapshot_file)
+		finally:
+			snapshot_file.close()
+		if snapshot.get('version') != PERSIST_VERSION:
+			return 0
+
+		downtime = max(0, time() - snapshot['saved'])
+		restored = 0
+		for record in snapshot['entries']:
+			try:
+				record = pickle.loads(record)
+				obj = _thaw(record['value'])
+			except:
+				continue
+
+			label, scope = record['label'], record['scope']
+			if CacheEntry.gen_key(label, scope) in cls._cache:
+				continue
+
+			callback = None
+			if record['callback']:
+				callback = _resolve_callback(record['callback'])
+			remaining = record['remaining'] - downtime
+			if remaining <= 0:
+				if not callback:
+					continue
+				remaining = random() * cls.PERSIST_RESTORE_SPREAD
+
+			lifespan = record['lifespan']
+			cls.stash(obj, label, scope, lifespan, callback, record['grace'], record['refresh_ahead'])
+			cache_entry = cls._cache.get(CacheEntry.gen_key(label, scope))
+			if cache_entry is not None and remaining < lifespan:
+				cache_entry.extend(remaining - lifespan)
+			restored += 1
+
+		system.util.getLogger('ExtraGlobal').debug('Restored %d entries from %r' % (restored, path))
+		return restored
+
+
+	# Expiration and refresh
+
+	def _check_expiration(cls, cache_entry):
+		"""Cull the entry if its time is up, otherwise schedule its next check.
+		(Remember, the entry will refresh itself if it can, referencing the new entry if needed.)
+		"""
+		try:
+			if cache_entry.expired:
+				cls._index_remove(cache_entry.key)
+			elif cls._cache.get(cache_entry.key) is cache_entry:
+				cls._schedule(cache_entry)
+		except:
+			cls._index_remove(cache_entry.key)
+
+	def _single_flight(cls, key, compute):
+		"""Run compute for the key - unless another thread already is, 
+		  in which case wait for it and return (or raise) what it did.
+		"""
+		flight = _Flight()
+		leader = cls._flights.setdefault(key, flight)
+		if leader is not flight:
+			return leader.outcome()
+		try:
+			try:
+				flight.result = compute()
+			except:
+				flight.error = sys.exc_info()
+				raise
+			return flight.result
+		finally:
+			cls._flights.pop(key, None)
+			flight.done.set()
+
+	def _dispatch_refresh(cls, cache_entry):
+		"""Hand the entry to the refresh workers. Returns False if they're too backed up to take it."""
+		key = cache_entry.key
+		# Already on its way - the worker will reschedule it when it's done
+		if cls._refreshing.setdefault(key, cache_entry) is not cache_entry:
+			return True
+		if not cls._refresh_queue.offer(cache_entry):
+			cls._refreshing.pop(key, None)
+			return False
+		cls.spawn_refresh_worker()
+		return True
+
+	def spawn_refresh_worker(cls):
+		"""Spin up another refresh worker, if there's work and fewer than REFRESH_WORKERS.
+
+		Workers take entries off the queue and check them (running the callback),
+		  closing once they've waited REFRESH_WORKER_IDLE seconds with nothing to do.
+		"""
+		cls._index_lock.acquire()
+		try:
+			workers = cls._refresh_workers
+			workers[:] = [worker for worker in workers 
+			              if worker.getState() != Thread.State.TERMINATED]
+			if len(workers) >= cls.REFRESH_WORKERS or cls._refresh_queue.isEmpty():
+				return
+			workers.append(cls._start_refresh_worker())
+		finally:
+			cls._index_lock.release()
+
+	def _start_refresh_worker(cls):
+		"""Start a refresh worker thread (see spawn_refresh_worker)."""
+		@async(name='%s-%d' % (cls.REFRESH_THREAD_NAME, cls._refresh_worker_ids.next()))
+		def refresh_worker(cls=cls):
+			queue = cls._refresh_queue
+			while True:
+				cache_entry = queue.poll(long(cls.REFRESH_WORKER_IDLE * 1000), TimeUnit.MILLISECONDS)
+				if cache_entry is None:
+					return
+				try:
+					# Refresh if it's (nearly) due and no one else is already, then see where that left it
+					cache_entry.refresh(wait=False, force=False)
+					current = cls._cache.get(cache_entry.key)
+					if current is cache_entry:
+						cls._check_expiration(cache_entry)
+					# The callback stashed a new entry itself, so that's the one to follow now
+					#   (checking the old one would only find it expired and refresh again)
+					elif current is not None:
+						cls._schedule(current)
+				finally:
+					if cls._refreshing.get(cache_entry.key) is cache_entry:
+						cls._refreshing.pop(cache_entry.key, None)
+
+		return refresh_worker()
+
 
 	def _scope_track(cls, label, scope):
 		"""Add the reference label to the scope, creating the scope if needed."""
@@ -470,12 +1475,12 @@ class MetaExtraGlobal(type):
 
 	def _scope_untrack(cls, label, scope):
 		"""Ensure a label is not in a scope, also purge the scope if it is empty."""
-		if not scope in cls._scoped_labels:
+		labels = cls._scoped_labels.get(scope)
+		if labels is None:
 			return
-		elif len(cls._scoped_labels[scope]) <= 1:
+		labels.discard(label)
+		if not labels:
 			del cls._scoped_labels[scope]
-		elif label in cls._scoped_labels[scope]:
-			cls._scoped_labels[scope].remove(label)
 
 
 	@classmethod
@@ -533,8 +1538,8 @@ class MetaExtraGlobal(type):
 
 
 	def spawn_cache_monitor(cls):
-		"""Spin up (if needed) a thread to monitor the cache. Checks all cache entries
-		  every CHECK_PERIOD seconds.
+		"""Spin up (if needed) a thread to monitor the cache. Sleeps until the next
+		  cache entry is due (checking in every RELEVANCE_CHECK_PERIOD seconds).
 
 		If there's already a thread (that's not dead) then don't bother.
 		If the thread that was watching is dead for some reason, replace it.
@@ -544,10 +1549,10 @@ class MetaExtraGlobal(type):
 		 - the class' _CLEANUP_MONITOR no longer references the monitoring script
 		 - the cache is empty
 		
-		Once started, the monitor will scan all objects in the cache to determine
-		  if they should be culled. If their time is up, an attempt will be made
-		  to refresh it. If the refresh brought the object back, then it will be skipped.
-		  Otherwise the cache entry will be trashed.
+		Once started, the monitor will check the objects in the cache as they come due
+		  to determine if they should be culled. If their time is up and they have a callback,
+		  they're handed to the refresh workers. If the refresh brought the object back, 
+		  then it will be rescheduled. Otherwise the cache entry will be trashed.
 		"""
 		cls.verify_holding_thread()
 		
@@ -565,38 +1570,38 @@ class MetaExtraGlobal(type):
 			thisThread = Thread.currentThread()
 			
 			while True:
-				# Wait for CHECK_PERIOD, but check occasionally if the monitor
-				# should be replaced. (Once scan starts, thread won't die until it's done.)
-				for iterNum,lastStepTime in EveryFixedDelay(cls.CHECK_PERIOD, cls.RELEVANCE_CHECK_PERIOD):
-					# die if disconnected reference or unneeded
-					if cls._CLEANUP_MONITOR is None:
-						system.util.getLogger('ExtraGlobal').debug('Closing monitor thread %r: CLEANUP MONITOR detected as None' % thisThread)
-						return
-					# die if another monitor has somehow been spun up instead
-					elif cls._CLEANUP_MONITOR != thisThread:
-						system.util.getLogger('ExtraGlobal').debug('Closing monitor thread %r: CLEANUP MONITOR detected as Changed' % thisThread)
-						return
-					# die gracefully if not needed
-					elif not cls._cache:
-						cls._CLEANUP_MONITOR = None
-						system.util.getLogger('ExtraGlobal').debug('Closing monitor thread %r: Cache is empty. Gracefully closing cache.' % thisThread)
-						return
-
-				# Scan the cache, removing entries as needed.
-				for key in frozenset(cls._cache):
-					try:
-						entry = cls._cache[key]
-					except KeyError:
-						continue # the key has been deleted mid-scan
-					
-					# Check if the entry is expired
-					# (remember, the entry will refresh itself if it can, referencing the new entry if needed)
-					try:
-						if entry.expired:
-							cls.trash(entry.label, entry.scope)
-					except:
-						del cls._cache[key]
-						cls._scope_untrack(entry.label, entry.scope)
+				# Sleep until something is due, but check occasionally if the monitor
+				# should be replaced. (Once a check starts, thread won't die until it's done.)
+				cls._wait_for_due(cls.RELEVANCE_CHECK_PERIOD)
+
+				# die if disconnected reference or unneeded
+				if cls._CLEANUP_MONITOR is None:
+					system.util.getLogger('ExtraGlobal').debug('Closing monitor thread %r: CLEANUP MONITOR detected as None' % thisThread)
+					return
+				# die if another monitor has somehow been spun up instead
+				elif cls._CLEANUP_MONITOR != thisThread:
+					system.util.getLogger('ExtraGlobal').debug('Closing monitor thread %r: CLEANUP MONITOR detected as Changed' % thisThread)
+					return
+				# die gracefully if not needed
+				elif not cls._cache:
+					cls._CLEANUP_MONITOR = None
+					system.util.getLogger('ExtraGlobal').debug('Closing monitor thread %r: Cache is empty. Gracefully closing cache.' % thisThread)
+					return
+
+				# Check just the entries that have come due.
+				# Anything with a callback goes to the refresh workers, so the monitor never waits on one.
+				for entry in cls._due_entries():
+					if entry.callback:
+						if not cls._dispatch_refresh(entry):
+							cls._schedule(entry, time() + cls.REFRESH_RETRY_DELAY)
+					else:
+						cls._check_expiration(entry)
+
+				# Make sure nothing's left queued if a worker closed just as work came in
+				cls.spawn_refresh_worker()
+
+				if cls.PERSIST_PATH and time() >= cls._persist_state['next']:
+					cls._persist_in_background()
 						
 		cls._CLEANUP_MONITOR = monitor()
 
@@ -641,28 +1646,47 @@ class MetaExtraGlobal(type):
 		if key in cls._cache:
 			return cls.access(label, scope)
 		else:
+			cls._record_miss(key)
 			return default
 
-	def setdefault(cls, label, scope=None, default=None, lifespan=None, callback=None):
-		"""Return a value without a KeyError, adding default if key was missing. (Like a dict)"""
+	def setdefault(cls, label, scope=None, default=None, lifespan=None, callback=None, grace=None, refresh_ahead=None):
+		"""Return a value without a KeyError, adding default if key was missing. (Like a dict)
+
+		If there's no default but there is a callback, the callback makes the first value.
+		  Only one thread runs it: others asking for the same key meanwhile wait for its result.
+		"""
 		key = CacheEntry.gen_key(label, scope)
 		if key in cls._cache:
 			return cls.access(label, scope)
+
+		cls._record_miss(key)
+		if default is None and callback is not None:
+			def compute_default(cls=cls):
+				# Another thread may have just finished with it
+				if key in cls._cache:
+					return cls.access(label, scope)
+				value = callback()
+				if value is not None:
+					cls.stash(value, label, scope, lifespan, callback, grace, refresh_ahead)
+				return value
+			return cls._single_flight(key, compute_default)
 		else:
-			cls.stash(default, label, scope, lifespan, callback)
+			cls.stash(default, label, scope, lifespan, callback, grace, refresh_ahead)
 			return default
 
 
 	def keys(cls, scope=None):
-		"""Currently available keys in the cache. (Like a dict, but sorted)"""
+		"""Currently available keys in the cache. (Like a dict, but sorted)
+		Given a scope, just the labels in that scope."""
 		if scope:
-			try:
-				return sorted(cls._scoped_labels[scope])
-			except KeyError:
-				return []
+			return sorted(cls._scoped_labels.get(scope, ()))
 		else:
 			return sorted(cls._cache.keys())
 
+	def scopes(cls):
+		"""The scopes that currently have something in the cache."""
+		return sorted(cls._scoped_labels)
+
 	def iterkeys(cls, scope=None):
 		"""Currently available keys in the cache. (Like a dict)"""
 		return iter(cls.keys(scope))
@@ -746,6 +1770,96 @@ class ExtraGlobal(MetaSingleton):
 	__metaclass__ = ExtraMetaExtraGlobal.GLOBAL_REFERENCE
 
 
+def extra_global_memoize(scope=None, lifespan=None, max_entries=None):
+	"""Decorate a function to keep its results in ExtraGlobal, keyed by its arguments.
+
+	Each function's results get a scope of their own: the function's module and name,
+	  or with a scope given, that and the function's name ('<scope>.<name>').
+	  Results are labeled by their arguments, so the arguments must be hashable - calls 
+	  with any that aren't simply run the function uncached.
+	  (And since ExtraGlobal doesn't hold None, calls that return None aren't cached either.)
+
+	If max_entries is set, it's the capacity of the function's scope (see set_capacity),
+	  so past that results are evicted by the cache's EVICTION_POLICY - least recently 
+	  used, by default. Being the cache's own limit, it keeps up with results that expire
+	  and holds across reloads of the decorated function's module.
+	If several threads ask for the same result at once, only one runs the function.
+
+	The decorated function gets cache_info() for its hits, misses, entries, and evictions,
+	  and cache_clear() to trash all its results.
+
+	>>> @extra_global_memoize(lifespan=300, max_entries=50)
+	... def line_recipe(line_name):
+	...     return system.db.runNamedQuery('Recipes/ForLine', {'line': line_name})
+	"""
+	def decorator(function):
+		memo_scope = '%s.%s' % (scope or function.__module__, function.__name__)
+
+		if max_entries:
+			ExtraGlobal.set_capacity(memo_scope, max_entries, ExtraGlobal.SCOPE_MAX_BYTES.get(memo_scope))
+
+		counters = {'hits': 0, 'misses': 0, 'uncacheable': 0}
+		lock = Lock()
+
+		def tally(counter):
+			lock.acquire()
+			try:
+				counters[counter] += 1
+			finally:
+				lock.release()
+
+		@wraps(function)
+		def memoized(*args, **kwargs):
+			label = (args, tuple(sorted(kwargs.items())))
+			try:
+				hash(label)
+			except TypeError:
+				tally('uncacheable')
+				return function(*args, **kwargs)
+
+			value = ExtraGlobal.get(label, memo_scope)
+			if value is None:
+				computed = []
+				def compute():
+					# Another thread may have just finished with it
+					result = ExtraGlobal.get(label, memo_scope)
+					if result is None:
+						computed.append(True)
+						result = function(*args, **kwargs)
+						if result is not None:
+							ExtraGlobal.stash(result, label, memo_scope, lifespan)
+					return result
+				value = ExtraGlobal._single_flight(CacheEntry.gen_key(label, memo_scope), compute)
+				tally('misses' if computed else 'hits')
+			else:
+				tally('hits')
+
+			return value
+
+		def cache_info():
+			"""Counters for the memoized function, and how many of its results are cached now."""
+			lock.acquire()
+			try:
+				info = dict(counters)
+			finally:
+				lock.release()
+			scope_stats = ExtraGlobal._scope_stats(memo_scope)
+			info['entries'] = scope_stats['entries']
+			info['evictions'] = scope_stats['evictions']
+			info['max_entries'] = scope_stats['max_entries']
+			info['scope'] = memo_scope
+			return info
+
+		def cache_clear():
+			"""Trash all the function's cached results."""
+			ExtraGlobal.trash_scope(memo_scope)
+
+		memoized.cache_info = cache_info
+		memoized.cache_clear = cache_clear
+		return memoized
+	return decorator
+
+
 ##==========================================================================
 ## Global access, in case class access is undesired
 ##==========================================================================
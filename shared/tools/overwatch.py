@@ -5,6 +5,7 @@
 
 
 import sys
+from functools import partial
 
 
 __copyright__ = """Copyright (C) 2020 Corso Systems"""
@@ -123,4 +124,273 @@ class Overwatch(BlindOverwatch):
 		if self._callbacks:
 			return self.dispatch
 		else:
-			self._callback_function(self._previous_callback)
\ No newline at end of file
+			self._callback_function(self._previous_callback)
+
+
+
+class _RoutedSys(object):
+	"""Stands in for a consumer's `sys` while it's subscribed to a TraceMultiplexer.
+
+	Its settrace calls go to the multiplexer, and everything else goes on
+	  to the real one (like a Tracer's hijacked sys).
+	"""
+	__slots__ = ('_sys', '_settrace')
+
+	def __init__(self, sys, settrace):
+		self._sys = sys
+		self._settrace = settrace
+
+	def settrace(self, tracefunc=None):
+		self._settrace(tracefunc)
+
+	def __getattr__(self, attribute):
+		return getattr(self._sys, attribute)
+
+
+class _FrameDispatch(object):
+	"""The local trace function for one frame, holding just the consumers that are tracing it."""
+	__slots__ = ('multiplexer', 'tracers')
+
+	def __init__(self, multiplexer, tracers):
+		self.multiplexer = multiplexer
+		self.tracers = tracers # [(id(consumer), events, local trace function)]
+
+	def dispatch(self, frame, event, arg):
+		multiplexer = self.multiplexer
+		if not multiplexer._installed:
+			return None
+
+		if self.tracers:
+			consumers = multiplexer._consumers
+			tracers = []
+			for key, events, trace in self.tracers:
+				if key not in consumers:
+					continue
+				if event in events:
+					# Like any local trace function, returning None stops it for this frame
+					trace = trace(frame, event, arg)
+					if trace is None:
+						continue
+				tracers.append((key, events, trace))
+			self.tracers = tracers
+
+		for consumer, handler in multiplexer._event_handlers.get(event, ()):
+			if handler(frame, arg) is None:
+				multiplexer._drop_handler(consumer, event)
+
+		if self.tracers or multiplexer._local_handlers:
+			return self.dispatch
+		return None
+
+
+class TraceMultiplexer(object):
+	"""Share one trace hook between several consumers.
+
+	Consumers can be Overwatch instances, anything else with a `dispatch`
+	  trace function (like Trap or the Tracer), or plain trace functions.
+	  Subscribers are sorted by event when they're added, so each event 
+	  only reaches the consumers that handle it, at the cost of one lookup
+	  - not one trace hook (and one dispatch) per consumer.
+
+	Plain Overwatch event handlers are called directly, skipping its own
+	  dispatch. As with Overwatch, a handler returning None drops out.
+
+	Trace functions get the 'call' event and, as with sys.settrace, what 
+	  they return is their local trace function for that frame. Each frame
+	  keeps its own list of those, so a consumer that declined a frame
+	  (returned None) sees none of its local events. If every consumer
+	  declines (and no handlers want local events) the frame isn't traced
+	  locally at all. A consumer not subscribed to 'call' traces every frame.
+
+	While subscribed, a consumer's own settrace calls (its _callback_function,
+	  or its sys.settrace, like the Tracer's) are routed here: setting None 
+	  unsubscribes it, instead of clearing the shared hook for everyone, and
+	  anything else just makes sure the shared hook is still in place.
+
+		>>> multiplexer = TraceMultiplexer()
+		>>> multiplexer.subscribe(Trap())
+		>>> multiplexer.subscribe(some_trace_function, events=['call', 'line'])
+	"""
+	_event_labels = BlindOverwatch._event_labels
+	_local_events = frozenset(['line', 'return', 'exception'])
+
+	def __init__(self, settrace=None, gettrace=None):
+		if settrace is None:
+			settrace = sys.settrace
+			if gettrace is None and sys_current_trace is not NOP:
+				gettrace = sys_current_trace
+		self._settrace = settrace
+		self._gettrace = gettrace
+
+		self._consumers = {} # id(consumer) -> (consumer, trace function, events)
+		self._handlers = {}  # id(consumer) -> (consumer, {event: handler})
+
+		self._call_tracers = ()
+		self._every_frame = ()
+		self._event_handlers = {}
+		self._local_handlers = False
+
+		self._installed = False
+
+
+	@property
+	def consumers(self):
+		return ( [consumer for consumer, _, _ in self._consumers.values()] 
+			   + [consumer for consumer, _ in self._handlers.values()] )
+
+	@property
+	def installed(self):
+		"""True if the shared hook is in place. 
+		If it can be checked (sys.gettrace), this also catches it being replaced."""
+		if self._installed and self._gettrace is not None:
+			return self._gettrace() == self.dispatch
+		return self._installed
+
+
+	def subscribe(self, consumer, events=None):
+		"""Add a consumer, and (re)install the hook.
+
+		The hook is always set again here, since consumers like Overwatch 
+		  set their own when they're created.
+		"""
+		self.unsubscribe(consumer, uninstall=False)
+
+		configured = getattr(consumer, '_configured_events', None)
+		if events is None:
+			if configured:
+				events = set(event[1:] for event in configured)
+			else:
+				events = self._event_labels
+		events = frozenset(events)
+
+		# The multiplexer does the chaining now
+		if getattr(consumer, '_previous_callback', None) is not None:
+			consumer._previous_callback = None
+
+		if (    isinstance(consumer, Overwatch) 
+			and type(consumer).dispatch == Overwatch.dispatch):
+			handlers = dict((event, callback) 
+							for event, callback in getattr(consumer, '_callbacks', {}).items()
+							if event in events)
+			self._handlers[id(consumer)] = (consumer, handlers)
+		else:
+			trace = getattr(consumer, 'dispatch', consumer)
+			self._consumers[id(consumer)] = (consumer, trace, events)
+
+		self._route_settrace(consumer)
+
+		self._rebuild()
+		self.install(force=True)
+
+
+	def unsubscribe(self, consumer, uninstall=True):
+		"""Remove a consumer. Once none are left, the hook is removed too."""
+		self._consumers.pop(id(consumer), None) or self._handlers.pop(id(consumer), None)
+		self._unroute_settrace(consumer)
+		self._rebuild()
+		if uninstall and not self._consumers and not self._handlers:
+			self.uninstall()
+
+
+	def _route_settrace(self, consumer):
+		"""Send the consumer's own settrace calls here while it's subscribed."""
+		settrace = partial(self._consumer_settrace, consumer)
+
+		if hasattr(consumer, '_callback_function'):
+			try:
+				consumer._callback_function = settrace
+			except AttributeError:
+				pass # slotted - it'll have to be unsubscribed directly
+
+		consumer_sys = getattr(consumer, 'sys', None)
+		if consumer_sys is not None and hasattr(consumer_sys, 'settrace'):
+			try:
+				consumer.sys = _RoutedSys(consumer_sys, settrace)
+			except AttributeError:
+				pass
+
+	def _unroute_settrace(self, consumer):
+		if '_callback_function' in getattr(consumer, '__dict__', {}):
+			del consumer._callback_function
+		consumer_sys = getattr(consumer, 'sys', None)
+		if isinstance(consumer_sys, _RoutedSys):
+			consumer.sys = consumer_sys._sys
+
+
+	def _consumer_settrace(self, consumer, trace_function):
+		"""A subscribed consumer called settrace."""
+		if trace_function is None:
+			self.unsubscribe(consumer)
+			return
+		key = id(consumer)
+		if key in self._consumers:
+			consumer, trace, events = self._consumers[key]
+			if trace != trace_function:
+				self._consumers[key] = (consumer, trace_function, events)
+				self._rebuild()
+		self.install()
+
+
+	def _drop_handler(self, consumer, event):
+		_, handlers = self._handlers[id(consumer)]
+		handlers.pop(event, None)
+		if not handlers:
+			self.unsubscribe(consumer)
+		else:
+			self._rebuild()
+
+
+	def _rebuild(self):
+		"""Precompute who gets which event."""
+		call_tracers = []
+		every_frame = []
+		for consumer, trace, events in self._consumers.values():
+			local_events = events & self._local_events
+			if 'call' in events:
+				call_tracers.append((id(consumer), local_events, trace))
+			elif local_events:
+				every_frame.append((id(consumer), local_events, trace))
+
+		event_handlers = {}
+		for consumer, handlers in self._handlers.values():
+			for event, handler in handlers.items():
+				event_handlers[event] = event_handlers.get(event, ()) + ((consumer, handler),)
+
+		self._call_tracers = tuple(call_tracers)
+		self._every_frame = tuple(every_frame)
+		self._event_handlers = event_handlers
+		self._local_handlers = any(event in self._local_events for event in event_handlers)
+
+
+	def install(self, force=False):
+		"""Set the shared hook, unless it's known to be in place already."""
+		if force or not self.installed:
+			self._settrace(self.dispatch)
+			self._installed = True
+
+	def uninstall(self):
+		if self._installed:
+			self._settrace(None)
+			self._installed = False
+
+
+	def dispatch(self, frame, event, arg):
+		"""The shared hook. Each new frame gets its own local dispatch for
+		  just the consumers that want to trace it."""
+		tracers = list(self._every_frame)
+		if event == 'call':
+			for key, events, trace in self._call_tracers:
+				trace = trace(frame, event, arg)
+				if trace is not None:
+					tracers.append((key, events, trace))
+
+		for consumer, handler in self._event_handlers.get(event, ()):
+			if handler(frame, arg) is None:
+				self._drop_handler(consumer, event)
+
+		if not self._installed:
+			return None
+
+		if tracers or self._local_handlers:
+			return _FrameDispatch(self, tracers).dispatch
+		return None
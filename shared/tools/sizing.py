@@ -0,0 +1,103 @@
+"""
+	Rough memory estimates for Python (and a few Ignition) objects.
+
+	Meant to be fast, not exact. Large containers and datasets are sampled
+	  and the rest extrapolated, and the sample shrinks with each level of
+	  nesting so even big nested structures stay cheap to size.
+
+	The costs are ballpark figures for the JVM. Use the estimates to compare
+	  and to budget, not to account for every byte.
+
+		>>> estimate_size(None)
+		0
+		>>> estimate_size([1, 2, 3]) == estimate_size([4, 5, 6])
+		True
+		>>> estimate_size('x' * 100) > estimate_size('x')
+		True
+"""
+
+
+__copyright__ = """Copyright (C) 2020 Corso Systems"""
+__license__ = 'Apache 2.0'
+__maintainer__ = 'Andrew Geiger'
+__email__ = 'andrew.geiger@corsosystems.com'
+
+
+__all__ = ['estimate_size']
+
+
+# Rough costs on the JVM (in bytes)
+SIZE_OBJECT = 16
+SIZE_REFERENCE = 8
+# Items sized out of a container before extrapolating to the rest
+#   (this shrinks with each level of nesting)
+SIZE_SAMPLE = 100
+# Past this many levels, anything is charged a flat SIZE_OBJECT
+SIZE_MAX_DEPTH = 6
+
+
+def _estimate_items(items, count, depth, max_depth):
+	"""Size a sample of the items and extrapolate to count of them."""
+	sample_limit = max(1, SIZE_SAMPLE >> (2 * depth))
+	sampled = 0
+	sample_count = 0
+	for item in items:
+		if sample_count >= sample_limit:
+			break
+		sampled += estimate_size(item, depth + 1, max_depth)
+		sample_count += 1
+	if not sample_count:
+		return 0
+	return int(sampled * (float(count) / sample_count))
+
+
+def _is_dataset(obj):
+	# Duck typed, so this works outside of Ignition, too
+	return hasattr(obj, 'getRowCount') and hasattr(obj, 'getColumnCount') and hasattr(obj, 'getValueAt')
+
+
+def estimate_size(obj, depth=0, max_depth=SIZE_MAX_DEPTH):
+	"""Roughly estimate how many bytes obj holds onto.
+
+	Understands datasets (and PyDataSets), strings, numbers, and the usual
+	  containers. Anything else is sized by its __dict__, if it has one.
+	  The depth is how far down into containers this already is, and
+	  anything max_depth down is charged a flat object overhead.
+	"""
+	if obj is None or isinstance(obj, bool):
+		return 0
+	if isinstance(obj, (int, long, float)):
+		return SIZE_OBJECT + 8
+	if isinstance(obj, basestring):
+		return SIZE_OBJECT * 2 + 2 * len(obj)
+	if depth >= max_depth:
+		return SIZE_OBJECT
+
+	if hasattr(obj, 'getUnderlyingDataset'):
+		obj = obj.getUnderlyingDataset()
+	if _is_dataset(obj):
+		rows = obj.getRowCount()
+		columns = obj.getColumnCount()
+		size = SIZE_OBJECT + columns * (SIZE_OBJECT * 4)
+		sample_rows = min(rows, max(1, SIZE_SAMPLE // max(columns, 1)))
+		if sample_rows:
+			sampled = 0
+			for row in range(sample_rows):
+				for column in range(columns):
+					sampled += estimate_size(obj.getValueAt(row, column), depth + 1, max_depth)
+			size += int(sampled * (float(rows) / sample_rows))
+		return size + rows * columns * SIZE_REFERENCE
+
+	if isinstance(obj, dict):
+		count = len(obj)
+		return (SIZE_OBJECT + count * SIZE_REFERENCE * 3
+				+ _estimate_items(obj.iterkeys(), count, depth, max_depth)
+				+ _estimate_items(obj.itervalues(), count, depth, max_depth))
+	if isinstance(obj, (list, tuple, set, frozenset)):
+		count = len(obj)
+		return SIZE_OBJECT + count * SIZE_REFERENCE + _estimate_items(iter(obj), count, depth, max_depth)
+
+	state = getattr(obj, '__dict__', None)
+	if isinstance(state, dict):
+		return SIZE_OBJECT + estimate_size(state, depth + 1, max_depth)
+	return SIZE_OBJECT
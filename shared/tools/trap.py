@@ -50,34 +50,58 @@ __status__ = "Prototype"
 
 
 class Context(object):
-	
-	__slots__ = ('_locals', '_event', '_arg', 
+	"""The details of a trace event.
+
+	Locals are copied only when asked for, and only what's asked for: 
+	  get_local() copies just the one, while `local` copies them all.
+	  Anything that keeps a context past its event (like the history) 
+	  should materialize() it first, since the frame moves on.
+	"""
+	__slots__ = ('_frame', '_locals', '_all_copied', 
+				 '_event', '_arg', 
 				 '_caller', '_filename', '_line',
 				 '_local_unsafe')
 	
 	def __init__(self, frame, event, arg):
-		
-		local_copy = {}
-		local_unsafe = {}
-		for key,value in frame.f_locals.items():
-			try:
-				local_copy[key]   = deepcopy(value)
-				local_unsafe[key] = value
-			except:
-				local_copy[key] = NotImplemented
-				local_unsafe[key] = value
-				
-		self._locals   = local_copy
+		self._frame    = frame
+		self._locals   = {}
+		self._all_copied = False
+		self._local_unsafe = None
+
 		self._event    = event
 		self._arg      = arg
 		self._caller   = frame.f_code.co_name
 		self._filename = frame.f_code.co_filename
 		self._line     = frame.f_lineno
-		self._local_unsafe = local_unsafe
+
+	@staticmethod
+	def _clone(value):
+		try:
+			return deepcopy(value)
+		except:
+			return NotImplemented
+
+	def get_local(self, key):
+		"""Get a copy of just the one local. (KeyError if it isn't there.)"""
+		try:
+			return self._locals[key]
+		except KeyError:
+			copy = self._locals[key] = self._clone(self.unsafe[key])
+			return copy
+
+	def materialize(self):
+		"""Copy all the locals now, while the frame is still at this event."""
+		if not self._all_copied:
+			copies = self._locals
+			for key, value in self.unsafe.items():
+				if not key in copies:
+					copies[key] = self._clone(value)
+			self._all_copied = True
+		return self
 
 	@property
 	def local(self):
-		return self._locals
+		return self.materialize()._locals
 	
 	@property
 	def event(self):
@@ -97,6 +121,10 @@ class Context(object):
 
 	@property
 	def unsafe(self):
+		"""The locals themselves (not copies)."""
+		if self._local_unsafe is None:
+			self._local_unsafe = dict(self._frame.f_locals)
+			self._frame = None # no need to keep it alive any more
 		return self._local_unsafe
 	
 	@property
@@ -123,6 +151,103 @@ class TrapException(Exception):
 	pass
 
 
+class Trigger(object):
+	"""A trap function, worked out once for what it needs from a context.
+
+	The function's argument names are looked up in the event's locals
+	  (the name `context` gets the Context itself). If any are missing, 
+	  the trigger can't apply, and the function isn't called at all.
+
+	Triggers can be limited to a filename and/or caller (function name),
+	  so they're never even considered for other frames.
+	"""
+	__slots__ = ('function', 'expected_result', 'argument_names', 
+				 'filename', 'caller')
+
+	def __init__(self, function, expected_result=True, filename=None, caller=None):
+		self.function = function
+		self.expected_result = expected_result
+		self.filename = filename
+		self.caller = caller
+
+		bound = getattr(function, 'im_self', None) is not None
+		function = getattr(function, 'im_func', function)
+		try:
+			code = function.__code__
+		except AttributeError:
+			code = function.func_code
+
+		argument_names = code.co_varnames[:code.co_argcount]
+		if bound:
+			argument_names = argument_names[1:]
+		self.argument_names = tuple(argument_names)
+
+	@property
+	def scope(self):
+		return (self.filename, self.caller)
+
+	def bind(self, context):
+		"""The keyword arguments for the function, or None if the context can't supply them."""
+		local = context.unsafe
+		for name in self.argument_names:
+			if not (name in local or name == 'context'):
+				return None
+		return dict((name, context if name == 'context' else context.get_local(name))
+					for name in self.argument_names)
+
+	def check(self, context):
+		"""True if the function, given what it asked for, returns the expected result."""
+		arg_scope = self.bind(context)
+		if arg_scope is None:
+			return False
+		try:
+			return self.expected_result == self.function(**arg_scope)
+		except:
+			return False # fail by default
+
+	def __repr__(self):
+		return '<Trigger %r expecting %r>' % (self.function, self.expected_result)
+
+
+class TriggerMap(object):
+	"""A read-only view of a trap's trigger functions, mapped to what they're expected to return.
+	Change them with the trap's add_trigger and remove_trigger.
+	"""
+	__slots__ = ('_trap',)
+
+	def __init__(self, trap):
+		self._trap = trap
+
+	def items(self):
+		return [(trigger.function, trigger.expected_result) 
+				for triggers in self._trap._triggers.values()
+				for trigger in triggers]
+
+	def keys(self):
+		return [function for function, _ in self.items()]
+
+	def values(self):
+		return [expected_result for _, expected_result in self.items()]
+
+	def get(self, function, default=None):
+		return dict(self.items()).get(function, default)
+
+	def __getitem__(self, function):
+		return dict(self.items())[function]
+
+	def __contains__(self, function):
+		return function in self.keys()
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def __len__(self):
+		return len(self.items())
+
+	def __repr__(self):
+		return '<TriggerMap %r>' % dict(self.items())
+
+
 class MetaTrap(MetaOverwatch):
 	def __getitem__(cls, trap_ix):
 		return cls._cached_traps[trap_ix]
@@ -130,7 +255,8 @@ class MetaTrap(MetaOverwatch):
 class Trap(Overwatch):
 	__metaclass__ = MetaTrap
 
-	__slots__ = ('traps', 'disarmed', 'tripped',
+	__slots__ = ('disarmed', 'tripped',
+				 '_triggers', '_trigger_cache',
 				 '_prev_frames', 'max_buffered_frames',
 				 '_frame_cache_pattern', 'verbose')
 
@@ -168,7 +294,8 @@ class Trap(Overwatch):
 	def clear(self):
 		self.disarmed = False
 		self.tripped = False
-		self.traps = {}
+		self._triggers = {}
+		self._trigger_cache = {}
 		self._prev_frames = deque()
 
 	@classmethod
@@ -215,10 +342,16 @@ class Trap(Overwatch):
 			self._callback_function(None)
 			return None
 
+		# Nothing to record or check, so don't bother with a context
+		cache_frame = self.frame_cache_pattern.match(frame.f_code.co_filename)
+		if not (cache_frame or event == 'exception' 
+				or self.relevant_triggers(frame.f_code.co_filename, frame.f_code.co_name)):
+			return self.dispatch
+
 		# Capture history
 		context = Context(frame, event, arg)
-		if self.frame_cache_pattern.match(context.filename):
-			self._push_frame(context)
+		if cache_frame:
+			self._push_frame(context.materialize())
 			
 		# Captute the call, if anything (and ignore it)
 		self._cb_retval = self._callbacks.get(event,lambda f,a: None)(context)
@@ -281,7 +414,7 @@ class Trap(Overwatch):
 	# TRAP SPRINGS
 		
 	def check_traps(self, context):
-		if self.traps:
+		if self._triggers:
 			if self.trip_triggers(context):
 				if self.verbose:
 					print '+--! Tripping! Pausing execution for debugger...'
@@ -289,35 +422,69 @@ class Trap(Overwatch):
 				self.tripped = True
 				
 	def trip_triggers(self, context):
-		for function,expectation in self.traps.items():
-			try:
-				function_code = function.__code__
-			except AttributeError:
-				try:
-					function_code = function.func_code
-				except AttributeError:
-					function_code = function.im_code.func_code
-
-			kwargs = set(function_code.co_varnames)
-			
-			if kwargs <= (set(context.local)|set(['context'])):
-
-				arg_scope = dict((v,context.local[v] if v is not 'context' else context) for v in kwargs)
-	
-				try:
-					if expectation == function(**arg_scope):
-						return True
-				except:
-					pass # fail by default
-				
+		for trigger in self.relevant_triggers(context.filename, context.caller):
+			if trigger.check(context):
+				return True
 		return False
+
+	def relevant_triggers(self, filename, caller):
+		"""The triggers that could apply to a frame in filename running caller."""
+		try:
+			return self._trigger_cache[(filename, caller)]
+		except KeyError:
+			triggers = self._triggers
+			relevant = (  triggers.get((filename, caller), ())
+						+ triggers.get((filename, None), ())
+						+ triggers.get((None, caller), ())
+						+ triggers.get((None, None), ()) )
+			self._trigger_cache[(filename, caller)] = relevant
+			return relevant
 	
 	# SETUP
+
+	@property
+	def traps(self):
+		"""The trigger functions and what they're expected to return (read-only - see add_trigger)."""
+		return TriggerMap(self)
 	
-	def add_trigger(self, function, expected_result=True):
+	def add_trigger(self, function, expected_result=True, filename=None, caller=None):
+		"""Trip when function returns expected_result. 
+
+		The function's arguments are pulled by name from the frame's locals
+		  (or `context` for the whole Context). Give a filename and/or caller
+		  to only check frames running there.
+		"""
 		if self.verbose:
 			print '+    adding trap: %r against %r' % (function, expected_result)
-		self.traps[function] = expected_result
+
+		# Replacing a trap function, so drop what it was before
+		self._drop_trigger(function)
+
+		trigger = Trigger(function, expected_result, filename, caller)
+		self._triggers[trigger.scope] = self._triggers.get(trigger.scope, ()) + (trigger,)
+		self._trigger_cache = {}
+
+	def remove_trigger(self, function):
+		"""Stop checking the trap function. Returns True if it was a trigger."""
+		if self.verbose:
+			print '-    removing trap: %r' % (function,)
+		removed = self._drop_trigger(function)
+		self._trigger_cache = {}
+		return removed
+
+	def _drop_trigger(self, function):
+		removed = False
+		for scope, triggers in self._triggers.items():
+			kept = tuple(trigger for trigger in triggers 
+						 if trigger.function is not function)
+			if len(kept) == len(triggers):
+				continue
+			removed = True
+			if kept:
+				self._triggers[scope] = kept
+			else:
+				del self._triggers[scope]
+		return removed
 	
 	
 	# CONTEXT
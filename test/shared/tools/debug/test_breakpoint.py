@@ -0,0 +1,76 @@
+import unittest
+
+from shared.tools.debug.breakpoint import Breakpoint
+
+
+def sample_function():
+	x = 1
+	y = 2
+	return x + y
+
+
+class _RacingEnabled(object):
+	"""Stands in for a breakpoint's enabled map, changing the breakpoints mid-build."""
+	def values(self):
+		Breakpoint._invalidate_index()
+		return [False]
+
+class _RacingBreakpoint(object):
+	enabled = _RacingEnabled()
+
+
+class CodeIndexTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.code = sample_function.func_code
+		self.key = (self.code.co_filename, self.code.co_firstlineno)
+		self.party = object()
+		self.breakpoints = []
+
+	def tearDown(self):
+		for breakpoint in self.breakpoints:
+			breakpoint._remove()
+		Breakpoint._invalidate_index()
+
+	def make_breakpoint(self, location, enable=True):
+		breakpoint = Breakpoint(self.code.co_filename, location)
+		if enable:
+			breakpoint.enable(self.party)
+		self.breakpoints.append(breakpoint)
+		return breakpoint
+
+	def test_lineBreakpointIndexed(self):
+		breakpoint = self.make_breakpoint(self.code.co_firstlineno + 2)
+		index = Breakpoint.code_index(self.code)
+		self.assertEqual((breakpoint,), index[self.code.co_firstlineno + 2])
+
+	def test_disabledBreakpointSkipped(self):
+		self.make_breakpoint(self.code.co_firstlineno + 1, enable=False)
+		self.assertEqual({}, Breakpoint.code_index(self.code))
+
+	def test_functionBreakpointOnAnyLine(self):
+		breakpoint = self.make_breakpoint('sample_function')
+		self.assertEqual((breakpoint,), Breakpoint.code_index(self.code)[None])
+
+	def test_changesInvalidate(self):
+		self.assertEqual({}, Breakpoint.code_index(self.code))
+		breakpoint = self.make_breakpoint(self.code.co_firstlineno + 1)
+		self.assertEqual((breakpoint,), Breakpoint.code_index(self.code)[self.code.co_firstlineno + 1])
+
+		breakpoint.disable(self.party)
+		self.assertEqual({}, Breakpoint.code_index(self.code))
+
+	def test_racingBuildNotCached(self):
+		Breakpoint._instances['racing'] = _RacingBreakpoint()
+		try:
+			Breakpoint.code_index(self.code)
+			self.assertFalse(self.key in Breakpoint._code_index)
+		finally:
+			del Breakpoint._instances['racing']
+
+		Breakpoint.code_index(self.code)
+		self.assertTrue(self.key in Breakpoint._code_index)
+
+
+suite = unittest.TestLoader().loadTestsFromTestCase(CodeIndexTestCase)
+unittest.TextTestRunner(verbosity=2).run(suite)
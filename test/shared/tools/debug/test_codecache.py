@@ -0,0 +1,54 @@
+import unittest
+from threading import Thread
+
+from shared.tools.debug.codecache import CodeCache
+
+
+class CacheTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.max_entries = CodeCache.MAX_ENTRIES
+		CodeCache.invalidate()
+
+	def tearDown(self):
+		CodeCache.MAX_ENTRIES = self.max_entries
+		CodeCache.invalidate()
+
+	def assertBytesAddUp(self):
+		self.assertEqual(CodeCache._cache_bytes,
+						 sum(entry.size for entry in CodeCache._cache.values()))
+
+	def test_fetch_is_cached(self):
+		loads = []
+		def load():
+			loads.append(True)
+			return 'x = 1\n'
+		first = CodeCache._cache_fetch(('test', 'cached'), load)
+		second = CodeCache._cache_fetch(('test', 'cached'), load)
+		self.assertTrue(first is second)
+		self.assertEqual(len(loads), 1)
+		self.assertBytesAddUp()
+
+	def test_concurrent_fetches_keep_the_byte_count(self):
+		CodeCache.MAX_ENTRIES = 10
+		def fetch(offset):
+			for ix in range(300):
+				key = ('test', (offset + ix) % 25)
+				CodeCache._cache_fetch(key, lambda key=key: 'line = %r\n' % (key,) * (1 + key[1]))
+		threads = [Thread(target=fetch, args=(offset,)) for offset in range(8)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertTrue(len(CodeCache._cache) <= 10)
+		self.assertBytesAddUp()
+
+	def test_invalidate(self):
+		CodeCache._cache_fetch(('test', 'dropped'), lambda: 'x = 1\n')
+		CodeCache.invalidate('dropped')
+		self.assertEqual(CodeCache.stats['entries'], 0)
+		self.assertEqual(CodeCache.stats['bytes'], 0)
+
+
+suite = unittest.TestLoader().loadTestsFromTestCase(CacheTestCase)
+unittest.TextTestRunner(verbosity=2).run(suite)
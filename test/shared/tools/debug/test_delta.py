@@ -0,0 +1,52 @@
+import unittest
+
+from shared.tools.debug.delta import delta_encode, delta_merge
+
+
+class DeltaTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.previous = {
+			'id': 'abc',
+			'cursor': {'line': 10, 'filename': 'module', 'locals': {'x': 1}},
+			'log': 'Done.',
+			}
+
+	def test_unchanged_is_empty(self):
+		self.assertEqual(delta_encode(dict(self.previous), self.previous), {})
+
+	def test_only_changes_are_sent(self):
+		state = dict(self.previous, log='Stepped.')
+		self.assertEqual(delta_encode(state, self.previous), {'log': 'Stepped.'})
+
+	def test_nested_changes_are_sent_nested(self):
+		state = dict(self.previous, 
+					 cursor={'line': 11, 'filename': 'module', 'locals': {'x': 1}})
+		self.assertEqual(delta_encode(state, self.previous), {'cursor': {'line': 11}})
+
+	def test_new_keys_are_sent(self):
+		state = dict(self.previous, logs=['step'])
+		self.assertEqual(delta_encode(state, self.previous), {'logs': ['step']})
+
+	def test_replaced_container_is_sent_whole(self):
+		state = dict(self.previous, log={'message': 'Done.'})
+		self.assertEqual(delta_encode(state, self.previous), {'log': {'message': 'Done.'}})
+
+	def test_merge_round_trips(self):
+		state = {
+			'id': 'abc',
+			'cursor': {'line': 12, 'filename': 'module', 'locals': {'x': 2, 'y': 3}},
+			'log': 'Next.',
+			}
+		merged = delta_merge(dict(self.previous), delta_encode(state, self.previous))
+		self.assertEqual(merged, state)
+
+	def test_merge_is_in_place(self):
+		known = dict(self.previous)
+		merged = delta_merge(known, {'log': 'Continued.'})
+		self.assertTrue(merged is known)
+		self.assertEqual(known['log'], 'Continued.')
+
+
+suite = unittest.TestLoader().loadTestsFromTestCase(DeltaTestCase)
+unittest.TextTestRunner(verbosity=2).run(suite)
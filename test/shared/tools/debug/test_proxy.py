@@ -0,0 +1,102 @@
+import unittest
+from threading import Thread
+from time import sleep
+
+from shared.tools.debug.proxy import LineHistory
+
+
+class LineHistoryTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.history = LineHistory(4)
+
+	def fill(self, count):
+		for ix in range(count):
+			self.history.append('line %d' % ix, timestamp=1000 * ix)
+
+	def lines(self, records):
+		return [line for _, line in records]
+
+	def test_empty(self):
+		self.assertEqual(len(self.history), 0)
+		self.assertEqual(list(self.history), [])
+		self.assertEqual(self.history.read_since(0), ([], 0, 0))
+		self.assertRaises(IndexError, lambda: self.history[0])
+
+	def test_keeps_lines_in_order(self):
+		self.fill(3)
+		self.assertEqual(len(self.history), 3)
+		self.assertEqual(self.lines(self.history.records), ['line 0', 'line 1', 'line 2'])
+
+	def test_overwrites_the_oldest(self):
+		self.fill(6)
+		self.assertEqual(len(self.history), 4)
+		self.assertEqual(self.lines(self.history.records), ['line 2', 'line 3', 'line 4', 'line 5'])
+		self.assertEqual(self.history.first_sequence, 2)
+		self.assertEqual(self.history.next_sequence, 6)
+
+	def test_indexing_formats_the_line(self):
+		self.fill(6)
+		self.assertTrue(self.history[0].endswith('] line 2'))
+		self.assertTrue(self.history[-1].endswith('] line 5'))
+		self.assertEqual([line[-6:] for line in self.history[1:3]], ['line 3', 'line 4'])
+		self.assertRaises(IndexError, lambda: self.history[4])
+
+	def test_extend_shares_a_timestamp(self):
+		self.history.extend(['a', 'b'], timestamp=5000)
+		self.assertEqual(self.history.records, [(5000, 'a'), (5000, 'b')])
+
+	def test_read_since_picks_up_where_it_left_off(self):
+		self.fill(2)
+		lines, sequence, skipped = self.history.read_since(0, formatted=False)
+		self.assertEqual((self.lines(lines), sequence, skipped), (['line 0', 'line 1'], 2, 0))
+
+		self.history.append('line 2', timestamp=0)
+		lines, sequence, skipped = self.history.read_since(sequence, formatted=False)
+		self.assertEqual((self.lines(lines), sequence, skipped), (['line 2'], 3, 0))
+
+		self.assertEqual(self.history.read_since(sequence), ([], 3, 0))
+
+	def test_read_since_counts_what_was_overwritten(self):
+		self.fill(7)
+		lines, sequence, skipped = self.history.read_since(1, formatted=False)
+		self.assertEqual(self.lines(lines), ['line 3', 'line 4', 'line 5', 'line 6'])
+		self.assertEqual((sequence, skipped), (7, 2))
+
+	def test_read_since_limit(self):
+		self.fill(4)
+		lines, sequence, _ = self.history.read_since(0, limit=3, formatted=False)
+		self.assertEqual((self.lines(lines), sequence), (['line 0', 'line 1', 'line 2'], 3))
+		lines, sequence, _ = self.history.read_since(sequence, limit=3, formatted=False)
+		self.assertEqual((self.lines(lines), sequence), (['line 3'], 4))
+
+	def test_read_since_negative_counts_back(self):
+		self.fill(4)
+		lines, sequence, _ = self.history.read_since(-2, formatted=False)
+		self.assertEqual((self.lines(lines), sequence), (['line 2', 'line 3'], 4))
+
+	def test_wait_for_times_out(self):
+		self.fill(1)
+		self.assertTrue(self.history.wait_for(0, timeout=0.01))
+		self.assertFalse(self.history.wait_for(1, timeout=0.01))
+
+	def test_wait_for_wakes_on_append(self):
+		def write_later(history=self.history):
+			sleep(0.05)
+			history.append('late')
+		writer = Thread(target=write_later)
+		writer.start()
+		try:
+			self.assertTrue(self.history.wait_for(0, timeout=5.0))
+		finally:
+			writer.join()
+		self.assertEqual(self.lines(self.history.records), ['late'])
+
+	def test_follow_stops_when_idle(self):
+		self.fill(3)
+		followed = list(self.history.follow(sequence=1, idle_timeout=0.01, formatted=False))
+		self.assertEqual(self.lines(followed), ['line 1', 'line 2'])
+
+
+suite = unittest.TestLoader().loadTestsFromTestCase(LineHistoryTestCase)
+unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,120 @@
+import unittest
+from collections import deque
+
+from shared.tools.global import ExtraGlobal
+from shared.tools.debug.tracer import Tracer, ExtraGlobalScopes
+from shared.tools.debug.channel import CommandChannel
+from shared.tools.debug.proxy import LineHistory
+from shared.tools.debug.delta import delta_merge
+
+
+class _Stream(object):
+	def __init__(self):
+		self.history = LineHistory(10)
+
+class _Sys(object):
+	def __init__(self):
+		self.stdout = _Stream()
+		self.stdin = _Stream()
+		self.stderr = _Stream()
+
+class _ContextBuffer(object):
+	stats = {}
+
+
+class _UpdateTracer(Tracer):
+	"""Just enough of a tracer to build its state updates."""
+	__slots__ = ()
+
+	_payload_ignition_info = {}
+	_payload_cursor_info = {}
+
+	def __init__(self):
+		self.id = 'tracer'
+		self.sys = _Sys()
+		self.context_buffer = _ContextBuffer()
+		self._logged_commands = deque()
+		self._update_sequence = 0
+		self._update_published = None
+		self._update_dropped = 0
+		self._commands_logged = 0
+		self._commands_published = 0
+
+
+class UpdateTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.tracer = _UpdateTracer()
+
+	def test_update_before_anything_is_logged(self):
+		payload = self.tracer._payload_tracer_update
+		self.assertFalse(payload['delta'])
+		self.assertEqual(payload['log']['command'], None)
+
+	def test_resync_before_anything_is_logged(self):
+		self.tracer._payload_tracer_update
+		# What _command_resync does before sending
+		self.tracer._update_published = None
+		payload = self.tracer._payload_tracer_update
+		self.assertFalse(payload['delta'])
+		self.assertEqual(payload['sequence'], 2)
+		self.assertEqual(payload['log']['command'], None)
+
+	def test_logged_command_is_sent_as_a_delta(self):
+		known = self.tracer._payload_tracer_update
+		self.tracer._logged_commands.appendleft(('step', 'Stepped.'))
+		payload = self.tracer._payload_tracer_update
+		self.assertTrue(payload['delta'])
+		self.assertEqual(payload['log'], {'command': {'in': 'step', 'out': 'Stepped.'}})
+		self.assertEqual(delta_merge(known, payload)['log']['command']['out'], 'Stepped.')
+
+
+class _LocalTracer(object):
+	"""Stands in for a tracer running in this JVM."""
+	def __init__(self):
+		self._pending_commands = CommandChannel()
+
+	def submit(self, command):
+		return self._pending_commands.put(command)
+
+
+class HubTestCase(unittest.TestCase):
+
+	def setUp(self):
+		ExtraGlobal.clear()
+		ExtraGlobal.stash({'id': 'local'}, 'local', ExtraGlobalScopes.REMOTE_INFO, lifespan=30)
+
+	def tearDown(self):
+		ExtraGlobal.clear()
+
+	def test_local_heartbeats_are_not_repeated(self):
+		tracer = _LocalTracer()
+		ExtraGlobal.stash(tracer, 'local', ExtraGlobalScopes.INSTANCES, lifespan=30)
+		for _ in range(3):
+			Tracer._check_heartbeat('local')
+		self.assertEqual([pending.command for pending in tracer._pending_commands.drain()], ['heartbeat'])
+
+	def test_remote_heartbeats_are_not_repeated(self):
+		for _ in range(3):
+			Tracer._check_heartbeat('local')
+		self.assertEqual(Tracer._handle_payload({'id': 'local', 'message': 'input'}), ['heartbeat'])
+
+	def test_local_resync_is_requested_once(self):
+		tracer = _LocalTracer()
+		ExtraGlobal.stash(tracer, 'local', ExtraGlobalScopes.INSTANCES, lifespan=30)
+		for _ in range(3):
+			Tracer._request_resync('local')
+		self.assertEqual(len(tracer._pending_commands), 1)
+
+
+def load_tests(*test_cases):
+	suite = unittest.TestSuite()
+	for test_case in test_cases:
+		suite.addTests(unittest.TestLoader().loadTestsFromTestCase(test_case))
+	return suite
+
+suite = load_tests(
+	UpdateTestCase,
+	HubTestCase,
+	)
+unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,416 @@
+import unittest
+import os
+import shutil
+import tempfile
+from time import time, sleep
+from threading import Thread, Event
+
+from shared.tools.global import ExtraGlobal, extra_global_memoize
+
+
+class ExtraGlobalTestCase(unittest.TestCase):
+	"""Shared setup: every test starts with an empty cache and default settings."""
+
+	def setUp(self):
+		ExtraGlobal.clear()
+
+	def tearDown(self):
+		ExtraGlobal.clear()
+
+
+class IndexTestCase(ExtraGlobalTestCase):
+
+	def test_scopes_are_indexed(self):
+		ExtraGlobal.stash(1, 'a', 'first')
+		ExtraGlobal.stash(2, 'b', 'first')
+		ExtraGlobal.stash(3, 'c', 'second')
+		self.assertEqual(ExtraGlobal.keys(scope='first'), ['a', 'b'])
+		self.assertEqual(ExtraGlobal.scopes(), ['first', 'second'])
+
+		ExtraGlobal.trash('c', 'second')
+		self.assertEqual(ExtraGlobal.scopes(), ['first'])
+
+	def test_trash_scope(self):
+		for label in 'abc':
+			ExtraGlobal.stash(label, label, 'doomed')
+		ExtraGlobal.stash('kept', 'a', 'safe')
+		self.assertEqual(ExtraGlobal.trash_scope('doomed'), 3)
+		self.assertEqual(ExtraGlobal.keys(), [('safe', 'a')])
+
+	def test_restashing_does_not_grow_the_schedule(self):
+		for _ in range(1000):
+			ExtraGlobal.stash('value', 'restashed', lifespan=60)
+		self.assertEqual(len(ExtraGlobal._expirations), 1)
+
+	def test_schedule_stays_bounded(self):
+		# Each sooner schedule supersedes the last, leaving a stale item behind
+		for ix in range(1000):
+			ExtraGlobal.stash('value', 'sooner', lifespan=1000 - ix)
+		self.assertTrue(len(ExtraGlobal._expirations) <= 2 + ExtraGlobal._EXPIRATIONS_SLACK)
+
+	def test_due_entries(self):
+		ExtraGlobal.stash('soon', 'soon', lifespan=0.01)
+		ExtraGlobal.stash('later', 'later', lifespan=60)
+		due = ExtraGlobal._due_entries(now=time() + 1)
+		self.assertEqual([entry.label for entry in due], ['soon'])
+		# Taken off the schedule (the monitor reschedules it if it lives on)
+		self.assertEqual(ExtraGlobal._due_entries(now=time() + 1), [])
+
+	def test_used_entries_are_put_back(self):
+		ExtraGlobal.stash('value', 'used', lifespan=0.05)
+		sleep(0.03)
+		ExtraGlobal.access('used') # slides its time along
+		self.assertEqual(ExtraGlobal._due_entries(now=time() + 0.03), [])
+		self.assertEqual(len(ExtraGlobal._expirations), 1)
+
+	def test_trashed_entries_are_skipped(self):
+		ExtraGlobal.stash('value', 'trashed', lifespan=0.01)
+		ExtraGlobal.trash('trashed')
+		self.assertEqual(ExtraGlobal._due_entries(now=time() + 1), [])
+
+
+class _HeldEntry(object):
+	"""Stands in for a cache entry whose refresh takes a while."""
+	expired = False
+
+	def __init__(self, key, release):
+		self.key = key
+		self.release = release
+
+	def refresh(self, wait=True, force=False):
+		self.release.wait(5)
+
+
+class RefreshTestCase(ExtraGlobalTestCase):
+
+	def setUp(self):
+		super(RefreshTestCase, self).setUp()
+		self.release = Event()
+		self.worker_idle = ExtraGlobal.REFRESH_WORKER_IDLE
+		ExtraGlobal.REFRESH_WORKER_IDLE = 0.05
+
+	def tearDown(self):
+		self.release.set()
+		super(RefreshTestCase, self).tearDown()
+		for worker in ExtraGlobal._refresh_workers:
+			worker.join()
+		ExtraGlobal.REFRESH_WORKER_IDLE = self.worker_idle
+
+	def queue_held_entries(self, count):
+		for ix in range(count):
+			ExtraGlobal._refresh_queue.offer(_HeldEntry(('held', ix), self.release))
+
+	def test_workers_are_capped(self):
+		self.queue_held_entries(ExtraGlobal.REFRESH_WORKERS * 4)
+		spawners = [Thread(target=ExtraGlobal.spawn_refresh_worker) for _ in range(16)]
+		for spawner in spawners:
+			spawner.start()
+		for spawner in spawners:
+			spawner.join()
+		self.assertEqual(len(ExtraGlobal._refresh_workers), ExtraGlobal.REFRESH_WORKERS)
+
+	def test_worker_names_are_unique(self):
+		names = []
+		for _ in range(3):
+			self.queue_held_entries(1)
+			ExtraGlobal.spawn_refresh_worker()
+			names.append(ExtraGlobal._refresh_workers[-1].getName())
+			# Let this worker finish up, making room for the next
+			self.release.set()
+			ExtraGlobal._refresh_workers[-1].join()
+			self.release.clear()
+		self.assertEqual(len(set(names)), len(names))
+
+	def count_refreshes(self, callback_for, seconds):
+		runs = []
+		callback = callback_for(runs)
+		ExtraGlobal.stash(0, 'counted', lifespan=0.1, callback=callback)
+		ExtraGlobal.spawn_cache_monitor()
+		sleep(seconds)
+		ExtraGlobal.trash('counted')
+		return len(runs)
+
+	def test_self_stashing_callback_runs_once_per_refresh(self):
+		def returning(runs):
+			def callback():
+				runs.append(True)
+				return len(runs)
+			return callback
+		def self_stashing(runs):
+			def callback():
+				runs.append(True)
+				ExtraGlobal.stash(len(runs), 'counted', lifespan=0.1, callback=callback)
+			return callback
+		returned = self.count_refreshes(returning, 0.55)
+		stashed = self.count_refreshes(self_stashing, 0.55)
+		self.assertTrue(returned >= 3)
+		self.assertTrue(stashed <= returned + 1, '%d runs, against %d' % (stashed, returned))
+
+	def test_callback_can_read_its_own_entry(self):
+		seen = []
+		def recompute():
+			seen.append(ExtraGlobal.access('reentrant'))
+			return len(seen)
+		ExtraGlobal.stash(0, 'reentrant', lifespan=0.01, callback=recompute)
+		sleep(0.03)
+
+		results = []
+		reader = Thread(target=lambda: results.append(ExtraGlobal.access('reentrant')))
+		reader.setDaemon(True)
+		reader.start()
+		reader.join(5)
+		self.assertFalse(reader.isAlive(), 'the refresh deadlocked')
+		self.assertEqual(results, [1])
+		# The callback saw the old value while working out the new one
+		self.assertEqual(seen, [0])
+
+
+class MemoizeTestCase(ExtraGlobalTestCase):
+
+	def tearDown(self):
+		ExtraGlobal.set_capacity('memoized.square')
+		super(MemoizeTestCase, self).tearDown()
+
+	def memoize(self, calls, max_entries=None):
+		@extra_global_memoize(scope='memoized', lifespan=60, max_entries=max_entries)
+		def square(x):
+			calls.append(x)
+			return x * x
+		return square
+
+	def test_results_are_cached(self):
+		calls = []
+		square = self.memoize(calls)
+		self.assertEqual([square(3), square(3), square(4)], [9, 9, 16])
+		self.assertEqual(calls, [3, 4])
+		info = square.cache_info()
+		self.assertEqual((info['hits'], info['misses'], info['entries']), (1, 2, 2))
+
+	def test_unhashable_arguments_are_not_cached(self):
+		calls = []
+		square = self.memoize(calls)
+		self.assertRaises(TypeError, square, [3])
+		self.assertEqual(square.cache_info()['uncacheable'], 1)
+
+	def test_max_entries(self):
+		square = self.memoize([], max_entries=3)
+		for x in range(10):
+			square(x)
+		info = square.cache_info()
+		self.assertTrue(info['entries'] <= 3)
+		self.assertEqual(info['entries'] + info['evictions'], 10)
+
+	def test_max_entries_holds_across_reloads(self):
+		for generation in range(3):
+			square = self.memoize([], max_entries=3)
+			for x in range(5):
+				square(generation * 5 + x)
+		self.assertTrue(square.cache_info()['entries'] <= 3)
+
+	def test_shared_scope_is_left_alone(self):
+		for label in 'abcde':
+			ExtraGlobal.stash(label, label, 'memoized')
+		square = self.memoize([], max_entries=3)
+		for x in range(10):
+			square(x)
+		self.assertEqual(ExtraGlobal.keys(scope='memoized'), list('abcde'))
+		info = square.cache_info()
+		self.assertEqual(info['scope'], 'memoized.square')
+		self.assertEqual(info['entries'] + info['evictions'], 10)
+
+	def test_cache_clear(self):
+		calls = []
+		square = self.memoize(calls)
+		square(3)
+		square.cache_clear()
+		self.assertEqual(square.cache_info()['entries'], 0)
+		square(3)
+		self.assertEqual(calls, [3, 3])
+
+
+class CapacityTestCase(ExtraGlobalTestCase):
+
+	def tearDown(self):
+		ExtraGlobal.set_capacity('bounded')
+		ExtraGlobal.EVICTION_POLICY = 'lru'
+		super(CapacityTestCase, self).tearDown()
+
+	def test_least_recently_used_are_evicted(self):
+		ExtraGlobal.set_capacity('bounded', max_entries=10)
+		for ix in range(10):
+			ExtraGlobal.stash(ix, ix, 'bounded')
+			sleep(0.001)
+		ExtraGlobal.access(0, 'bounded')
+		ExtraGlobal.stash(10, 10, 'bounded')
+		# Back down to the EVICTION_TARGET, keeping what was just used
+		labels = ExtraGlobal.keys(scope='bounded')
+		self.assertEqual(len(labels), 9)
+		self.assertTrue(0 in labels and 10 in labels)
+		self.assertEqual(ExtraGlobal.stats()['scopes']['bounded']['evictions'], 2)
+
+	def test_least_frequently_used_are_evicted(self):
+		ExtraGlobal.EVICTION_POLICY = 'lfu'
+		ExtraGlobal.set_capacity('bounded', max_entries=4)
+		for ix in range(4):
+			ExtraGlobal.stash(ix, ix, 'bounded')
+		for _ in range(3):
+			ExtraGlobal.access(1, 'bounded')
+			ExtraGlobal.access(2, 'bounded')
+		ExtraGlobal.stash(4, 4, 'bounded')
+		self.assertEqual(ExtraGlobal.keys(scope='bounded'), [1, 2, 4])
+
+	def test_max_bytes(self):
+		ExtraGlobal.set_capacity('bounded', max_bytes=20000)
+		for ix in range(50):
+			ExtraGlobal.stash('x' * 1000, ix, 'bounded')
+		stats = ExtraGlobal.stats()['scopes']['bounded']
+		self.assertTrue(stats['bytes'] <= 20000)
+		self.assertEqual(stats['entries'] + stats['evictions'], 50)
+		# The newest entry is never the one evicted
+		self.assertTrue(49 in ExtraGlobal.keys(scope='bounded'))
+
+
+class MetricsTestCase(ExtraGlobalTestCase):
+
+	def setUp(self):
+		super(MetricsTestCase, self).setUp()
+		self.max_keys = ExtraGlobal.METRICS_MAX_KEYS
+
+	def tearDown(self):
+		ExtraGlobal.METRICS_MAX_KEYS = self.max_keys
+		super(MetricsTestCase, self).tearDown()
+
+	def test_hits_and_misses(self):
+		ExtraGlobal.stash('value', 'counted')
+		ExtraGlobal.access('counted')
+		ExtraGlobal.access('counted')
+		self.assertRaises(KeyError, ExtraGlobal.access, 'missing')
+		rows = dict((row['label'], row) for row in ExtraGlobal.key_metrics())
+		self.assertEqual((rows['counted']['hits'], rows['counted']['misses']), (2, 0))
+		self.assertEqual((rows['missing']['hits'], rows['missing']['misses']), (0, 1))
+		self.assertEqual(rows['counted']['hit_ratio'], 1.0)
+
+	def test_pruned_to_low_water(self):
+		ExtraGlobal.METRICS_MAX_KEYS = 10
+		ExtraGlobal.stash('value', 'cached')
+		ExtraGlobal.access('cached')
+		for ix in range(9):
+			self.assertRaises(KeyError, ExtraGlobal.access, ix)
+		self.assertEqual(len(ExtraGlobal.key_metrics()), 10)
+
+		# The next one prunes back to half, keeping the cached key
+		self.assertRaises(KeyError, ExtraGlobal.access, 'one more')
+		labels = [row['label'] for row in ExtraGlobal.key_metrics()]
+		self.assertEqual(len(labels), 6)
+		self.assertTrue('cached' in labels and 'one more' in labels)
+
+	def test_concurrent_tracking(self):
+		ExtraGlobal.METRICS_MAX_KEYS = 50
+		def miss(offset):
+			for ix in range(500):
+				try:
+					ExtraGlobal.access(offset + ix)
+				except KeyError:
+					pass
+		threads = [Thread(target=miss, args=(offset,)) for offset in range(0, 4000, 500)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertTrue(len(ExtraGlobal.key_metrics()) <= 50)
+
+
+class PersistenceTestCase(ExtraGlobalTestCase):
+
+	def setUp(self):
+		super(PersistenceTestCase, self).setUp()
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, 'snapshot')
+		self.limits = (ExtraGlobal.PERSIST_MAX_ENTRY_BYTES, ExtraGlobal.PERSIST_MAX_BYTES)
+
+	def tearDown(self):
+		ExtraGlobal.PERSIST_MAX_ENTRY_BYTES, ExtraGlobal.PERSIST_MAX_BYTES = self.limits
+		shutil.rmtree(self.directory)
+		super(PersistenceTestCase, self).tearDown()
+
+	def test_round_trip(self):
+		ExtraGlobal.stash({'a': 1}, 'settings', 'saved', lifespan=60)
+		ExtraGlobal.stash('value', 'plain', lifespan=60)
+		self.assertEqual(ExtraGlobal.persist(self.path), 2)
+		ExtraGlobal.clear()
+		self.assertEqual(ExtraGlobal.restore(self.path), 2)
+		self.assertEqual(ExtraGlobal.access('settings', 'saved'), {'a': 1})
+		self.assertEqual(ExtraGlobal.access('plain'), 'value')
+
+	def test_nothing_to_save_writes_nothing(self):
+		self.assertEqual(ExtraGlobal.persist(self.path), 0)
+		self.assertFalse(os.path.exists(self.path))
+
+		# ... and leaves the last snapshot alone
+		ExtraGlobal.stash('value', 'kept', lifespan=60)
+		ExtraGlobal.persist(self.path)
+		ExtraGlobal.clear()
+		self.assertEqual(ExtraGlobal.persist(self.path), 0)
+		self.assertEqual(ExtraGlobal.restore(self.path), 1)
+
+	def test_snapshot_is_private(self):
+		ExtraGlobal.stash('value', 'private', lifespan=60)
+		ExtraGlobal.persist(self.path)
+		self.assertEqual(os.stat(self.path).st_mode & 077, 0)
+
+	def test_planted_temp_link_is_not_written_through(self):
+		target = os.path.join(self.directory, 'target')
+		target_file = open(target, 'w')
+		target_file.write('untouched')
+		target_file.close()
+		os.symlink(target, self.path + '.tmp')
+		ExtraGlobal.stash('value', 'linked', lifespan=60)
+		self.assertEqual(ExtraGlobal.persist(self.path), 1)
+		self.assertEqual(open(target).read(), 'untouched')
+		self.assertFalse(os.path.islink(self.path))
+		self.assertEqual(os.stat(self.path).st_mode & 077, 0)
+
+	def test_writable_snapshot_is_refused(self):
+		ExtraGlobal.stash('value', 'tampered', lifespan=60)
+		ExtraGlobal.persist(self.path)
+		ExtraGlobal.clear()
+		os.chmod(self.path, 0666)
+		self.assertEqual(ExtraGlobal.restore(self.path), 0)
+		self.assertEqual(ExtraGlobal.keys(), [])
+
+	def test_large_entries_are_not_saved(self):
+		ExtraGlobal.PERSIST_MAX_ENTRY_BYTES = 1000
+		ExtraGlobal.stash('x' * 1000, 'large', lifespan=60)
+		ExtraGlobal.stash('x', 'small', lifespan=60)
+		self.assertEqual(ExtraGlobal.persist(self.path), 1)
+		ExtraGlobal.clear()
+		ExtraGlobal.restore(self.path)
+		self.assertEqual(ExtraGlobal.keys(), [(None, 'small')])
+
+	def test_snapshot_budget_keeps_recently_used(self):
+		ExtraGlobal.stash('x' * 1000, 'older', lifespan=60)
+		ExtraGlobal.stash('x' * 1000, 'newer', lifespan=60)
+		sleep(0.01)
+		ExtraGlobal.access('newer')
+		ExtraGlobal.PERSIST_MAX_BYTES = 3000
+		self.assertEqual(ExtraGlobal.persist(self.path), 1)
+		ExtraGlobal.clear()
+		ExtraGlobal.restore(self.path)
+		self.assertEqual(ExtraGlobal.keys(), [(None, 'newer')])
+
+
+def load_tests(*test_cases):
+	suite = unittest.TestSuite()
+	for test_case in test_cases:
+		suite.addTests(unittest.TestLoader().loadTestsFromTestCase(test_case))
+	return suite
+
+suite = load_tests(
+	IndexTestCase,
+	RefreshTestCase,
+	CapacityTestCase,
+	MemoizeTestCase,
+	MetricsTestCase,
+	PersistenceTestCase,
+	)
+unittest.TextTestRunner(verbosity=2).run(suite)
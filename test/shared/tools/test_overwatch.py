@@ -0,0 +1,128 @@
+import unittest
+import sys
+
+from shared.tools.overwatch import TraceMultiplexer
+
+
+def target():
+	x = 1
+	y = 2
+	return x + y
+
+def other():
+	return 3
+
+
+class Recorder(object):
+	"""Traces just the frames of the given functions, noting what it sees."""
+	def __init__(self, *functions):
+		self.codes = set(function.func_code for function in functions)
+		self.seen = []
+
+	def dispatch(self, frame, event, arg):
+		if frame.f_code not in self.codes:
+			return None
+		self.seen.append((frame.f_code.co_name, event))
+		return self.dispatch
+
+	def events(self, name):
+		return [event for code_name, event in self.seen if code_name == name]
+
+
+class FakeSys(object):
+	"""A consumer's own sys (like the Tracer's hijacked one)."""
+	def __init__(self):
+		self.calls = []
+		self.version = 'fake'
+	def settrace(self, trace_function):
+		self.calls.append(trace_function)
+
+
+class SysConsumer(Recorder):
+	def __init__(self, *functions):
+		super(SysConsumer, self).__init__(*functions)
+		self.sys = FakeSys()
+
+
+class TraceMultiplexerTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.multiplexer = TraceMultiplexer()
+
+	def tearDown(self):
+		self.multiplexer.uninstall()
+		sys.settrace(None)
+
+	def run_traced(self, *functions):
+		self.multiplexer.install()
+		try:
+			for function in functions:
+				function()
+		finally:
+			sys.settrace(None)
+
+	def test_declined_frames_get_no_local_events(self):
+		wants_target = Recorder(target)
+		wants_other = Recorder(other)
+		self.multiplexer.subscribe(wants_target)
+		self.multiplexer.subscribe(wants_other)
+
+		self.run_traced(target, other)
+
+		self.assertEqual(wants_target.events('target'), ['call', 'line', 'line', 'line', 'return'])
+		self.assertEqual(wants_target.events('other'), [])
+		self.assertEqual(wants_other.events('other'), ['call', 'line', 'return'])
+		self.assertEqual(wants_other.events('target'), [])
+
+	def test_subscribed_events_only(self):
+		recorder = Recorder(target)
+		self.multiplexer.subscribe(recorder, events=['call', 'return'])
+		self.run_traced(target)
+		self.assertEqual(recorder.events('target'), ['call', 'return'])
+
+	def test_subscribe_reinstalls_a_replaced_hook(self):
+		recorder = Recorder(target)
+		self.multiplexer.subscribe(recorder)
+		# Something else (like an Overwatch being created) takes the hook over
+		sys.settrace(lambda frame, event, arg: None)
+		self.assertFalse(self.multiplexer.installed)
+
+		self.multiplexer.subscribe(Recorder(other))
+		self.assertTrue(self.multiplexer.installed)
+
+	def test_consumer_settrace_is_routed(self):
+		consumer = SysConsumer(target)
+		self.multiplexer.subscribe(consumer)
+
+		# Setting its own trace function doesn't replace the shared hook...
+		consumer.sys.settrace(consumer.dispatch)
+		self.assertTrue(self.multiplexer.installed)
+		self.assertEqual(consumer.sys.version, 'fake')
+
+		# ... and clearing it just unsubscribes it
+		consumer.sys.settrace(None)
+		self.assertEqual(self.multiplexer.consumers, [])
+		self.assertFalse(self.multiplexer.installed)
+		self.assertTrue(isinstance(consumer.sys, FakeSys))
+		self.assertEqual(consumer.sys.calls, [])
+
+	def test_unsubscribe_stops_local_events(self):
+		recorder = Recorder(target)
+		keeper = Recorder(other)
+		self.multiplexer.subscribe(recorder)
+		self.multiplexer.subscribe(keeper)
+		self.multiplexer.unsubscribe(recorder)
+		self.run_traced(target)
+		self.assertEqual(recorder.seen, [])
+
+	def test_last_unsubscribe_uninstalls(self):
+		recorder = Recorder(target)
+		self.multiplexer.subscribe(recorder)
+		self.assertTrue(self.multiplexer.installed)
+		self.multiplexer.unsubscribe(recorder)
+		self.assertFalse(self.multiplexer.installed)
+		self.assertTrue(sys.gettrace() is None)
+
+
+suite = unittest.TestLoader().loadTestsFromTestCase(TraceMultiplexerTestCase)
+unittest.TextTestRunner(verbosity=2).run(suite)
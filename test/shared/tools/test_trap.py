@@ -0,0 +1,53 @@
+import unittest
+
+from shared.tools.trap import Trap
+
+
+def is_negative(x):
+	return x < 0
+
+def is_large(x):
+	return x > 100
+
+
+class TriggerTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.trap = Trap()
+
+	def test_traps_lists_the_triggers(self):
+		self.trap.add_trigger(is_negative)
+		self.trap.add_trigger(is_large, False, caller='work')
+		self.assertEqual(dict(self.trap.traps.items()), {is_negative: True, is_large: False})
+		self.assertTrue(is_negative in self.trap.traps)
+		self.assertEqual(self.trap.traps[is_large], False)
+
+	def test_traps_is_read_only(self):
+		self.trap.add_trigger(is_negative)
+		def assign():
+			self.trap.traps[is_large] = True
+		def delete():
+			del self.trap.traps[is_negative]
+		self.assertRaises(TypeError, assign)
+		self.assertRaises((TypeError, AttributeError), delete)
+		self.assertEqual(self.trap.traps.keys(), [is_negative])
+
+	def test_replacing_a_trigger(self):
+		self.trap.add_trigger(is_negative, filename='module')
+		self.trap.add_trigger(is_negative, False)
+		self.assertEqual(len(self.trap.traps), 1)
+		self.assertEqual(self.trap.relevant_triggers('module', 'work')[0].expected_result, False)
+
+	def test_remove_trigger(self):
+		self.trap.add_trigger(is_negative, caller='work')
+		self.assertEqual(len(self.trap.relevant_triggers('module', 'work')), 1)
+		self.assertTrue(self.trap.remove_trigger(is_negative))
+		self.assertFalse(self.trap.remove_trigger(is_negative))
+		self.assertEqual(len(self.trap.traps), 0)
+		# The cached lookups are dropped, too
+		self.assertEqual(self.trap.relevant_triggers('module', 'work'), ())
+		self.assertEqual(self.trap._triggers, {})
+
+
+suite = unittest.TestLoader().loadTestsFromTestCase(TriggerTestCase)
+unittest.TextTestRunner(verbosity=2).run(suite)